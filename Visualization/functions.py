@@ -12,10 +12,13 @@ from matplotlib.patches import Rectangle
 import matplotlib.pyplot as plt
 import matplotlib.cm as cm
 
+from segmentation.masks import SparseMasks
+
 # from Angran Li. Plot for trace visualization
+# A_path is a seg_results .mat file or SparseMasks
 def plot_trace(A_path, C_path, output_dir, frame_len = 1000, neuron_step = 100):
     # neuron_image_data_path = r"/mnt/nas/lk/pico/Experiments/0729_multi_animal_n3/exp01_m20/29-Jul-24/23-24-56-719/analysis/seg_results_thresh_pmap_1/seg_results_filtered.mat"
-    neuron_image_data = loadmat(A_path)
+    masks = A_path if isinstance(A_path, SparseMasks) else SparseMasks.load_mat(A_path)
 
     # neuron_intensity_data_path = r"/mnt/nas/lk/pico/Experiments/0729_multi_animal_n3/exp01_m20/29-Jul-24/23-24-56-719/analysis/seg_results_thresh_pmap_1/infer_results_filtered.mat"
     C = loadmat(C_path)["C"]
@@ -23,14 +26,8 @@ def plot_trace(A_path, C_path, output_dir, frame_len = 1000, neuron_step = 100):
     # output_dir = "/mnt/nas/lk/pico/Experiments/0729_multi_animal_n3/exp01_m20/29-Jul-24/23-24-56-719/Neuron_trace/"  # Replace with the actual path
     os.makedirs(output_dir, exist_ok=True)
 
-    names = [name for name in neuron_image_data.keys() if "frame" in name]
-    # Extract frames and convert sparse matrices to dense arrays
-    frame_shape = neuron_image_data[names[0]].shape
-    summed_frames = np.zeros(frame_shape, dtype=np.int8)
-
-    for frame_name in names:
-        frame = np.array(neuron_image_data[frame_name].todense(), dtype=np.int8)
-        summed_frames += frame
+    # number of neurons covering every pixel
+    summed_frames = masks.sum_image()
 
     # Normalize the summed frames to binary image (0 and 255)
     binary_image = (summed_frames > 0).astype(np.uint8) * 255
@@ -69,9 +66,9 @@ def plot_trace(A_path, C_path, output_dir, frame_len = 1000, neuron_step = 100):
 
         temp_image = np.array(image.convert("RGB"))
         for i in neuron_indices:
-            frame = np.array(neuron_image_data[names[i]].todense(), dtype=np.uint8)
+            rows, cols = masks.pixels(i)
             color=cmap(norm(i - neuron_start))
-            temp_image[frame == 1] = (np.array(color[:3]) * 255).astype(np.uint8)
+            temp_image[rows, cols] = (np.array(color[:3]) * 255).astype(np.uint8)
         temp_image = Image.fromarray(temp_image)
 
         # Left plot: Image
@@ -112,7 +109,7 @@ def plot_trace(A_path, C_path, output_dir, frame_len = 1000, neuron_step = 100):
         plt.savefig(save_path, dpi=100)
 
 # save mc_video to avi format
-def save_video(video, fr, outpath, quality=97):
+def save_video(video, fr, outpath, quality=97, scale=None):
     fourcc = cv2.VideoWriter_fourcc(*'MJPG')
     out = cv2.VideoWriter(outpath, fourcc, fr, (video[0].shape[1], video[0].shape[0]), isColor=False)
 
@@ -127,6 +124,8 @@ def save_video(video, fr, outpath, quality=97):
         else:
             gray_frame = frame  # Frame is already grayscale
         # Continue processing gray_frame
+        if scale is not None: # e.g. 255 / max for unnormalized frames
+            gray_frame = gray_frame.astype(np.float32) * scale
         gray_frame = gray_frame.astype(np.uint8) 
 
         out.write(gray_frame)
@@ -195,7 +194,8 @@ def filter_masks_by_roundness(masks, max_axis_ratio=3, min_occupancy=0.5):
     Filters a list of binary masks based on their roundness using elliptical fitting.
 
     Args:
-        masks: A list of N d1 x d2 binary masks (numpy arrays).
+        masks: A list of N d1 x d2 binary masks (numpy arrays), or SparseMasks.
+            SparseMasks are processed on a crop around each mask, with the same result.
         max_axis_ratio: The maximum allowed ratio between the long and short axes of the fitted ellipse.
         min_occupancy: The minimum required ratio of cell pixels within the fitted ellipse.
 
@@ -204,8 +204,14 @@ def filter_masks_by_roundness(masks, max_axis_ratio=3, min_occupancy=0.5):
     """
 
     invalid_id = []
+    is_sparse = isinstance(masks, SparseMasks)
 
-    for idx, mask in tqdm(enumerate(masks)):
+    for idx in tqdm(range(len(masks))):
+        if is_sparse:
+            # 1 pixel margin so the contour does not touch the border of the crop
+            mask, roi = masks.crop(idx, margin=1)
+        else:
+            mask = masks[idx]
         # Find contours in the mask
         contours, _ = cv2.findContours(mask.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
 
@@ -227,6 +233,16 @@ def filter_masks_by_roundness(masks, max_axis_ratio=3, min_occupancy=0.5):
 
                 axis_ratio = major_axis_length / minor_axis_length
 
+                if is_sparse:
+                    # the ellipse can be larger than the mask, use a window that holds it
+                    # (clipped to the frame, as the full size mask would be)
+                    radius = int(np.ceil(major_axis_length / 2)) + 2
+                    cx, cy = center[0] + roi[2], center[1] + roi[0]
+                    y0, y1, x0, x1 = masks.bboxes[idx]
+                    mask, (wy, wx) = masks.window(idx, min(y0, np.floor(cy) - radius), max(y1, np.ceil(cy) + radius + 1),
+                                                  min(x0, np.floor(cx) - radius), max(x1, np.ceil(cx) + radius + 1))
+                    ellipse = ((cx - wx, cy - wy), axes, orientation)
+
                 # Calculate occupancy only if ellipse is valid
                 ellipse_mask = np.zeros_like(mask, dtype=np.uint8)
                 try:
@@ -6,5 +6,5 @@ from .cluster import start_server, stop_server
 from .mmapping import load_memmap, save_memmap, save_memmap_each, save_memmap_join
 from .summary_images import local_correlations
 
-from .mc_function import normcorre_function
+from .mc_function import normcorre_function, normcorre_session, MCDiagnostics
 #from .source_extraction import cnmf
@@ -37,9 +37,12 @@ logging.basicConfig(format=
 
 
 import caiman as cm
-from caiman.motion_correction import MotionCorrect, tile_and_correct, motion_correction_piecewise
+from caiman.motion_correction import MotionCorrect, tile_and_correct, motion_correction_piecewise, motion_correct_batch_rigid
+from caiman.shared_array import SharedArrayHandle
 from caiman.utils.utils import download_demo
 from caiman.base.movies import movie
+from caiman.summary_images import local_correlations_fft
+from pipeline import timing
 
 
 def normcorre_function(video, # a numpy array of the video
@@ -54,7 +57,17 @@ def normcorre_function(video, # a numpy array of the video
                        outpath,
                        template = None,
                        save_movie = True,
-                       dview = None):
+                       dview = None,
+                       shared_backend = 'memmap', # 'shm' or 'memmap', how the workers read the input frames
+                       source = None, # VideoBuffer video is a chunk of: the workers read its file at source_offset, no copy
+                       source_offset = 0, # index of the first frame of video in source
+                       mc_mode = 'two_pass', # 'two_pass': rigid then pw-rigid, 'single_pass': pw-rigid seeded by the rigid shift of each frame
+                       downsample_factor = 1, # > 1: shifts estimated on frames downsampled by this factor, applied at full resolution
+                       persist = 'frames', # 'frames': return the corrected movie, 'shifts': only estimate the shifts (returns None instead of the movie)
+                       shift_store = None, # ShiftStore the shifts are written to, at shift_offset
+                       shift_offset = 0,
+                       diagnostics = 'full', # 'full': figures and concat movie of the chunk, 'summary': only added to summary, 'off': none
+                       summary = None): # MCDiagnostics of the session the chunk is added to
     # %% parameters
     # fr = 10 # frame rate
     # max_shifts = (50, 50)  # maximum allowed rigid shift in pixels (view the movie to get a sense of motion)
@@ -67,11 +80,12 @@ def normcorre_function(video, # a numpy array of the video
     # downsample_ratio = 0.1 # for displaying purpose
 
     # %%
+    # the original movie is only kept for the figures of the chunk
     m_orig = movie(video.astype(np.float32),
                      fr=fr,
                      start_time=0,
                      file_name='video',
-                     meta_data=None)
+                     meta_data=None) if diagnostics == 'full' else None
 
     #%% start the cluster (if a cluster already exists terminate it)
     if dview is None:
@@ -85,56 +99,141 @@ def normcorre_function(video, # a numpy array of the video
         input_deview_flag = True
 
     # %%
+    # share the input with the workers by name, no hdf5 copy in the cwd
+    if source is not None:
+        # the chunk is already in the raw memmap of the session, the workers read it there
+        source.flush()
+        video_handle = SharedArrayHandle(source.path, video.shape, video.dtype, backend='memmap',
+                                         out_dir=outpath, offset=source_offset)
+    else:
+        video_handle = SharedArrayHandle.from_array(video, backend=shared_backend, tmp_dir=outpath)
     # create a motion correction object
-    mc = MotionCorrect(video, dview=dview, max_shifts=max_shifts,
+    mc = MotionCorrect(video_handle, dview=dview, max_shifts=max_shifts,
                     strides=strides, overlaps=overlaps,
                     max_deviation_rigid=max_deviation_rigid, 
                     shifts_opencv=shifts_opencv, nonneg_movie=True,
-                    border_nan=border_nan)
+                    border_nan=border_nan, downsample_factor=downsample_factor)
 
-    # correct for rigid motion correction and save the file (in memory mapped form)
-    if template is not None:
-        mc.motion_correct(save_movie=True, template=template)
+    # with persist='shifts' no corrected frame is written, they are recomputed from the shifts when read (ShiftedVideo)
+    keep_frames = persist == 'frames'
+    m_rig, m_els = None, None
+    if mc_mode == 'single_pass':
+        # one read and one write of the frames: no rigid movie, the rigid shifts come with the pw-rigid pass
+        timing.begin('single_pass')
+        mc.motion_correct(save_movie=keep_frames, template=template, single_pass=True)
+        if keep_frames:
+            m_els = cm.load(mc.fname_tot_els,
+                            fr=fr)
+        bord_px_rig = np.ceil(np.max(mc.shifts_rig)).astype(int)
+        timing.count(frames=len(video))
+        timing.end('single_pass')
     else:
-        mc.motion_correct(save_movie=True)
-    # %% load motion corrected movie
-    m_rig = cm.load(mc.mmap_file, 
-                    fr=fr)
-    bord_px_rig = np.ceil(np.max(mc.shifts_rig)).astype(int) # TODO save, this is for the border pixels
-    # let's save this video in uint8
-    if save_movie:
-        tif.imsave(outpath + '/rigid.tif', m_rig.astype(np.uint8))
+        # correct for rigid motion correction and save the file (in memory mapped form)
+        timing.begin('rigid')
+        if template is not None:
+            mc.motion_correct(save_movie=keep_frames, template=template)
+        else:
+            mc.motion_correct(save_movie=keep_frames)
+        # %% load motion corrected movie
+        if keep_frames:
+            m_rig = cm.load(mc.mmap_file, 
+                            fr=fr)
+        bord_px_rig = np.ceil(np.max(mc.shifts_rig)).astype(int) # TODO save, this is for the border pixels
+        timing.count(frames=len(video))
+        timing.end('rigid')
+        # let's save this video in uint8
+        if save_movie and keep_frames:
+            with timing.stage('write_tif'):
+                tif.imsave(outpath + '/rigid.tif', m_rig.astype(np.uint8))
+                timing.count(bytes_written=m_rig.size)
 
     #%% visualize templates
-    plt.figure(figsize = (20,10))
-    plt.imshow(mc.total_template_rig, cmap = 'gray') # get the template
-    plt.savefig(outpath + '/template.svg', format='svg')
-    plt.savefig(outpath +'/template.png')
+    if diagnostics == 'full':
+        timing.begin('figures')
+        plt.figure(figsize = (20,10))
+        plt.imshow(mc.total_template_rig, cmap = 'gray') # get the template
+        plt.savefig(outpath + '/template.svg', format='svg')
+        plt.savefig(outpath +'/template.png')
+        timing.end('figures')
 
     #%% motion correct piecewise rigid
-    mc.pw_rigid = True  # turn the flag to True for pw-rigid motion correction
-    mc.template = mc.mmap_file  # use the template obtained before to save in computation (optional). We can use this feature to do a very large file compensation
+    if mc_mode != 'single_pass':
+        timing.begin('pw_rigid')
+        mc.pw_rigid = True  # turn the flag to True for pw-rigid motion correction
+        mc.template = mc.mmap_file  # use the template obtained before to save in computation (optional). We can use this feature to do a very large file compensation
 
-    mc.motion_correct(save_movie=True, template=mc.total_template_rig) # note we do with template input
+        mc.motion_correct(save_movie=keep_frames, template=mc.total_template_rig) # note we do with template input
+        # load motion corrected movie, piecewise
+        if keep_frames:
+            m_els = cm.load(mc.fname_tot_els,
+                            fr=fr)
+        timing.count(frames=len(video))
+        timing.end('pw_rigid')
     out_template = mc.total_template_rig
-    # load motion corrected movie, piecewise
-    m_els = cm.load(mc.fname_tot_els,
-                    fr=fr)
+    if shift_store is not None:
+        shift_store.write(shift_offset, mc)
 
     # %%
-    # do the downsampling and concatenate, for visualization
-    concat_movie = cm.concatenate([m_orig.resize(1, 1, downsample_ratio) - mc.min_mov*mc.nonneg_movie,
-                    m_rig.resize(1, 1, downsample_ratio), m_els.resize(
-                1, 1, downsample_ratio)], axis=2)
-    tif.imsave(outpath + '/concat_movie.tif', concat_movie.astype(np.uint8))
-    # %%
-    # let's save it
-    m_nonrig = cm.load(mc.fname_tot_els, fr=fr)
-    # let's save this videoin uint8
-    if save_movie:
-        tif.imsave(outpath + '/non_rigid.tif', m_nonrig.astype(np.uint8))
+    # let's save it, the pw-rigid movie is already loaded
+    m_nonrig = m_els
+    if keep_frames:
+        timing.begin('write_tif')
+        if diagnostics == 'full':
+            # do the downsampling and concatenate, for visualization
+            concat_movie = cm.concatenate([m_orig.resize(1, 1, downsample_ratio) - mc.min_mov*mc.nonneg_movie] +
+                            ([m_rig.resize(1, 1, downsample_ratio)] if m_rig is not None else []) +
+                            [m_els.resize(1, 1, downsample_ratio)], axis=2)
+            tif.imsave(outpath + '/concat_movie.tif', concat_movie.astype(np.uint8))
+            timing.count(bytes_written=concat_movie.size)
+        # let's save this videoin uint8
+        if save_movie:
+            tif.imsave(outpath + '/non_rigid.tif', m_nonrig.astype(np.uint8))
+            timing.count(bytes_written=m_nonrig.size)
+        timing.end('write_tif')
+
+    if summary is not None:
+        with timing.stage('summary'):
+            summary.add(video, mc, corrected=m_els)
+
+    if diagnostics == 'full':
+        plot_chunk_figures(outpath, mc, [m for m in (m_orig, m_rig, m_els) if m is not None])
+
+    #%% compute borders to exclude
+    bord_px_els = np.ceil(np.maximum(np.max(np.abs(mc.x_shifts_els)),
+                                    np.max(np.abs(mc.y_shifts_els)))).astype(int)
+
+    # TODO save
+    #%% stop the cluster
+    if input_deview_flag == False:
+        cm.stop_server(dview=dview) # stop the server
+    if source is None:
+        video_handle.release()
+    # the rigid and pw-rigid memmaps are not needed once loaded, the returned movie still maps
+    # the pw-rigid one, its disk space is freed with the movie (Linux)
+    m_rig = None
+    remove_memmaps(mc.fname_tot_rig + mc.fname_tot_els)
+    
+    
+    plt.close()
+    #%% return the nonrigid movie
+    return m_nonrig, bord_px_rig, bord_px_els, out_template
+
+def remove_memmaps(fnames):
+    # removes the motion corrected memmaps of a chunk, left in place if still mapped on Windows
+    for fname in fnames:
+        if fname is None:
+            continue
+        try:
+            os.remove(fname)
+        except FileNotFoundError:
+            pass
+        except PermissionError:
+            logging.warning(f'{fname} is still mapped and was not removed')
 
+def plot_chunk_figures(outpath, mc, corr_movies):
+    # shifts and local correlation images of one chunk, diagnostics='full' of normcorre_function
     #%% plot rigid shifts
+    timing.begin('figures')
     plt.close()
     plt.figure(figsize = (20,10))
     plt.plot(mc.shifts_rig)
@@ -159,25 +258,224 @@ def normcorre_function(video, # a numpy array of the video
 
     # %% plot correlations
     plt.figure(figsize = (20,10))
-    plt.subplot(1,3,1); plt.imshow(m_orig.local_correlations(eight_neighbours=True, swap_dim=False))
-    plt.subplot(1,3,2); plt.imshow(m_rig.local_correlations(eight_neighbours=True, swap_dim=False))
-    plt.subplot(1,3,3); plt.imshow(m_els.local_correlations(eight_neighbours=True, swap_dim=False))
+    for i, m in enumerate(corr_movies):
+        plt.subplot(1, len(corr_movies), i + 1); plt.imshow(m.local_correlations(eight_neighbours=True, swap_dim=False))
     plt.savefig(outpath +'/local_correlation.png')
     plt.savefig(outpath + '/local_correlation.svg', format='svg')
+    timing.end('figures')
 
-    #%% compute borders to exclude
+def session_template(video_handle, max_shifts, dview, n_workers, template_frames=1000,
+                     shifts_opencv=True, border_nan='copy', shared_backend='memmap', outpath=None):
+    # phase one of normcorre_session: rigid template of a strided subsample of the whole session.
+    # bin_median of the subsample corrected against itself, then refined by one rigid pass over it
+    T = len(video_handle)
+    stride = max(1, T // template_frames)
+    sample = video_handle.read(slice(0, T, stride), dtype=np.float32)
+    sample_handle = SharedArrayHandle.from_array(sample, backend=shared_backend, tmp_dir=outpath)
+    try:
+        _, template, _, _ = motion_correct_batch_rigid(sample_handle, max_shifts, dview=dview,
+                                                       splits=min(n_workers, len(sample)), template=None,
+                                                       shifts_opencv=shifts_opencv, save_movie_rigid=False,
+                                                       add_to_movie=-np.min(sample), nonneg_movie=True,
+                                                       border_nan=border_nan)
+    finally:
+        sample_handle.release()
+    return template
+
+def normcorre_session(video, # (T, d1, d2) video of the whole session, VideoBuffer (its file is shared as is) or numpy array
+                      fr,
+                      max_shifts,
+                      strides,
+                      overlaps,
+                      max_deviation_rigid,
+                      shifts_opencv,
+                      border_nan,
+                      outpath,
+                      dview,
+                      n_workers, # number of processes of dview
+                      num_frames_split = 100, # approximate length of the splits handed to the workers
+                      template_frames = 1000, # number of frames of the subsample used for the template
+                      template = None,
+                      shared_backend = 'memmap',
+                      downsample_factor = 1, # > 1: shifts estimated on frames downsampled by this factor
+                      persist = 'frames', # 'shifts': no pw-rigid memmap is written, None is returned instead of its name
+                      shift_store = None, # ShiftStore the shifts of the session are written to
+                      diagnostics = 'full', # 'full': template and shift figures, 'summary': only added to summary, 'off': none
+                      summary = None): # MCDiagnostics the session is added to
+    # Two phase motion correction of a whole session instead of chunk after chunk:
+    # 1) one global template from a strided subsample of the session
+    # 2) all the frames corrected against this fixed template at once, in splits sized
+    #    to the number of workers, so no chunk waits for the template of the previous one.
+    # With a fixed template a separate rigid pass would only repeat the rigid shifts that seed the
+    # pw-rigid patches, so the frames go through one pw-rigid pass (single_pass of MotionCorrect).
+    # Returns the pw-rigid memmap (read it back with cm.load_memmap) instead of the movie.
+    # With persist='shifts' only the shifts are kept, in shift_store.
+    T = len(video)
+    path = getattr(video, 'path', None)
+    if path is not None:
+        # the raw memmap of the session is read by the workers directly, no copy
+        video_handle = SharedArrayHandle(path, video.shape, video.dtype, backend='memmap', out_dir=outpath)
+        owns_handle = False
+    else:
+        video_handle = SharedArrayHandle.from_array(video, backend=shared_backend, tmp_dir=outpath)
+        owns_handle = True
+
+    # %% phase one: global template
+    if template is None:
+        with timing.stage('template'):
+            template = session_template(video_handle, max_shifts, dview, n_workers, template_frames=template_frames,
+                                        shifts_opencv=shifts_opencv, border_nan=border_nan,
+                                        shared_backend=shared_backend, outpath=outpath)
+
+    # %% phase two: every split against the fixed template
+    splits = n_workers * max(1, int(np.ceil(T / (n_workers * num_frames_split))))
+    logging.info(f'Session motion correction of {T} frames in {splits} splits')
+    mc = MotionCorrect(video_handle, dview=dview, max_shifts=max_shifts,
+                    strides=strides, overlaps=overlaps,
+                    max_deviation_rigid=max_deviation_rigid,
+                    shifts_opencv=shifts_opencv, nonneg_movie=True,
+                    border_nan=border_nan, splits_rig=splits, splits_els=splits,
+                    downsample_factor=downsample_factor)
+    timing.begin('correct')
+    mc.motion_correct(save_movie=persist == 'frames', template=template, single_pass=True)
+    timing.count(frames=T)
+    timing.end('correct')
+    if owns_handle:
+        video_handle.release()
+    if shift_store is not None:
+        shift_store.write(0, mc)
+    if summary is not None:
+        with timing.stage('summary'):
+            summary.add(video, mc)
+
+    bord_px_rig = np.ceil(np.max(mc.shifts_rig)).astype(int)
     bord_px_els = np.ceil(np.maximum(np.max(np.abs(mc.x_shifts_els)),
                                     np.max(np.abs(mc.y_shifts_els)))).astype(int)
 
-    # TODO save
-    #%% stop the cluster
-    if input_deview_flag == False:
-        cm.stop_server(dview=dview) # stop the server
-    
-    
+    #%% figures of the session
+    if diagnostics == 'full':
+        timing.begin('figures')
+        plot_session_figures(outpath, template, mc.shifts_rig, mc.x_shifts_els, mc.y_shifts_els)
+        timing.end('figures')
+
+    return mc.fname_tot_els[0] if persist == 'frames' else None, bord_px_rig, bord_px_els, template
+
+def plot_session_figures(outpath, template, shifts_rig, x_shifts_els, y_shifts_els):
+    # template and shifts of a whole session, one png each
+    plt.figure(figsize = (20,10))
+    plt.imshow(template, cmap = 'gray')
+    plt.savefig(outpath + '/template.png')
     plt.close()
-    #%% return the nonrigid movie
-    return m_nonrig, bord_px_rig, bord_px_els, out_template
+    plt.figure(figsize = (20,10))
+    plt.plot(shifts_rig)
+    plt.legend(['x shifts','y shifts'])
+    plt.xlabel('frames')
+    plt.ylabel('pixels')
+    plt.savefig(outpath +'/rigid_shift.png')
+    plt.close()
+    plt.figure(figsize = (20,10))
+    plt.subplot(2, 1, 1)
+    plt.plot(x_shifts_els)
+    plt.ylabel('x shifts (pixels)')
+    plt.subplot(2, 1, 2)
+    plt.plot(y_shifts_els)
+    plt.ylabel('y_shifts (pixels)')
+    plt.xlabel('frames')
+    plt.savefig(outpath +'/non_rigid_shift.png')
+    plt.close()
+
+class MCDiagnostics(object):
+    """
+    Quality control of the motion correction of a whole session, rendered once at the end
+    instead of for every chunk (diagnostics='summary' of normcorre_function and normcorre_session).
+
+    Every chunk adds its shifts, and the local correlation images (local_correlations_fft) of
+    one frame out of stride, before and after correction. The correlation images are averaged
+    over blocks of frames, so only two images are kept whatever the length of the session.
+
+    Args:
+        outpath: str
+            directory of the figures
+
+        stride: int
+            one frame out of stride is used for the correlation images
+
+        block: int
+            number of consecutive frames whose subset gives one correlation image
+
+    Example:
+        summary = MCDiagnostics(mc_out)
+        for start in range(0, T, chunk_size):
+            normcorre_function(video[start:start + chunk_size], ..., diagnostics='summary', summary=summary)
+        summary.render()
+    """
+    def __init__(self, outpath, stride=10, block=1000):
+        self.outpath = outpath
+        self.stride = max(1, int(stride))
+        self.block = max(self.stride, int(block))
+        self.template = None
+        self.shifts_rig = []
+        self.x_shifts_els = []
+        self.y_shifts_els = []
+        self.corr_raw = None
+        self.corr_mc = None
+        self.num_frames = 0
+
+    def add(self, video, mc, corrected=None):
+        """
+        Adds the next frames of the session
+
+        Args:
+            video: array-like
+                (T, d1, d2) raw frames
+
+            mc: MotionCorrect
+                after its pw-rigid correction of video
+
+            corrected: ndarray
+                (T, d1, d2) corrected frames if available, otherwise the shifts of mc are
+                applied to the subset of video
+        """
+        offset = len(self.shifts_rig)
+        self.template = mc.total_template_rig
+        self.shifts_rig += list(mc.shifts_rig)
+        self.x_shifts_els += list(mc.x_shifts_els)
+        self.y_shifts_els += list(mc.y_shifts_els)
+        T = len(video)
+        for start in range(0, T, self.block):
+            # same frames of the session whatever the chunks
+            idx = np.arange(start + (-(offset + start) % self.stride), min(start + self.block, T), self.stride)
+            if len(idx) < 3:
+                continue
+            raw = np.asarray(video[idx], dtype=np.float32)
+            if corrected is not None:
+                mc_frames = np.asarray(corrected[idx], dtype=np.float32)
+            else:
+                mc_frames = np.asarray(mc.apply_shifts_movie(raw, remove_min=False, frame_idx=idx), dtype=np.float32)
+            corr_raw = local_correlations_fft(raw, swap_dim=False)
+            corr_mc = local_correlations_fft(mc_frames, swap_dim=False)
+            # running mean over the subsets, weighted by their number of frames
+            n = len(idx)
+            if self.corr_raw is None:
+                self.corr_raw, self.corr_mc = corr_raw * n, corr_mc * n
+            else:
+                self.corr_raw += corr_raw * n
+                self.corr_mc += corr_mc * n
+            self.num_frames += n
+
+    def render(self):
+        """Writes the template, shift and local correlation figures of the session to outpath"""
+        os.makedirs(self.outpath, exist_ok=True)
+        plot_session_figures(self.outpath, self.template, self.shifts_rig, self.x_shifts_els, self.y_shifts_els)
+        if self.num_frames > 0:
+            plt.figure(figsize = (20,10))
+            for i, (title, corr) in enumerate([('original', self.corr_raw), ('motion corrected', self.corr_mc)]):
+                plt.subplot(1, 2, i + 1)
+                plt.imshow(corr / self.num_frames)
+                plt.title(title)
+            plt.savefig(self.outpath + '/local_correlation.png')
+            plt.close()
+        logging.info(f'MC summary of {len(self.shifts_rig)} frames written to {self.outpath}')
 
 if __name__ == '__main__':
     # %%
@@ -55,7 +55,9 @@ from numpy.fft import ifftshift
 import os
 import sys
 import pylab as pl
+import scipy.fft
 import tifffile
+from numba import jit, prange
 from typing import List, Optional, Tuple
 from skimage.transform import resize as resize_sk
 from skimage.transform import warp as warp_sk
@@ -66,6 +68,7 @@ import caiman.motion_correction
 
 import caiman.paths
 from .mmapping import prepare_shape
+from .shared_array import SharedArrayHandle
 
 try:
     cv2.setNumThreads(0)
@@ -100,13 +103,14 @@ class MotionCorrect(object):
                  strides=(96, 96), overlaps=(32, 32), splits_els=14, num_splits_to_process_els=None,
                  upsample_factor_grid=4, max_deviation_rigid=3, shifts_opencv=True, nonneg_movie=True, gSig_filt=(6,6),
                  use_cuda=False, border_nan=True, pw_rigid=False, num_frames_split=80, var_name_hdf5='mov',is3D=False,
-                 indices=(slice(None), slice(None))):
+                 indices=(slice(None), slice(None)), tmp_dir=None, downsample_factor=1):
         """
         Constructor class for motion correction operations
 
         Args:
-           fname: str
-               path to file to motion correct
+           fname: str, ndarray or SharedArrayHandle
+               path to file to motion correct, or the movie itself. A SharedArrayHandle is read
+               by the workers directly. An ndarray is copied once to a memmap file in tmp_dir
 
            min_mov: int16 or float32
                estimated minimum value of the movie to produce an output that is positive
@@ -175,14 +179,23 @@ class MotionCorrect(object):
             indices: tuple(slice), default: (slice(None), slice(None))
                Use that to apply motion correction only on a part of the FOV
 
+           downsample_factor: int, default: 1
+               estimate the shifts on frames downsampled by this factor (coarse-to-fine) and
+               apply them at full resolution. Requires shifts_opencv and 2D movies
+
+           tmp_dir: str, default: None
+               directory of the shared copy of an ndarray input, defaults to the system temporary directory
+
        Returns:
            self
 
         """
+        self.input_handle = None
         if 'ndarray' in str(type(fname)):
-            logging.info('Creating file for motion correction "tmp_mov_mot_corr.hdf5"')
-            cm.movie(fname).save('tmp_mov_mot_corr.hdf5')
-            fname = ['tmp_mov_mot_corr.hdf5']
+            # shared with the workers by name, instead of a tmp_mov_mot_corr.hdf5 in the cwd
+            self.input_handle = SharedArrayHandle.from_array(fname, backend='memmap', tmp_dir=tmp_dir)
+            logging.info('Sharing movie for motion correction in "{}"'.format(self.input_handle.name))
+            fname = [self.input_handle]
 
         if not isinstance(fname, list):
             fname = [fname]
@@ -212,10 +225,19 @@ class MotionCorrect(object):
         self.var_name_hdf5 = var_name_hdf5
         self.is3D = bool(is3D)
         self.indices = indices
+        self.downsample_factor = int(downsample_factor)
+        if self.downsample_factor > 1 and (self.is3D or not self.shifts_opencv):
+            raise Exception('downsample_factor > 1 requires shifts_opencv and 2D movies')
         if self.use_cuda and not HAS_CUDA:
             logging.debug("pycuda is unavailable. Falling back to default FFT.")
 
-    def motion_correct(self, template=None, save_movie=False):
+    def release(self):
+        """Removes the shared copy made of an ndarray input. The motion corrected files are kept"""
+        if self.input_handle is not None:
+            self.input_handle.release()
+            self.input_handle = None
+
+    def motion_correct(self, template=None, save_movie=False, single_pass=False):
         """general function for performing all types of motion correction. The
         function will perform either rigid or piecewise rigid motion correction
         depending on the attribute self.pw_rigid and will perform high pass
@@ -230,12 +252,26 @@ class MotionCorrect(object):
             save_movie: bool, default: False
                 flag for saving motion corrected file(s) as memory mapped file(s)
 
+            single_pass: bool, default: False
+                pw-rigid correction without a full rigid pass before it. The template
+                comes from a subsample of the movie (or the one provided), the rigid
+                shift of every frame is estimated in the same call that seeds its
+                patches, and only the pw-rigid movie is written. shifts_rig is filled,
+                fname_tot_rig is not.
+
         Returns:
             self
         """
         # TODO: Review the docs here, and also why we would ever return self
         #       from a method that is not a constructor
-        if self.min_mov is None:
+        if self.min_mov is None and isinstance(self.fname[0], SharedArrayHandle):
+            first_frames = self.fname[0].read(slice(400), dtype=np.float32)
+            if self.gSig_filt is None:
+                self.min_mov = first_frames.min()
+            else:
+                self.min_mov = np.array([high_pass_filter_space(m_, self.gSig_filt)
+                    for m_ in first_frames]).min()
+        elif self.min_mov is None:
             if self.gSig_filt is None:
                 # self.min_mov = np.array([cm.load(self.fname[0],
                 #                                  var_name_hdf5=self.var_name_hdf5,
@@ -254,8 +290,22 @@ class MotionCorrect(object):
                     for m_ in cm.load(self.fname[0], var_name_hdf5=self.var_name_hdf5,
                                       subindices=slice(400))]).min()
 
-        if self.pw_rigid:
+        if single_pass:
+            if self.is3D:
+                raise Exception('single_pass is not implemented for 3D movies')
+            self.pw_rigid = True
+            if template is None:
+                template = build_template(self.fname[0], self.max_shifts, gSig_filt=self.gSig_filt,
+                                          var_name_hdf5=self.var_name_hdf5, indices=self.indices)
+            self.total_template_rig = template
+            self.templates_rig = []
+            self.fname_tot_rig = []
             self.motion_correct_pwrigid(template=template, save_movie=save_movie)
+            self.shifts_rig = self.shifts_rig_els
+
+        if self.pw_rigid:
+            if not single_pass:
+                self.motion_correct_pwrigid(template=template, save_movie=save_movie)
             if self.is3D:
                 # TODO - error at this point after saving
                 b0 = np.ceil(np.max([np.max(np.abs(self.x_shifts_els)),
@@ -316,7 +366,8 @@ class MotionCorrect(object):
                 border_nan=self.border_nan,
                 var_name_hdf5=self.var_name_hdf5,
                 is3D=self.is3D,
-                indices=self.indices)
+                indices=self.indices,
+                downsample_factor=self.downsample_factor)
             if template is None:
                 self.total_template_rig = _total_template_rig
 
@@ -345,6 +396,7 @@ class MotionCorrect(object):
             self.z_shifts_els: shifts in z per frame per patch (if 3D)
             self.coord_shifts_els: coordinates associated to the patch for
             values in x_shifts_els and y_shifts_els (and z_shifts_els if 3D)
+            self.shifts_rig_els: rigid shifts per frame that seeded the patches (2D only)
             self.total_template_els: list of templates. one for each chunk
 
         Raises:
@@ -367,16 +419,17 @@ class MotionCorrect(object):
             self.z_shifts_els:List = []
 
         self.coord_shifts_els:List = []
+        self.shifts_rig_els:List = []
         for name_cur in self.fname:
             _fname_tot_els, new_template_els, _templates_els,\
-                _x_shifts_els, _y_shifts_els, _z_shifts_els, _coord_shifts_els = motion_correct_batch_pwrigid(
+                _x_shifts_els, _y_shifts_els, _z_shifts_els, _coord_shifts_els, _shifts_rig_els = motion_correct_batch_pwrigid(
                     name_cur, self.max_shifts, self.strides, self.overlaps, -self.min_mov,
                     dview=self.dview, upsample_factor_grid=self.upsample_factor_grid,
                     max_deviation_rigid=self.max_deviation_rigid, splits=self.splits_els,
                     num_splits_to_process=None, num_iter=num_iter, template=self.total_template_els,
                     shifts_opencv=self.shifts_opencv, save_movie=save_movie, nonneg_movie=self.nonneg_movie, gSig_filt=self.gSig_filt,
                     use_cuda=self.use_cuda, border_nan=self.border_nan, var_name_hdf5=self.var_name_hdf5, is3D=self.is3D,
-                    indices=self.indices)
+                    indices=self.indices, downsample_factor=self.downsample_factor)
             if not self.is3D:
                 if show_template:
                     pl.imshow(new_template_els)
@@ -395,9 +448,10 @@ class MotionCorrect(object):
             if self.is3D:
                 self.z_shifts_els += _z_shifts_els
             self.coord_shifts_els += _coord_shifts_els
+            self.shifts_rig_els += _shifts_rig_els
 
     def apply_shifts_movie(self, fname, rigid_shifts:bool=None, save_memmap:bool=False,
-                           save_base_name:str='MC', order:str='F', remove_min:bool=True):
+                           save_base_name:str='MC', order:str='F', remove_min:bool=True, frame_idx=None):
         """
         Applies shifts found by registering one file to a different file. Useful
         for cases when shifts computed from a structural channel are applied to a
@@ -405,9 +459,10 @@ class MotionCorrect(object):
         supported. Returns either cm.movie or the path to a memory mapped file.
 
         Args:
-            fname: str of List[str]
+            fname: str of List[str] or ndarray
                 name(s) of the movie to motion correct. It should not contain
-                nans. All the loadable formats from CaImAn are acceptable
+                nans. All the loadable formats from CaImAn are acceptable, or
+                the (T, d1, d2) frames themselves
 
             rigid_shifts: bool (True)
                 apply rigid or pw-rigid shifts (must exist in the mc object)
@@ -425,12 +480,19 @@ class MotionCorrect(object):
             remove_min: bool (True)
                 If minimum value is negative, subtract it from the data
 
+            frame_idx: array of int (None)
+                indices of the frames of fname among the registered frames, to
+                apply the shifts of a part of the movie only, e.g. one chunk
+
         Returns:
             m_reg: caiman movie object
                 caiman movie object with applied shifts (not memory mapped)
         """
 
-        Y = cm.load(fname).astype(np.float32)
+        if isinstance(fname, np.ndarray):
+            Y = np.array(fname, dtype=np.float32)
+        else:
+            Y = cm.load(fname).astype(np.float32)
         if remove_min: 
             ymin = Y.min()
             if ymin < 0:
@@ -442,29 +504,32 @@ class MotionCorrect(object):
                             ' mc.pw_rigid and is current set to the opposite' +
                             ' of {}'.format(self.pw_rigid))            
         
+        def select(shifts):
+            return shifts if frame_idx is None else [shifts[idx] for idx in frame_idx]
+
         if self.pw_rigid is False:
+            shifts_rig = select(self.shifts_rig)
             if self.is3D:
                 m_reg = [apply_shifts_dft(img, (sh[0], sh[1], sh[2]), 0,
                                           is_freq=False, border_nan=self.border_nan)
-                         for img, sh in zip(Y, self.shifts_rig)]
+                         for img, sh in zip(Y, shifts_rig)]
             elif self.shifts_opencv:
-                m_reg = [apply_shift_iteration(img, shift, border_nan=self.border_nan)
-                         for img, shift in zip(Y, self.shifts_rig)]
+                m_reg = apply_shifts_batch(Y, shifts_rig=shifts_rig, border_nan=self.border_nan, dtype=np.float32)
             else:
                 m_reg = [apply_shifts_dft(img, (
                     sh[0], sh[1]), 0, is_freq=False, border_nan=self.border_nan) for img, sh in zip(
-                    Y, self.shifts_rig)]
+                    Y, shifts_rig)]
         else:
             if self.is3D:
                 xyz_grid = [(it[0], it[1], it[2]) for it in sliding_window_3d(
                             Y[0], self.overlaps, self.strides)]
                 dims_grid = tuple(np.add(xyz_grid[-1], 1))
                 shifts_x = np.stack([np.reshape(_sh_, dims_grid, order='C').astype(
-                    np.float32) for _sh_ in self.x_shifts_els], axis=0)
+                    np.float32) for _sh_ in select(self.x_shifts_els)], axis=0)
                 shifts_y = np.stack([np.reshape(_sh_, dims_grid, order='C').astype(
-                    np.float32) for _sh_ in self.y_shifts_els], axis=0)
+                    np.float32) for _sh_ in select(self.y_shifts_els)], axis=0)
                 shifts_z = np.stack([np.reshape(_sh_, dims_grid, order='C').astype(
-                    np.float32) for _sh_ in self.z_shifts_els], axis=0)
+                    np.float32) for _sh_ in select(self.z_shifts_els)], axis=0)
                 dims = Y.shape[1:]
                 x_grid, y_grid, z_grid = np.meshgrid(np.arange(0., dims[1]).astype(
                     np.float32), np.arange(0., dims[0]).astype(np.float32),
@@ -476,21 +541,21 @@ class MotionCorrect(object):
                          for img, shiftX, shiftY, shiftZ in zip(Y, shifts_x, shifts_y, shifts_z)]
                                  # borderValue=add_to_movie)
             else:
-                xy_grid = [(it[0], it[1]) for it in sliding_window(Y[0], self.overlaps, self.strides)]
+                img_grid, overlaps, strides = Y[0], self.overlaps, self.strides
+                f = getattr(self, 'downsample_factor', 1)
+                if f > 1:
+                    # the patches were registered on the frames downsampled by f, see RegistrationPlan
+                    img_grid = Y[0][:Y.shape[1] // f, :Y.shape[2] // f]
+                    overlaps = tuple(max(1, s // f) for s in overlaps)
+                    strides = tuple(max(1, s // f) for s in strides)
+                xy_grid = [(it[0], it[1]) for it in sliding_window(img_grid, overlaps, strides)]
                 dims_grid = tuple(np.max(np.stack(xy_grid, axis=1), axis=1) - np.min(
                     np.stack(xy_grid, axis=1), axis=1) + 1)
-                shifts_x = np.stack([np.reshape(_sh_, dims_grid, order='C').astype(
-                    np.float32) for _sh_ in self.x_shifts_els], axis=0)
-                shifts_y = np.stack([np.reshape(_sh_, dims_grid, order='C').astype(
-                    np.float32) for _sh_ in self.y_shifts_els], axis=0)
-                dims = Y.shape[1:]
-                x_grid, y_grid = np.meshgrid(np.arange(0., dims[1]).astype(
-                    np.float32), np.arange(0., dims[0]).astype(np.float32))
-                m_reg = [cv2.remap(img, -cv2.resize(shiftY, dims[::-1]) + x_grid,
-                                   -cv2.resize(shiftX, dims[::-1]) + y_grid,
-                                   cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE)
-                         for img, shiftX, shiftY in zip(Y, shifts_x, shifts_y)]
-        m_reg = np.stack(m_reg, axis=0)
+                m_reg = apply_shifts_batch(Y, x_shifts_els=select(self.x_shifts_els),
+                                           y_shifts_els=select(self.y_shifts_els), dims_grid=dims_grid,
+                                           dtype=np.float32)
+        if not isinstance(m_reg, np.ndarray):
+            m_reg = np.stack(m_reg, axis=0)
         if save_memmap:
             dims = m_reg.shape
             fname_tot = caiman.paths.memmap_frames_filename(save_base_name, dims[1:], dims[0], order)
@@ -546,6 +611,235 @@ def apply_shift_iteration(img, shift, border_nan:bool=False, border_type=cv2.BOR
     return img
 
 
+#%%
+# bicubic interpolation as cv2.remap/cv2.warpAffine: coordinates rounded to 1/32 pixel and
+# the weights of the 4x4 neighbourhood tabulated for each of the 32 x 32 fractional positions
+INTER_BITS = 5
+INTER_TAB_SIZE = 1 << INTER_BITS
+
+
+def _cubic_tab():
+    x = np.arange(INTER_TAB_SIZE, dtype=np.float32) * np.float32(1. / INTER_TAB_SIZE)
+    A, one = np.float32(-0.75), np.float32(1)
+    c0 = ((A * (x + one) - 5 * A) * (x + one) + 8 * A) * (x + one) - 4 * A
+    c1 = ((A + 2) * x - (A + 3)) * x * x + one
+    c2 = ((A + 2) * (one - x) - (A + 3)) * (one - x) * (one - x) + one
+    c3 = one - c0 - c1 - c2
+    coeffs = np.stack([c0, c1, c2, c3], axis=1).astype(np.float32)
+    # tab[fy * 32 + fx, 4 * i + j] = coeffs[fy, i] * coeffs[fx, j]
+    return np.einsum('ai,bj->abij', coeffs, coeffs).reshape(INTER_TAB_SIZE ** 2, 16).astype(np.float32)
+
+
+_CUBIC_TAB = _cubic_tab()
+
+
+def _resize_linear_coeffs(ssize, dsize):
+    """Source indices and weights of cv2.resize(INTER_LINEAR) along one dimension"""
+    scale = 1. / (float(dsize) / ssize)
+    fx = ((np.arange(dsize) + 0.5) * scale - 0.5).astype(np.float32)
+    sx = np.floor(fx).astype(np.int64)
+    fx = fx - sx.astype(np.float32)
+    edge = (sx < 0) | (sx >= ssize - 1)
+    fx[edge] = 0
+    sx = np.clip(sx, 0, ssize - 1)
+    alpha = np.stack([np.float32(1) - fx, fx], axis=1).astype(np.float32)
+    return np.stack([sx, np.minimum(sx + 1, ssize - 1)], axis=1), alpha
+
+
+def _warp_frames(movie, flow_x, flow_y, rows, row_w, cols, col_w, bounds, border, affine, reflect, clip,
+                 add_to_movie, out_offset, tab, out):
+    """
+    Bicubic warp of a stack of frames, output pixel p read at p + flow. The flow of each frame
+    is a (gh, gw) grid upsampled bilinearly. Pixels outside bounds are filled according to
+    border (0: nothing, 1: copy of the nearest pixel inside, 2: nan, 3: minimum of the frame)
+    """
+    T, d1, d2 = movie.shape
+    gh = flow_x.shape[1]
+    # in the precision of the interpolation, the type of add_to_movie
+    lo = np.full(T, add_to_movie)
+    hi = np.full(T, add_to_movie)
+    # flow grids upsampled along the columns, the rows are interpolated pixel by pixel
+    hx = np.empty((T, gh, d2), dtype=np.float32)
+    hy = np.empty((T, gh, d2), dtype=np.float32)
+    for t in prange(T):
+        if clip or border == 3:
+            # nanmin and nanmax, as selects that vectorize
+            vmin, vmax = np.inf, -np.inf
+            for i in range(d1):
+                for j in range(d2):
+                    v = movie[t, i, j] + add_to_movie
+                    vmin = v if v < vmin else vmin
+                    vmax = v if v > vmax else vmax
+            lo[t], hi[t] = vmin, vmax
+        if not affine:
+            for r in range(gh):
+                for j in range(d2):
+                    hx[t, r, j] = flow_x[t, r, cols[j, 0]] * col_w[j, 0] + flow_x[t, r, cols[j, 1]] * col_w[j, 1]
+                    hy[t, r, j] = flow_y[t, r, cols[j, 0]] * col_w[j, 0] + flow_y[t, r, cols[j, 1]] * col_w[j, 1]
+
+    for k in prange(T * d1):
+        t = k // d1
+        i0 = k - t * d1
+        m = movie[t]
+        o = out[t]
+        jlo, jhi, vlo, vhi = bounds[t, 2], bounds[t, 3], lo[t], hi[t]
+        i = i0
+        if i0 < bounds[t, 0] or i0 > bounds[t, 1]:
+            if border == 1:
+                i = min(max(i0, bounds[t, 0]), bounds[t, 1])
+            elif border >= 2:
+                for j0 in range(d2):
+                    o[i0, j0] = np.nan if border == 2 else vlo - out_offset
+                continue
+        if affine:
+            # fixed point coordinates of cv2.warpAffine for a translation
+            Y = (np.int64(np.rint((np.float64(i) + np.float64(flow_x[t, 0, 0])) * 1024)) + 16) >> (10 - INTER_BITS)
+            X0 = np.int64(np.rint(np.float64(flow_y[t, 0, 0]) * 1024)) + 16
+        else:
+            # pw-rigid flows are never clamped, i == i0. Coordinates of the row first, in a
+            # loop that vectorizes, as the maps of cv2.remap rounded to 1/32 pixel
+            hx0, hx1 = hx[t, rows[i, 0]], hx[t, rows[i, 1]]
+            hy0, hy1 = hy[t, rows[i, 0]], hy[t, rows[i, 1]]
+            b0, b1 = row_w[i, 0], row_w[i, 1]
+            Xs = np.empty(d2, dtype=np.int64)
+            Ys = np.empty(d2, dtype=np.int64)
+            for j in range(d2):
+                Xs[j] = np.int64(np.rint((np.float32(j) + (hy0[j] * b0 + hy1[j] * b1)) * np.float32(INTER_TAB_SIZE)))
+                Ys[j] = np.int64(np.rint((np.float32(i) + (hx0[j] * b0 + hx1[j] * b1)) * np.float32(INTER_TAB_SIZE)))
+        for j0 in range(d2):
+            j = j0
+            if j0 < jlo or j0 > jhi:
+                if border == 1:
+                    j = min(max(j0, jlo), jhi)
+                elif border == 2:
+                    o[i0, j0] = np.nan
+                    continue
+                elif border == 3:
+                    o[i0, j0] = vlo - out_offset
+                    continue
+            if affine:
+                X = (j * 1024 + X0) >> (10 - INTER_BITS)
+            else:
+                X = Xs[j]
+                Y = Ys[j]
+            w = (Y & (INTER_TAB_SIZE - 1)) * INTER_TAB_SIZE + (X & (INTER_TAB_SIZE - 1))
+            sx = (X >> INTER_BITS) - 1
+            sy = (Y >> INTER_BITS) - 1
+            if 0 <= sx < d2 - 3 and 0 <= sy < d1 - 3:
+                # same summation order as cv2, row by row
+                val = (m[sy, sx] + add_to_movie) * tab[w, 0] + (m[sy, sx + 1] + add_to_movie) * tab[w, 1] + \
+                      (m[sy, sx + 2] + add_to_movie) * tab[w, 2] + (m[sy, sx + 3] + add_to_movie) * tab[w, 3]
+                for a in range(1, 4):
+                    y = sy + a
+                    val += (m[y, sx] + add_to_movie) * tab[w, 4 * a] + (m[y, sx + 1] + add_to_movie) * tab[w, 4 * a + 1] + \
+                           (m[y, sx + 2] + add_to_movie) * tab[w, 4 * a + 2] + (m[y, sx + 3] + add_to_movie) * tab[w, 4 * a + 3]
+            else:
+                # border pixels, replicated or reflected
+                val = (add_to_movie - add_to_movie) * tab[w, 0]
+                for a in range(4):
+                    y = sy + a
+                    if reflect:
+                        y = -y - 1 if y < 0 else (2 * d1 - y - 1 if y >= d1 else y)
+                    y = min(max(y, 0), d1 - 1)
+                    for b in range(4):
+                        x = sx + b
+                        if reflect:
+                            x = -x - 1 if x < 0 else (2 * d2 - x - 1 if x >= d2 else x)
+                        x = min(max(x, 0), d2 - 1)
+                        val += (m[y, x] + add_to_movie) * tab[w, 4 * a + b]
+            if clip:
+                if val < vlo:
+                    val = vlo
+                elif val > vhi:
+                    val = vhi
+            o[i0, j0] = val - out_offset
+
+
+_warp_frames_parallel = jit(nopython=True, parallel=True, cache=True)(_warp_frames)
+_warp_frames_serial = jit(nopython=True, cache=True)(_warp_frames)
+
+
+def apply_shifts_batch(movie, shifts_rig=None, x_shifts_els=None, y_shifts_els=None, dims_grid=None,
+                       border_nan=True, add_to_movie=0, out_offset=0, dtype=np.float64, out=None, n_threads=None):
+    """
+    Applies rigid or piecewise rigid shifts to a stack of frames in one parallel pass.
+
+    Same bicubic interpolation as apply_shift_iteration (rigid) and as the opencv remap of
+    tile_and_correct (pw-rigid), but the upsampling of the patch shifts, the warp, the
+    clipping and the border handling are done together for every pixel, and the frames go
+    straight into out without per-frame coordinate grids or masks.
+
+    Args:
+        movie: ndarray (T, d1, d2)
+            frames to correct
+
+        shifts_rig: ndarray (T, 2)
+            rigid shifts, as given to apply_shift_iteration (e.g. MotionCorrect.shifts_rig)
+
+        x_shifts_els, y_shifts_els: ndarray (T, num_patches)
+            pw-rigid shifts of the patches, as in MotionCorrect.x_shifts_els. Used instead of
+            shifts_rig when given. The frame borders are then replicated as in tile_and_correct
+
+        dims_grid: tuple
+            number of patches along each dimension
+
+        border_nan: bool or string
+            border handling of the rigid shifts (True, False, 'copy', 'min'), as in apply_shift_iteration
+
+        add_to_movie: float
+            offset added to the frames before they are warped
+
+        out_offset: float
+            offset subtracted from the warped frames
+
+        dtype: numpy dtype
+            precision of the interpolation, np.float64 as tile_and_correct, np.float32 as
+            the frames of apply_shifts_movie
+
+        out: ndarray (T, d1, d2)
+            output buffer, e.g. a memmap, float32 if None
+
+        n_threads: int
+            1 for a serial pass, e.g. in the motion correction workers. None uses the numba threads
+
+    Returns:
+        out: ndarray (T, d1, d2)
+            corrected frames
+    """
+    movie = np.asarray(movie)
+    if movie.dtype not in (np.float32, np.float64):
+        movie = movie.astype(np.float32)
+    T, d1, d2 = movie.shape
+    if out is None:
+        out = np.empty((T, d1, d2), dtype=np.float32)
+    full = np.tile(np.array([0, d1 - 1, 0, d2 - 1], dtype=np.int64), (T, 1))
+    if x_shifts_els is None:
+        shifts = np.asarray(shifts_rig, dtype=np.float32).reshape(T, 2)
+        # output pixel p is read at p - shift
+        flow_x = -shifts[:, 0].reshape(T, 1, 1)
+        flow_y = -shifts[:, 1].reshape(T, 1, 1)
+        bounds = full
+        if border_nan is not False:
+            # the border rows and columns left empty by the shift
+            max_h = np.ceil(np.maximum(0, shifts)).astype(np.int64)
+            min_h = np.floor(np.minimum(0, shifts)).astype(np.int64)
+            bounds = np.stack([max_h[:, 0], d1 - 1 + min_h[:, 0], max_h[:, 1], d2 - 1 + min_h[:, 1]], axis=1)
+        border = {False: 0, 'copy': 1, True: 2, 'min': 3}[border_nan]
+        affine, reflect, clip = True, True, True
+    else:
+        flow_x = -np.asarray(x_shifts_els, dtype=np.float32).reshape((T,) + tuple(dims_grid))
+        flow_y = -np.asarray(y_shifts_els, dtype=np.float32).reshape((T,) + tuple(dims_grid))
+        bounds, border = full, 0
+        affine, reflect, clip = False, False, False
+    rows, row_w = _resize_linear_coeffs(flow_x.shape[1], d1)
+    cols, col_w = _resize_linear_coeffs(flow_x.shape[2], d2)
+    warp = _warp_frames_serial if n_threads == 1 else _warp_frames_parallel
+    warp(movie, np.ascontiguousarray(flow_x), np.ascontiguousarray(flow_y), rows, row_w, cols, col_w,
+         np.ascontiguousarray(bounds), border, affine, reflect, clip, np.dtype(dtype).type(add_to_movie),
+         np.dtype(dtype).type(out_offset), _CUBIC_TAB, out)
+    return out
+
+
 #%%
 def apply_shift_online(movie_iterable, xy_shifts, save_base_name=None, order='F'):
     """
@@ -1787,6 +2081,120 @@ def register_translation(src_image, target_image, upsample_factor=1,
 
     return shifts, src_freq, _compute_phasediff(CCmax)
 
+def template_spectrum(template):
+    """
+    Spectrum of a template (or of a stack of templates) for register_translation_batch.
+    Compute it once and reuse it for every frame registered against the template.
+
+    Args:
+        template: ndarray (H, W) or (B, H, W)
+
+    Returns:
+        target_freq: ndarray (H, W // 2 + 1) or (B, H, W // 2 + 1), rfft2 of the template
+    """
+    return scipy.fft.rfft2(np.asarray(template, dtype=np.float64))
+
+def register_translation_batch(src_images, target_freq, upsample_factor=1, max_shifts=(10, 10),
+                               shifts_lb=None, shifts_ub=None):
+    """
+    Batched version of register_translation for a (B, H, W) stack of real images.
+
+    The stack is transformed with one rfft2 call, correlated with the cached spectrum of
+    the template(s), the whole-pixel peaks within the allowed shifts are found with one
+    argmax, and the subpixel refinement (matrix multiply DFT around each peak, as in
+    _upsampled_dft) is done for all the images at once. Shifts are the same as the ones
+    of register_translation(src_images[b], template) in real space.
+
+    Args:
+        src_images: ndarray (B, H, W)
+            images to register
+
+        target_freq: ndarray (H, W // 2 + 1) or (B, H, W // 2 + 1)
+            template spectrum from template_spectrum, one for all images or one per image
+
+        upsample_factor: int
+            images are registered within 1 / upsample_factor of a pixel
+
+        max_shifts: tuple
+            max shifts in x and y, used when shifts_lb and shifts_ub are None
+
+        shifts_lb, shifts_ub: ndarray (2,) or (B, 2), optional
+            lower and upper bounds of the shifts (upper bound excluded), as in register_translation
+
+    Returns:
+        shifts: ndarray (B, 2)
+            shifts (in pixels) required to register the template with each image
+
+        src_freq: ndarray (B, H, W // 2 + 1)
+            rfft2 of the images
+
+        phasediff: ndarray (B,)
+            global phase difference between each image and the template
+    """
+    src_images = np.asarray(src_images, dtype=np.float64)
+    B, H, W = src_images.shape
+    src_freq = scipy.fft.rfft2(src_images)
+    image_product = src_freq * np.conj(target_freq)
+    cross_correlation = scipy.fft.irfft2(image_product, s=(H, W))
+
+    # search only the lags in [lb, ub) along each axis (negative lags wrap around)
+    if shifts_lb is None or shifts_ub is None:
+        shifts_lb = -np.array(max_shifts[:2])
+        shifts_ub = np.array(max_shifts[:2])
+    shifts_lb = np.broadcast_to(np.asarray(shifts_lb, dtype=np.int64), (B, 2))
+    shifts_ub = np.broadcast_to(np.asarray(shifts_ub, dtype=np.int64), (B, 2))
+    shape = np.array([H, W])
+    width = np.minimum(shifts_ub - shifts_lb, shape)
+    rows = (shifts_lb[:, :1] + np.arange(width[:, 0].max())) % H
+    cols = (shifts_lb[:, 1:] + np.arange(width[:, 1].max())) % W
+    window = np.abs(cross_correlation[np.arange(B)[:, None, None], rows[:, :, None], cols[:, None, :]])
+    # windows narrower than the widest one are padded
+    window[np.arange(rows.shape[1])[None, :] >= width[:, :1]] = -1
+    window.transpose(0, 2, 1)[np.arange(cols.shape[1])[None, :] >= width[:, 1:]] = -1
+    peak_row, peak_col = np.unravel_index(np.argmax(window.reshape(B, -1), axis=1), window.shape[1:])
+    shifts = np.stack([rows[np.arange(B), peak_row], cols[np.arange(B), peak_col]], axis=1).astype(np.float64)
+    shifts = np.where(shifts > np.fix(shape / 2), shifts - shape, shifts)
+
+    if upsample_factor == 1:
+        CCmax = cross_correlation.reshape(B, -1).max(axis=1)
+    else:
+        # Initial shift estimate in upsampled grid
+        shifts = np.round(shifts * upsample_factor) / upsample_factor
+        upsampled_region_size = int(np.ceil(upsample_factor * 1.5))
+        # Center of output array at dftshift + 1
+        dftshift = np.fix(upsampled_region_size / 2.0)
+        normalization = H * W * upsample_factor ** 2
+        sample_region_offset = dftshift - shifts * upsample_factor
+        # _upsampled_dft kernels, one per image as the region follows each peak
+        region = np.arange(upsampled_region_size)
+        row_kernel = np.exp(
+            (-1j * 2 * np.pi / (H * upsample_factor)) *
+            (region[None, :, None] - sample_region_offset[:, 0, None, None]) *
+            (ifftshift(np.arange(H)) - np.floor(H / 2))[None, None, :])
+        col_kernel = np.exp(
+            (-1j * 2 * np.pi / (W * upsample_factor)) *
+            (ifftshift(np.arange(W)) - np.floor(W / 2))[None, :, None] *
+            (region[None, None, :] - sample_region_offset[:, 1, None, None]))
+        # the product of real images is hermitian: the columns missing from the rfft are
+        # conj(product[-k, W - j]), so the DFT of the full spectrum is split in two halves
+        data = image_product.conj()
+        n_half = data.shape[-1]
+        mirror = np.arange(1, W - n_half + 1)
+        cross_correlation = np.matmul(row_kernel, np.matmul(data, col_kernel[:, :n_half]))
+        cross_correlation += np.matmul(row_kernel[:, :, -np.arange(H) % H],
+                                       np.matmul(data[:, :, mirror].conj(), col_kernel[:, W - mirror]))
+        cross_correlation = cross_correlation.conj() / normalization
+        # Locate maximum and map back to original pixel grid
+        flat = cross_correlation.reshape(B, -1)
+        maxima = np.unravel_index(np.argmax(np.abs(flat), axis=1), cross_correlation.shape[1:])
+        shifts = shifts + (np.stack(maxima, axis=1) - dftshift) / upsample_factor
+        CCmax = flat.max(axis=1)
+
+    # If its only one row or column the shift along that dimension has no effect
+    shifts[:, shape == 1] = 0
+
+    return shifts, src_freq, _compute_phasediff(CCmax)
+
 #%%
 
 def apply_shifts_dft(src_freq, shifts, diffphase, is_freq=True, border_nan=True):
@@ -2023,6 +2431,110 @@ def create_weight_matrix_for_blending(img, overlaps, strides):
 
         yield weight_mat
 
+class RegistrationPlan(object):
+    """
+    What tile_and_correct derives from the template alone, computed once per template
+    instead of once per frame, and shipped to the workers with the frames to correct.
+
+    Args:
+        template: ndarray 2D
+            reference image
+
+        strides, overlaps: tuple
+            patches of the pw-rigid correction, None for a rigid correction only
+
+        add_to_movie: float
+            offset added to frames and template before registering them, as in tile_and_correct
+
+        upsample_factor_grid, newstrides, newoverlaps:
+            upsampling of the vector field, as in tile_and_correct (only used when the
+            shifts are not applied with opencv)
+
+        downsample_factor: int
+            coarse-to-fine estimation when > 1: the rigid shift is first estimated on frames
+            downsampled by this factor and refined at full resolution in a window of
+            refine_window pixels, the patches are registered on the downsampled frames only.
+            The shifts are applied at full resolution
+
+        refine_window: tuple
+            size of the full resolution window, centered in the field of view, refining the
+            rigid shift found on the downsampled frames
+
+    Attributes:
+        template_freq: spectrum of the template, for the rigid shifts (see register_frames)
+
+        xy_grid, start_step: grid coordinates and top left corner of each patch
+
+        patch_freq: ndarray (num_tiles, h, w // 2 + 1), spectra of the template patches
+        (of the downsampled template if downsample_factor > 1)
+
+        proxy_freq: spectrum of the downsampled template, if downsample_factor > 1
+
+        new_xy_grid, new_start_step, weight_matrix: upsampled grid and the blending
+        weight of each of its patches
+
+    Example:
+        plan = RegistrationPlan(template, strides, overlaps, add_to_movie=add_to_movie)
+        new_img, shifts, _, _ = tile_and_correct(img, template, strides, overlaps, max_shifts,
+                                                 add_to_movie=add_to_movie, plan=plan)
+    """
+    def __init__(self, template, strides=None, overlaps=None, add_to_movie=0, upsample_factor_grid=4,
+                 newstrides=None, newoverlaps=None, downsample_factor=1, refine_window=(256, 256)):
+        template = np.asarray(template, dtype=np.float64) + add_to_movie
+        self.shape = template.shape
+        self.template_freq = template_spectrum(template)
+        self.downsample_factor = int(downsample_factor)
+        patch_template, patch_strides, patch_overlaps = template, strides, overlaps
+        if self.downsample_factor > 1:
+            self.template = template
+            self.refine_window = tuple(np.minimum(refine_window, template.shape))
+            patch_template = self.downsample(template)
+            self.proxy_freq = template_spectrum(patch_template)
+            if strides is not None:
+                patch_strides = tuple(max(1, s // self.downsample_factor) for s in strides)
+                patch_overlaps = tuple(max(1, s // self.downsample_factor) for s in overlaps)
+        if strides is None:
+            return
+        windows = list(sliding_window(patch_template, overlaps=patch_overlaps, strides=patch_strides))
+        self.xy_grid = [(it[0], it[1]) for it in windows]
+        self.start_step = [(it[2], it[3]) for it in windows]
+        self.dim_grid = tuple(np.add(self.xy_grid[-1], 1))
+        self.patch_shape = tuple(np.add(patch_overlaps, patch_strides))
+        self.patch_freq = template_spectrum(np.stack([it[-1] for it in windows]))
+
+        if newoverlaps is None:
+            newoverlaps = overlaps
+        if newstrides is None:
+            newstrides = tuple(
+                np.round(np.divide(strides, upsample_factor_grid)).astype(int))
+        self.newoverlaps = newoverlaps
+        self.newstrides = newstrides
+        self.newshapes = np.add(newstrides, newoverlaps)
+        new_windows = [it[:4] for it in sliding_window(template, overlaps=newoverlaps, strides=newstrides)]
+        self.new_xy_grid = [(it[0], it[1]) for it in new_windows]
+        self.new_start_step = [(it[2], it[3]) for it in new_windows]
+        self.dim_new_grid = tuple(np.add(self.new_xy_grid[-1], 1))
+        self.weight_matrix = list(create_weight_matrix_for_blending(template, newoverlaps, newstrides))
+
+    def patches(self, img):
+        """(num_tiles, h, w) stack of the patches of a frame"""
+        h, w = self.patch_shape
+        return np.stack([img[x:x + h, y:y + w] for x, y in self.start_step])
+
+    def downsample(self, img):
+        """Frame downsampled by downsample_factor, cropped to a multiple of it so that the shifts scale exactly"""
+        f = self.downsample_factor
+        h, w = img.shape[0] // f * f, img.shape[1] // f * f
+        return cv2.resize(np.asarray(img[:h, :w], dtype=np.float32), (w // f, h // f),
+                          interpolation=cv2.INTER_AREA).astype(np.float64)
+
+    def proxy(self, img, gSig_filt=None):
+        """Downsampled frame, high pass filtered at the downsampled scale, for the coarse estimation"""
+        img = self.downsample(img)
+        if gSig_filt is not None:
+            img = high_pass_filter_space(img, tuple(max(1, int(round(g / self.downsample_factor))) for g in gSig_filt))
+        return np.asarray(img, dtype=np.float64)
+
 def high_pass_filter_space(img_orig, gSig_filt=None, freq=None, order=None):
     """
     Function for high passing the image(s) with centered Gaussian if gSig_filt
@@ -2071,9 +2583,101 @@ def high_pass_filter_space(img_orig, gSig_filt=None, freq=None, order=None):
             return cm.movie(np.array([cv2.idft(cv2.dft(img, flags=cv2.DFT_COMPLEX_OUTPUT) * 
                             H[..., None])[..., 0] for img in img_orig]) / (rows*cols))
 
+def _register_coarse_to_fine(batch, plan, max_shifts, add_to_movie=0, gSig_filt=None, upsample_factor_fft=10):
+    """
+    Rigid shifts of a batch of frames estimated on their downsampled proxies, then refined
+    at full resolution within +/- downsample_factor pixels, on a window of the frames
+    registered against the window of the template moved by the coarse shift.
+    """
+    f = plan.downsample_factor
+    proxies = np.array([plan.proxy(img, gSig_filt) for img in batch])
+    max_shifts_proxy = tuple(int(np.ceil(m / f)) for m in max_shifts[:2])
+    coarse = register_translation_batch(proxies + add_to_movie, plan.proxy_freq, 1, max_shifts=max_shifts_proxy)[0]
+    coarse = np.round(coarse * f).astype(int)
+
+    H, W = plan.shape
+    h, w = plan.refine_window
+    y0, x0 = (H - h) // 2, (W - w) // 2
+    # template window moved by the coarse shift, kept inside the field of view
+    ty0 = np.clip(y0 - coarse[:, 0], 0, H - h)
+    tx0 = np.clip(x0 - coarse[:, 1], 0, W - w)
+    offset = np.stack([y0 - ty0, x0 - tx0], axis=1)
+    templates = np.stack([plan.template[a:a + h, b:b + w] for a, b in zip(ty0, tx0)])
+
+    if gSig_filt is not None:
+        # filter the frame windows with a margin, so that their borders match the filtered template
+        margin = max((3 * g) // 2 + 1 for g in gSig_filt)
+        top, left = min(margin, y0), min(margin, x0)
+        bottom, right = min(margin, H - y0 - h), min(margin, W - x0 - w)
+        windows = np.array([high_pass_filter_space(img[y0 - top:y0 + h + bottom, x0 - left:x0 + w + right], gSig_filt)
+                            [top:top + h, left:left + w] for img in batch], dtype=np.float64)
+    else:
+        windows = batch[:, y0:y0 + h, x0:x0 + w]
+
+    residual = coarse - offset
+    fine = register_translation_batch(windows + add_to_movie, template_spectrum(templates), upsample_factor_fft,
+                                      shifts_lb=residual - f, shifts_ub=residual + f + 1)[0]
+    return offset + fine
+
+def register_frames(imgs, template, max_shifts, add_to_movie=0, gSig_filt=None, upsample_factor_fft=10,
+                    batch_size=8, plan=None):
+    """
+    Rigid shifts of a stack of frames against one template, as the ones estimated by
+    tile_and_correct frame by frame, but with register_translation_batch: the template
+    spectrum is computed once and the frames are registered batch_size at a time.
+
+    Args:
+        imgs: ndarray (T, H, W)
+            frames to register
+
+        template: ndarray (H, W)
+            reference image
+
+        max_shifts: tuple
+            max shifts in x and y
+
+        add_to_movie: float
+            offset added to the frames and the template, as in tile_and_correct
+
+        gSig_filt: tuple
+            size of the high pass spatial filter applied to the frames (not to the template)
+
+        upsample_factor_fft: int
+            resolution of fractional shifts
+
+        batch_size: int
+            number of frames transformed at once, bounds the memory of the batch
+
+        plan: RegistrationPlan
+            plan of the template with the same add_to_movie, its spectrum is reused.
+            With plan.downsample_factor > 1 the shifts are estimated coarse-to-fine
+
+    Returns:
+        shifts: ndarray (T, 2)
+            rigid shifts, to be passed as rigid_shts to tile_and_correct
+    """
+    if plan is not None:
+        target_freq = plan.template_freq
+    else:
+        target_freq = template_spectrum(np.asarray(template, dtype=np.float64) + add_to_movie)
+    shifts = np.zeros((len(imgs), 2))
+    for start in range(0, len(imgs), batch_size):
+        batch = np.array(imgs[start:start + batch_size], dtype=np.float64)
+        if plan is not None and plan.downsample_factor > 1:
+            shifts[start:start + batch_size] = _register_coarse_to_fine(
+                batch, plan, max_shifts, add_to_movie=add_to_movie, gSig_filt=gSig_filt,
+                upsample_factor_fft=upsample_factor_fft)
+            continue
+        if gSig_filt is not None:
+            batch = np.array([high_pass_filter_space(img, gSig_filt) for img in batch])
+        shifts[start:start + batch_size] = register_translation_batch(
+            batch + add_to_movie, target_freq, upsample_factor=upsample_factor_fft, max_shifts=max_shifts)[0]
+    return shifts
+
 def tile_and_correct(img, template, strides, overlaps, max_shifts, newoverlaps=None, newstrides=None, upsample_factor_grid=4,
                      upsample_factor_fft=10, show_movie=False, max_deviation_rigid=2, add_to_movie=0, shifts_opencv=False, gSig_filt=None,
-                     use_cuda=False, border_nan=True):
+                     use_cuda=False, border_nan=True, return_rigid_shift=False, rigid_shts=None, plan=None,
+                     apply_shifts=True):
     """ perform piecewise rigid motion correction iteration, by
         1) dividing the FOV in patches
         2) motion correcting each patch separately
@@ -2124,30 +2728,69 @@ def tile_and_correct(img, template, strides, overlaps, max_shifts, newoverlaps=N
         border_nan : bool or string, optional
             specifies how to deal with borders. (True, False, 'copy', 'min')
 
+        return_rigid_shift : bool, optional
+            also return the rigid shift of the frame, estimated before the patches. Default: False
+
+        rigid_shts : ndarray, optional
+            rigid shift of the frame already estimated, e.g. by register_frames for a whole
+            batch of frames. Only used with shifts_opencv. Default: None (estimated here)
+
+        plan : RegistrationPlan, optional
+            patches, template spectra and blending weights precomputed for this template,
+            strides, overlaps and add_to_movie. The patches are then registered in one batch.
+            Default: None (derived from the template here)
+
+        apply_shifts : bool, optional
+            False only estimates the shifts and new_img is None, to apply the shifts of
+            many frames at once with apply_shifts_batch. Only with shifts_opencv. Default: True
+
     Returns:
         (new_img, total_shifts, start_step, xy_grid)
             new_img: ndarray, corrected image
 
+        (new_img, total_shifts, start_step, xy_grid, rigid_shift) if return_rigid_shift
+
 
     """
 
     img = img.astype(np.float64).copy()
     template = template.astype(np.float64).copy()
 
+    if rigid_shts is None or not shifts_opencv or show_movie:
+        rigid_shts = None
+
+    # coarse-to-fine: shifts estimated on the downsampled frame, applied to the full one
+    coarse = plan is not None and plan.downsample_factor > 1
+    if coarse:
+        if not shifts_opencv:
+            raise Exception('Coarse-to-fine motion estimation needs shifts_opencv=True')
+        img_raw = img
+        if rigid_shts is None:
+            rigid_shts = register_frames(img[None], template, max_shifts, add_to_movie=add_to_movie,
+                                         gSig_filt=gSig_filt, upsample_factor_fft=upsample_factor_fft, plan=plan)[0]
+
     if gSig_filt is not None:
 
         img_orig = img.copy()
-        img = high_pass_filter_space(img_orig, gSig_filt)
+        # the filtered frame is only needed to register it (or its patches)
+        if rigid_shts is None or (max_deviation_rigid != 0 and not coarse):
+            img = high_pass_filter_space(img_orig, gSig_filt)
 
     img = img + add_to_movie
     template = template + add_to_movie
 
     # compute rigid shifts
-    rigid_shts, sfr_freq, diffphase = register_translation(
-        img, template, upsample_factor=upsample_factor_fft, max_shifts=max_shifts, use_cuda=use_cuda)
+    if rigid_shts is None:
+        rigid_shts, sfr_freq, diffphase = register_translation(
+            img, template, upsample_factor=upsample_factor_fft, max_shifts=max_shifts, use_cuda=use_cuda)
+    # same sign convention as the shifts of the rigid correction
+    rigid_shift = ((-rigid_shts[0], -rigid_shts[1]),) if return_rigid_shift else ()
 
     if max_deviation_rigid == 0:
 
+        if shifts_opencv and not apply_shifts:
+            return (None, (-rigid_shts[0], -rigid_shts[1]), None, None) + rigid_shift
+
         if shifts_opencv:
             if gSig_filt is not None:
                 img = img_orig
@@ -2164,16 +2807,23 @@ def tile_and_correct(img, template, strides, overlaps, max_shifts, newoverlaps=N
             new_img = apply_shifts_dft(
                 sfr_freq, (-rigid_shts[0], -rigid_shts[1]), diffphase, border_nan=border_nan)
 
-        return new_img - add_to_movie, (-rigid_shts[0], -rigid_shts[1]), None, None
+        return (new_img - add_to_movie, (-rigid_shts[0], -rigid_shts[1]), None, None) + rigid_shift
     else:
         # extract patches
-        templates = [
-            it[-1] for it in sliding_window(template, overlaps=overlaps, strides=strides)]
-        xy_grid = [(it[0], it[1]) for it in sliding_window(
-            template, overlaps=overlaps, strides=strides)]
+        if coarse:
+            xy_grid = plan.xy_grid
+            imgs = plan.patches(plan.proxy(img_raw, gSig_filt) + add_to_movie)
+        elif plan is not None:
+            xy_grid = plan.xy_grid
+            imgs = plan.patches(img)
+        else:
+            templates = [
+                it[-1] for it in sliding_window(template, overlaps=overlaps, strides=strides)]
+            xy_grid = [(it[0], it[1]) for it in sliding_window(
+                template, overlaps=overlaps, strides=strides)]
+            imgs = [it[-1]
+                    for it in sliding_window(img, overlaps=overlaps, strides=strides)]
         num_tiles = np.prod(np.add(xy_grid[-1], 1))
-        imgs = [it[-1]
-                for it in sliding_window(img, overlaps=overlaps, strides=strides)]
         dim_grid = tuple(np.add(xy_grid[-1], 1))
 
         if max_deviation_rigid is not None:
@@ -2189,16 +2839,36 @@ def tile_and_correct(img, template, strides, overlaps, max_shifts, newoverlaps=N
             ub_shifts = None
 
         # extract shifts for each patch
-        shfts_et_all = [register_translation(
-            a, b, c, shifts_lb=lb_shifts, shifts_ub=ub_shifts, max_shifts=max_shifts, use_cuda=use_cuda) for a, b, c in zip(
-            imgs, templates, [upsample_factor_fft] * num_tiles)]
-        shfts = [sshh[0] for sshh in shfts_et_all]
-        diffs_phase = [sshh[2] for sshh in shfts_et_all]
+        if coarse:
+            # search around the rigid shift scaled to the proxy, with the same resolution in full pixels
+            f = plan.downsample_factor
+            if max_deviation_rigid is not None:
+                lb_shifts = np.floor(np.subtract(rigid_shts, max_deviation_rigid) / f).astype(int)
+                ub_shifts = np.ceil(np.add(rigid_shts, max_deviation_rigid) / f).astype(int)
+            shfts, _, diffs_phase = register_translation_batch(
+                imgs, plan.patch_freq, upsample_factor_fft * f, max_shifts=np.ceil(np.divide(max_shifts, f)).astype(int),
+                shifts_lb=lb_shifts, shifts_ub=ub_shifts)
+            shfts = shfts * f
+        elif plan is not None:
+            shfts, _, diffs_phase = register_translation_batch(
+                imgs, plan.patch_freq, upsample_factor_fft, max_shifts=max_shifts,
+                shifts_lb=lb_shifts, shifts_ub=ub_shifts)
+        else:
+            shfts_et_all = [register_translation(
+                a, b, c, shifts_lb=lb_shifts, shifts_ub=ub_shifts, max_shifts=max_shifts, use_cuda=use_cuda) for a, b, c in zip(
+                imgs, templates, [upsample_factor_fft] * num_tiles)]
+            shfts = [sshh[0] for sshh in shfts_et_all]
+            diffs_phase = [sshh[2] for sshh in shfts_et_all]
         # create a vector field
         shift_img_x = np.reshape(np.array(shfts)[:, 0], dim_grid)
         shift_img_y = np.reshape(np.array(shfts)[:, 1], dim_grid)
         diffs_phase_grid = np.reshape(np.array(diffs_phase), dim_grid)
 
+        if shifts_opencv and not apply_shifts:
+            total_shifts = [
+                    (-x, -y) for x, y in zip(shift_img_x.reshape(num_tiles), shift_img_y.reshape(num_tiles))]
+            return (None, total_shifts, None, None) + rigid_shift
+
         if shifts_opencv:
             if gSig_filt is not None:
                 img = img_orig
@@ -2212,25 +2882,29 @@ def tile_and_correct(img, template, strides, overlaps, max_shifts, newoverlaps=N
                              # borderValue=add_to_movie)
             total_shifts = [
                     (-x, -y) for x, y in zip(shift_img_x.reshape(num_tiles), shift_img_y.reshape(num_tiles))]
-            return m_reg - add_to_movie, total_shifts, None, None
+            return (m_reg - add_to_movie, total_shifts, None, None) + rigid_shift
 
-        # create automatically upsample parameters if not passed
-        if newoverlaps is None:
-            newoverlaps = overlaps
-        if newstrides is None:
-            newstrides = tuple(
-                np.round(np.divide(strides, upsample_factor_grid)).astype(int))
+        if plan is not None:
+            newoverlaps, newstrides, newshapes = plan.newoverlaps, plan.newstrides, plan.newshapes
+            xy_grid, start_step = plan.new_xy_grid, plan.new_start_step
+        else:
+            # create automatically upsample parameters if not passed
+            if newoverlaps is None:
+                newoverlaps = overlaps
+            if newstrides is None:
+                newstrides = tuple(
+                    np.round(np.divide(strides, upsample_factor_grid)).astype(int))
 
-        newshapes = np.add(newstrides, newoverlaps)
+            newshapes = np.add(newstrides, newoverlaps)
 
-        imgs = [it[-1]
-                for it in sliding_window(img, overlaps=newoverlaps, strides=newstrides)]
+            xy_grid = [(it[0], it[1]) for it in sliding_window(
+                img, overlaps=newoverlaps, strides=newstrides)]
 
-        xy_grid = [(it[0], it[1]) for it in sliding_window(
-            img, overlaps=newoverlaps, strides=newstrides)]
+            start_step = [(it[2], it[3]) for it in sliding_window(
+                img, overlaps=newoverlaps, strides=newstrides)]
 
-        start_step = [(it[2], it[3]) for it in sliding_window(
-            img, overlaps=newoverlaps, strides=newstrides)]
+        imgs = [it[-1]
+                for it in sliding_window(img, overlaps=newoverlaps, strides=newstrides)]
 
         dim_new_grid = tuple(np.add(xy_grid[-1], 1))
 
@@ -2263,8 +2937,11 @@ def tile_and_correct(img, template, strides, overlaps, max_shifts, newoverlaps=N
         normalizer = np.zeros_like(img) * np.nan
         new_img = np.zeros_like(img) * np.nan
 
-        weight_matrix = create_weight_matrix_for_blending(
-            img, newoverlaps, newstrides)
+        if plan is not None:
+            weight_matrix = plan.weight_matrix
+        else:
+            weight_matrix = create_weight_matrix_for_blending(
+                img, newoverlaps, newstrides)
 
         if max_shear < 0.5:
             for (x, y), (_, _), im, (_, _), weight_mat in zip(start_step, xy_grid, imgs, total_shifts, weight_matrix):
@@ -2314,7 +2991,7 @@ def tile_and_correct(img, template, strides, overlaps, max_shifts, newoverlaps=N
                 cv2.destroyAllWindows()
             except:
                 pass
-        return new_img - add_to_movie, total_shifts, start_step, xy_grid
+        return (new_img - add_to_movie, total_shifts, start_step, xy_grid) + rigid_shift
 
 #%%        
 def tile_and_correct_3d(img:np.ndarray, template:np.ndarray, strides:Tuple, overlaps:Tuple, max_shifts:Tuple, newoverlaps:Optional[Tuple]=None, newstrides:Optional[Tuple]=None, upsample_factor_grid:int=4,
@@ -2713,10 +3390,72 @@ def compute_metrics_motion_correction(fname, final_size_x, final_size_y, swap_di
 
 
 #%%
+def build_template(fname, max_shifts, gSig_filt=None, subidx=slice(None, None, 1), var_name_hdf5='mov',
+                   is3D=False, indices=(slice(None), slice(None))):
+    """
+    Initial template from a subsample of the movie (one frame out of 50, 10 if 3D),
+    rigidly registered and median binned. Only the subsampled frames are read.
+
+    Args:
+        fname: str or SharedArrayHandle
+            movie to motion correct
+
+        max_shifts: tuple
+            x and y (and z if 3D) maximum allowed shifts
+
+        gSig_filt: tuple
+            size of the high pass spatial filter, for 1p data
+
+        subidx: slice
+            Indices to slice
+
+        indices: tuple(slice), default: (slice(None), slice(None))
+           Use that to apply motion correction only on a part of the FOV
+
+    Returns:
+        template: ndarray
+    """
+    dims, T = cm.source_extraction.cnmf.utilities.get_file_size(fname, var_name_hdf5=var_name_hdf5)
+    Ts = np.arange(T)[subidx].shape[0]
+    step = Ts // 10 if is3D else Ts // 50
+    corrected_slicer = slice(subidx.start, subidx.stop, step + 1)
+    if isinstance(fname, SharedArrayHandle):
+        m = cm.movie(fname.read(corrected_slicer, dtype=np.float32))
+    else:
+        m = cm.load(fname, var_name_hdf5=var_name_hdf5, subindices=corrected_slicer)
+
+    if len(m.shape) < 3:
+        m = cm.load(fname, var_name_hdf5=var_name_hdf5)
+        m = m[corrected_slicer]
+        logging.warning("Your original file was saved as a single page " +
+                        "file. Consider saving it in multiple smaller files" +
+                        "with size smaller than 4GB (if it is a .tif file)")
+
+    if is3D:
+        m = m[:, indices[0], indices[1], indices[2]]
+    else:
+        m = m[:, indices[0], indices[1]]
+
+    if gSig_filt is not None:
+        m = cm.movie(
+            np.array([high_pass_filter_space(m_, gSig_filt) for m_ in m]))
+    if is3D:
+        # TODO - motion_correct_3d needs to be implemented in movies.py
+        template = bin_median_3d(m) # motion_correct_3d has not been implemented yet - instead initialize to just median image
+#        template = caiman.motion_correction.bin_median_3d(
+#                m.motion_correct_3d(max_shifts[2], max_shifts[1], max_shifts[0], template=None)[0])
+    else:
+        if not m.flags['WRITEABLE']:
+            m = m.copy()
+        template = bin_median(
+                m.motion_correct(max_shifts[1], max_shifts[0], template=None)[0])
+    return template
+
 def motion_correct_batch_rigid(fname, max_shifts, dview=None, splits=56, num_splits_to_process=None, num_iter=1,
                                template=None, shifts_opencv=False, save_movie_rigid=False, add_to_movie=None,
                                nonneg_movie=False, gSig_filt=None, subidx=slice(None, None, 1), use_cuda=False,
-                               border_nan=True, var_name_hdf5='mov', is3D=False, indices=(slice(None), slice(None))):
+                               border_nan=True, var_name_hdf5='mov', is3D=False, indices=(slice(None), slice(None)),
+                               downsample_factor=1):
     """
     Function that perform memory efficient hyper parallelized rigid motion corrections while also saving a memory mappable file
 
@@ -2757,6 +3496,9 @@ def motion_correct_batch_rigid(fname, max_shifts, dview=None, splits=56, num_spl
         indices: tuple(slice), default: (slice(None), slice(None))
            Use that to apply motion correction only on a part of the FOV
 
+        downsample_factor: int, default: 1
+           estimate the shifts on frames downsampled by this factor, see RegistrationPlan
+
     Returns:
          fname_tot_rig: str
 
@@ -2773,38 +3515,9 @@ def motion_correct_batch_rigid(fname, max_shifts, dview=None, splits=56, num_spl
 
     """
 
-    dims, T = cm.source_extraction.cnmf.utilities.get_file_size(fname, var_name_hdf5=var_name_hdf5)
-    Ts = np.arange(T)[subidx].shape[0]
-    step = Ts // 10 if is3D else Ts // 50
-    corrected_slicer = slice(subidx.start, subidx.stop, step + 1)
-    m = cm.load(fname, var_name_hdf5=var_name_hdf5, subindices=corrected_slicer)
-
-    if len(m.shape) < 3:
-        m = cm.load(fname, var_name_hdf5=var_name_hdf5)
-        m = m[corrected_slicer]
-        logging.warning("Your original file was saved as a single page " +
-                        "file. Consider saving it in multiple smaller files" +
-                        "with size smaller than 4GB (if it is a .tif file)")
-
-    if is3D:
-        m = m[:, indices[0], indices[1], indices[2]]
-    else:
-        m = m[:, indices[0], indices[1]]
-
     if template is None:
-        if gSig_filt is not None:
-            m = cm.movie(
-                np.array([high_pass_filter_space(m_, gSig_filt) for m_ in m]))
-        if is3D:     
-            # TODO - motion_correct_3d needs to be implemented in movies.py
-            template = bin_median_3d(m) # motion_correct_3d has not been implemented yet - instead initialize to just median image
-#            template = caiman.motion_correction.bin_median_3d(
-#                    m.motion_correct_3d(max_shifts[2], max_shifts[1], max_shifts[0], template=None)[0])
-        else:
-            if not m.flags['WRITEABLE']:
-                m = m.copy()
-            template = bin_median(
-                    m.motion_correct(max_shifts[1], max_shifts[0], template=None)[0])
+        template = build_template(fname, max_shifts, gSig_filt=gSig_filt, subidx=subidx,
+                                  var_name_hdf5=var_name_hdf5, is3D=is3D, indices=indices)
 
     new_templ = template
     if add_to_movie is None:
@@ -2827,7 +3540,9 @@ def motion_correct_batch_rigid(fname, max_shifts, dview=None, splits=56, num_spl
             logging.debug('saving!')
 
 
-        if isinstance(fname, tuple):
+        if isinstance(fname, SharedArrayHandle):
+            base_name=fname.base_name + '_rig_'
+        elif isinstance(fname, tuple):
             base_name=os.path.split(fname[0])[-1][:-4] + '_rig_'
         else:
             base_name=os.path.split(fname)[-1][:-4] + '_rig_'
@@ -2837,7 +3552,7 @@ def motion_correct_batch_rigid(fname, max_shifts, dview=None, splits=56, num_spl
                                                              dview=dview, save_movie=save_movie, base_name=base_name, subidx = subidx,
                                                              num_splits=num_splits_to_process, shifts_opencv=shifts_opencv, nonneg_movie=nonneg_movie, gSig_filt=gSig_filt,
                                                              use_cuda=use_cuda, border_nan=border_nan, var_name_hdf5=var_name_hdf5, is3D=is3D,
-                                                             indices=indices)
+                                                             indices=indices, downsample_factor=downsample_factor)
         if is3D:
             new_templ = np.nanmedian(np.stack([r[-1] for r in res_rig]), 0)           
         else:
@@ -2867,7 +3582,7 @@ def motion_correct_batch_pwrigid(fname, max_shifts, strides, overlaps, add_to_mo
                                  splits=56, num_splits_to_process=None, num_iter=1,
                                  template=None, shifts_opencv=False, save_movie=False, nonneg_movie=False, gSig_filt=None,
                                  use_cuda=False, border_nan=True, var_name_hdf5='mov', is3D=False,
-                                 indices=(slice(None), slice(None))):
+                                 indices=(slice(None), slice(None)), downsample_factor=1):
     """
     Function that perform memory efficient hyper parallelized rigid motion corrections while also saving a memory mappable file
 
@@ -2917,6 +3632,9 @@ def motion_correct_batch_pwrigid(fname, max_shifts, strides, overlaps, add_to_mo
         indices: tuple(slice), default: (slice(None), slice(None))
            Use that to apply motion correction only on a part of the FOV
 
+        downsample_factor: int, default: 1
+           estimate the shifts on frames downsampled by this factor, see RegistrationPlan
+
     Returns:
         fname_tot_rig: str
 
@@ -2925,8 +3643,14 @@ def motion_correct_batch_pwrigid(fname, max_shifts, strides, overlaps, add_to_mo
         templates:list
             list of produced templates, one per batch
 
-        shifts: list
-            inferred rigid shifts to corrrect the movie
+        x_shifts, y_shifts, z_shifts: list
+            inferred shifts of the patches to corrrect the movie
+
+        coord_shifts: list
+            coordinates of the patches
+
+        rigid_shifts: list
+            rigid shift of every frame, estimated before its patches (empty if 3D)
 
     Raises:
         Exception 'You need to initialize the template with a good estimate. See the motion'
@@ -2952,12 +3676,16 @@ def motion_correct_batch_pwrigid(fname, max_shifts, strides, overlaps, add_to_mo
             save_movie = save_movie
             if save_movie:
 
-                if isinstance(fname, tuple):
+                if isinstance(fname, SharedArrayHandle):
+                    logging.debug(f'saving mmap of shared movie {fname.name}')
+                elif isinstance(fname, tuple):
                     logging.debug(f'saving mmap of {fname[0]} to {fname[-1]}')
                 else:
                     logging.debug(f'saving mmap of {fname}')
 
-        if isinstance(fname, tuple):
+        if isinstance(fname, SharedArrayHandle):
+            base_name=fname.base_name + '_els_'
+        elif isinstance(fname, tuple):
             base_name=os.path.split(fname[0])[-1][:-4] + '_els_'
         else:
             base_name=os.path.split(fname)[-1][:-4] + '_els_'
@@ -2970,7 +3698,7 @@ def motion_correct_batch_pwrigid(fname, max_shifts, strides, overlaps, add_to_mo
                                                             base_name=base_name, num_splits=num_splits_to_process,
                                                             shifts_opencv=shifts_opencv, nonneg_movie=nonneg_movie, gSig_filt=gSig_filt,
                                                             use_cuda=use_cuda, border_nan=border_nan, var_name_hdf5=var_name_hdf5, is3D=is3D,
-                                                            indices=indices)
+                                                            indices=indices, downsample_factor=downsample_factor)
 
         new_templ = np.nanmedian(np.dstack([r[-1] for r in res_el]), -1)
         if gSig_filt is not None:
@@ -2982,6 +3710,7 @@ def motion_correct_batch_pwrigid(fname, max_shifts, strides, overlaps, add_to_mo
     y_shifts = []
     z_shifts = []
     coord_shifts = []
+    rigid_shifts = []
     for rr in res_el:
         shift_info_chunk, idxs_chunk, tmpl_chunk = rr
         templates.append(tmpl_chunk)
@@ -2993,12 +3722,13 @@ def motion_correct_batch_pwrigid(fname, max_shifts, strides, overlaps, add_to_mo
                 z_shifts.append(np.array([sh[2] for sh in total_shift]))
                 coord_shifts.append(xyz_grid)
             else:
-                total_shift, _, xy_grid = shift_info
+                total_shift, _, xy_grid, rigid_shift = shift_info
                 x_shifts.append(np.array([sh[0] for sh in total_shift]))
                 y_shifts.append(np.array([sh[1] for sh in total_shift]))
                 coord_shifts.append(xy_grid)
+                rigid_shifts.append(rigid_shift)
 
-    return fname_tot_els, total_template, templates, x_shifts, y_shifts, z_shifts, coord_shifts
+    return fname_tot_els, total_template, templates, x_shifts, y_shifts, z_shifts, coord_shifts, rigid_shifts
 
 
 #%% in parallel
@@ -3025,21 +3755,29 @@ def tile_and_correct_wrapper(params):
     img_name, out_fname, idxs, shape_mov, template, strides, overlaps, max_shifts,\
         add_to_movie, max_deviation_rigid, upsample_factor_grid, newoverlaps, newstrides, \
         shifts_opencv, nonneg_movie, gSig_filt, is_fiji, use_cuda, border_nan, var_name_hdf5, \
-        is3D, indices = params
+        is3D, indices, plan = params
 
 
-    if isinstance(img_name, tuple):
-        name, extension = os.path.splitext(img_name[0])[:2]
-    else:
-        name, extension = os.path.splitext(img_name)[:2]
-    extension = extension.lower()
     shift_info = []
 
-    imgs = cm.load(img_name, subindices=idxs, var_name_hdf5=var_name_hdf5,is3D=is3D)
+    if isinstance(img_name, SharedArrayHandle):
+        # attach to the shared movie, only the frames of this split are copied
+        imgs = cm.movie(img_name.read(idxs, dtype=np.float32))
+    else:
+        imgs = cm.load(img_name, subindices=idxs, var_name_hdf5=var_name_hdf5,is3D=is3D)
     imgs = imgs[(slice(None),) + indices]
     mc = np.zeros(imgs.shape, dtype=np.float32)
     if not imgs[0].shape == template.shape:
         template = template[indices]
+    if shifts_opencv and not is3D and not (HAS_CUDA and use_cuda):
+        # rigid shifts of the whole split in batches, against one template spectrum
+        rigid_shts = register_frames(imgs, template, max_shifts, add_to_movie=add_to_movie, gSig_filt=gSig_filt,
+                                     plan=plan)
+    else:
+        rigid_shts = [None] * len(imgs)
+    # the opencv shifts are estimated frame by frame, then applied to the whole split at
+    # once by apply_shifts_batch, straight into mc
+    batched = shifts_opencv and not is3D and not (HAS_CUDA and use_cuda) and plan is not None
     for count, img in enumerate(imgs):
         if count % 10 == 0:
             logging.debug(count)
@@ -3055,15 +3793,33 @@ def tile_and_correct_wrapper(params):
             shift_info.append([tuple(-np.array(total_shift)), start_step, xyz_grid])
             
         else:
-            mc[count], total_shift, start_step, xy_grid = tile_and_correct(img, template, strides, overlaps, max_shifts,
+            new_img, total_shift, start_step, xy_grid, rigid_shift = tile_and_correct(img, template, strides, overlaps, max_shifts,
                                                                        add_to_movie=add_to_movie, newoverlaps=newoverlaps,
                                                                        newstrides=newstrides,
                                                                        upsample_factor_grid=upsample_factor_grid,
                                                                        upsample_factor_fft=10, show_movie=False,
                                                                        max_deviation_rigid=max_deviation_rigid,
                                                                        shifts_opencv=shifts_opencv, gSig_filt=gSig_filt,
-                                                                       use_cuda=use_cuda, border_nan=border_nan)
-            shift_info.append([total_shift, start_step, xy_grid])
+                                                                       use_cuda=use_cuda, border_nan=border_nan,
+                                                                       return_rigid_shift=True, rigid_shts=rigid_shts[count],
+                                                                       plan=plan, apply_shifts=not batched)
+            if not batched:
+                mc[count] = new_img
+            # the rigid shift seeding the patch search comes for free with the pw-rigid pass
+            shift_info.append([total_shift, start_step, xy_grid, rigid_shift])
+
+    if batched:
+        shifts = [info[0] for info in shift_info]
+        # tile_and_correct warps the frames plus add_to_movie, unless they were filtered
+        offset = 0 if gSig_filt is not None else add_to_movie
+        if max_deviation_rigid == 0:
+            apply_shifts_batch(imgs, shifts_rig=shifts, border_nan=border_nan, add_to_movie=offset,
+                               out_offset=add_to_movie, out=mc, n_threads=1)
+        else:
+            apply_shifts_batch(imgs, x_shifts_els=[[sh[0] for sh in s] for s in shifts],
+                               y_shifts_els=[[sh[1] for sh in s] for s in shifts],
+                               dims_grid=tuple(np.add(plan.xy_grid[-1], 1)), add_to_movie=offset,
+                               out_offset=add_to_movie, out=mc, n_threads=1)
 
     if out_fname is not None:
         outv = np.memmap(out_fname, mode='r+', dtype=np.float32,
@@ -3083,16 +3839,11 @@ def motion_correction_piecewise(fname, splits, strides, overlaps, add_to_movie=0
                                 upsample_factor_grid=4, order='F', dview=None, save_movie=True,
                                 base_name=None, subidx = None, num_splits=None, shifts_opencv=False, nonneg_movie=False, gSig_filt=None,
                                 use_cuda=False, border_nan=True, var_name_hdf5='mov', is3D=False,
-                                indices=(slice(None), slice(None))):
+                                indices=(slice(None), slice(None)), downsample_factor=1):
     """
 
     """
     # todo todocument
-    if isinstance(fname, tuple):
-        name, extension = os.path.splitext(fname[0])[:2]
-    else:
-        name, extension = os.path.splitext(fname)[:2]
-    extension = extension.lower()
     is_fiji = False
 
     dims, T = cm.source_extraction.cnmf.utilities.get_file_size(fname, var_name_hdf5=var_name_hdf5)
@@ -3125,9 +3876,11 @@ def motion_correction_piecewise(fname, splits, strides, overlaps, add_to_movie=0
 
     if save_movie:
         if base_name is None:
-            base_name = os.path.split(fname)[1][:-4]
+            base_name = fname.base_name if isinstance(fname, SharedArrayHandle) else os.path.split(fname)[1][:-4]
         fname_tot:Optional[str] = caiman.paths.memmap_frames_filename(base_name, dims, T, order)
-        if isinstance(fname, tuple):
+        if isinstance(fname, SharedArrayHandle):
+            fname_tot = os.path.join(fname.out_dir, fname_tot)
+        elif isinstance(fname, tuple):
             fname_tot = os.path.join(os.path.split(fname[0])[0], fname_tot)
         else:
             fname_tot = os.path.join(os.path.split(fname)[0], fname_tot)
@@ -3138,13 +3891,24 @@ def motion_correction_piecewise(fname, splits, strides, overlaps, add_to_movie=0
     else:
         fname_tot = None
 
+    add_to_movie = np.array(add_to_movie, dtype=np.float32)
+    if is3D:
+        plan = None
+    else:
+        # template patches, spectra and blending weights, computed once and shipped with every split
+        plan = RegistrationPlan(template if template.shape == dims else template[indices],
+                                strides=None if max_deviation_rigid == 0 else strides, overlaps=overlaps,
+                                add_to_movie=add_to_movie, upsample_factor_grid=upsample_factor_grid,
+                                newstrides=newstrides, newoverlaps=newoverlaps,
+                                downsample_factor=downsample_factor)
+
     pars = []
     for idx in idxs:
         logging.debug('Processing: frames: {}'.format(idx))
-        pars.append([fname, fname_tot, idx, shape_mov, template, strides, overlaps, max_shifts, np.array(
-            add_to_movie, dtype=np.float32), max_deviation_rigid, upsample_factor_grid,
+        pars.append([fname, fname_tot, idx, shape_mov, template, strides, overlaps, max_shifts,
+            add_to_movie, max_deviation_rigid, upsample_factor_grid,
             newoverlaps, newstrides, shifts_opencv, nonneg_movie, gSig_filt, is_fiji,
-            use_cuda, border_nan, var_name_hdf5, is3D, indices])
+            use_cuda, border_nan, var_name_hdf5, is3D, indices, plan])
 
     if dview is not None:
         logging.info('** Starting parallel motion correction **')
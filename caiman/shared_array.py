@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+"""
+Handle to a movie kept in shared memory or in a memory mapped file, so that the
+motion correction workers can read their frames without a copy of the movie being
+serialized to disk (tmp_mov_mot_corr.hdf5) or pickled to every process.
+"""
+
+import logging
+import os
+import tempfile
+import uuid
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+
+# pid -> whether the process shares the resource tracker of the owner
+_shared_tracker = {}
+
+
+def _attach(name):
+    """
+    Attaches an existing shared memory block without taking ownership of it.
+
+    A worker forked before the resource tracker of the parent was started runs its
+    own tracker, which would unlink the block when the worker exits. Such a worker
+    unregisters the block right away, the owner unlinks it in release().
+    """
+    pid = os.getpid()
+    if pid not in _shared_tracker:
+        _shared_tracker[pid] = os.name != 'posix' or \
+            getattr(resource_tracker._resource_tracker, '_fd', None) is not None
+    shm = shared_memory.SharedMemory(name=name)
+    if not _shared_tracker[pid]:
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+
+class SharedArrayHandle(object):
+    """
+    Picklable reference to a (T, d1, d2) array shared between processes.
+
+    Only the name, shape and dtype are pickled. The process that created the handle
+    owns the memory and has to call release() once the workers are done.
+
+    Args:
+        name: str
+            name of the shared memory block, or path of the memmap file
+
+        shape: tuple
+            shape of the array
+
+        dtype: numpy dtype
+            data type of the array, the original one of the movie (e.g. uint8)
+
+        backend: str
+            'shm' for multiprocessing.shared_memory, 'memmap' for a raw file on disk
+
+        out_dir: str
+            directory where the motion corrected memmap files are written
+
+        offset: int
+            index of the first frame of the array in the memmap file, to share a chunk
+            of a longer raw memmap (e.g. a VideoBuffer) without copying it
+
+    Example:
+        handle = SharedArrayHandle.from_array(video, tmp_dir=outpath)
+        mc = MotionCorrect(handle, dview=dview, ...)
+        mc.motion_correct(save_movie=True)
+        handle.release()
+    """
+
+    def __init__(self, name, shape, dtype, backend='shm', out_dir=None, offset=0):
+        if backend not in ('shm', 'memmap'):
+            raise ValueError('backend must be shm or memmap')
+        self.name = name
+        self.shape = tuple(int(s) for s in shape)
+        self.dtype = np.dtype(dtype)
+        self.backend = backend
+        self.out_dir = out_dir if out_dir is not None else os.getcwd()
+        self.offset = int(offset)
+        if self.offset and backend != 'memmap':
+            raise ValueError('a frame offset needs the memmap backend')
+        self._shm = None
+        self._array = None
+
+    @classmethod
+    def from_array(cls, array, backend='shm', tmp_dir=None):
+        """
+        Copies array into a new shared block owned by this process
+
+        Args:
+            array: ndarray
+                movie to share, its dtype is kept
+
+            backend: str
+                'shm' or 'memmap'. Use 'memmap' if the movie does not fit in RAM twice
+
+            tmp_dir: str
+                directory of the memmap file and of the motion corrected outputs,
+                defaults to the system temporary directory
+
+        Returns:
+            handle: SharedArrayHandle
+        """
+        array = np.asarray(array)
+        tmp_dir = tmp_dir if tmp_dir is not None else tempfile.gettempdir()
+        if backend == 'shm':
+            shm = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+            handle = cls(shm.name, array.shape, array.dtype, backend, tmp_dir)
+            handle._shm = shm
+            handle._array = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+        else:
+            os.makedirs(tmp_dir, exist_ok=True)
+            path = os.path.join(tmp_dir, 'mc_input_' + uuid.uuid4().hex[:12] + '.dat')
+            handle = cls(path, array.shape, array.dtype, backend, tmp_dir)
+            handle._array = np.memmap(path, dtype=array.dtype, mode='w+', shape=array.shape)
+        handle._array[:] = array
+        logging.debug('Shared movie {} {} {}'.format(handle.name, handle.shape, handle.dtype))
+        return handle
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_shm'] = None
+        state['_array'] = None
+        return state
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def base_name(self):
+        """Name of the output memmap files, the chunks of one file reuse (overwrite) the same names"""
+        return os.path.splitext(os.path.split(self.name)[-1])[0].lstrip('/')
+
+    def read(self, item=slice(None), dtype=None):
+        """
+        Copies a part of the array, e.g. read(idxs) for the frames idxs
+
+        Args:
+            item: index
+                any numpy index on the (T, d1, d2) array
+
+            dtype: numpy dtype
+                data type of the copy, defaults to the one of the array
+
+        Returns:
+            frames: ndarray
+        """
+        if self._array is not None:
+            return np.array(self._array[item], dtype=dtype)
+        if self.backend == 'memmap':
+            frame_bytes = int(np.prod(self.shape[1:])) * self.dtype.itemsize
+            return np.array(np.memmap(self.name, dtype=self.dtype, mode='r', shape=self.shape,
+                                      offset=self.offset * frame_bytes)[item], dtype=dtype)
+        # attach for this read only, workers do not keep the block mapped
+        shm = _attach(self.name)
+        try:
+            array = np.ndarray(self.shape, dtype=self.dtype, buffer=shm.buf)
+            frames = np.array(array[item], dtype=dtype)
+            del array
+        finally:
+            shm.close()
+        return frames
+
+    def release(self):
+        """Frees the shared memory or removes the memmap file. Only for the owner"""
+        self._array = None
+        if self.backend == 'shm':
+            if self._shm is not None:
+                self._shm.close()
+                try:
+                    self._shm.unlink()
+                except FileNotFoundError:
+                    pass
+                self._shm = None
+        else:
+            try:
+                os.remove(self.name)
+            except FileNotFoundError:
+                pass
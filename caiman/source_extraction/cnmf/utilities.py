@@ -41,6 +41,7 @@ from ...base.rois import com
 from ...mmapping import parallel_dot_product, load_memmap
 from ...cluster import extract_patch_coordinates
 from ...utils.stats import df_percentile
+from ...shared_array import SharedArrayHandle
 
 
 def decimation_matrix(dims, sub):
@@ -974,6 +975,8 @@ def get_file_size(file_name, var_name_hdf5='mov'):
             T: int or tuple of int
                 number of timesteps in each file
     """
+    if isinstance(file_name, SharedArrayHandle):
+        return file_name.shape[1:], file_name.shape[0]
     if isinstance(file_name, pathlib.Path):
         # We want to support these as input, but str has a broader set of operations that we'd like to use, so let's just convert.
 	# (specifically, filePath types don't support subscripting)
@@ -0,0 +1,58 @@
+# check that the online motion correction of a synthetic session gives the frames
+# MotionCorrect gives offline with the same template, e.g. python check_online_mc.py
+import os
+import argparse
+import tempfile
+
+import cv2
+import numpy as np
+
+from caiman.motion_correction import MotionCorrect
+from caiman.base.movies import load
+from caiman.shared_array import SharedArrayHandle
+from pipeline import VideoBuffer
+from pipeline.online_mc import OnlineMotionCorrection
+
+
+def check_online_mc(frame_num=60, tolerance=1e-3):
+    """Max absolute difference between the online and offline corrected frames, raises if above tolerance."""
+    rng = np.random.default_rng(0)
+    base = cv2.GaussianBlur((rng.random((200, 200)) * 200).astype(np.float32), (0, 0), 3) * 3
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_path = os.path.join(tmp_dir, 'frames')
+        os.makedirs(data_path)
+        for i in range(frame_num):
+            shift = rng.integers(-5, 6, size=2)
+            cv2.imwrite(os.path.join(data_path, f'frame_{i}.jpg'),
+                        np.roll(base, tuple(shift), (0, 1)).clip(0, 255).astype(np.uint8))
+        # one template from all the frames, kept for the whole session
+        online_mc = OnlineMotionCorrection(data_path, os.path.join(tmp_dir, 'mc.h5'), (10, 10), (48, 48), (24, 24), 3,
+                                           buffer_path=os.path.join(tmp_dir, 'mc.dat'), frame_num=frame_num,
+                                           init_frames=frame_num, template_update=frame_num + 1,
+                                           detect_bad_frames=False)
+        online_mc.run()
+        online = np.array(VideoBuffer(os.path.join(tmp_dir, 'mc.dat'), (frame_num,) + tuple(online_mc.dims),
+                                      np.float32, mode='r')[:])
+
+        raw = np.stack([online_mc._imread(i) for i in range(frame_num)]).astype(np.float32)
+        raw_handle = SharedArrayHandle.from_array(raw, backend='memmap', tmp_dir=tmp_dir)
+        mc = MotionCorrect(raw_handle, max_shifts=(10, 10), strides=(48, 48), overlaps=(24, 24), max_deviation_rigid=3,
+                           shifts_opencv=True, nonneg_movie=True, border_nan='copy', gSig_filt=(6, 6))
+        mc.motion_correct(save_movie=True, template=online_mc.template, single_pass=True)
+        offline = np.array(load(mc.fname_tot_els[0]))
+        raw_handle.release()
+        online_mc.close()
+
+    difference = float(np.abs(online - offline).max())
+    if difference > tolerance:
+        raise AssertionError(f'online and offline motion correction differ by {difference} > {tolerance}')
+    return difference
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare online and offline motion correction on a synthetic session')
+    parser.add_argument('--frame_num', type=int, default=60, help='Number of synthetic frames')
+    parser.add_argument('--tolerance', type=float, default=1e-3, help='Largest accepted difference of a pixel')
+    args = parser.parse_args()
+    difference = check_online_mc(args.frame_num, args.tolerance)
+    print(f'online vs offline motion correction: max difference {difference} <= {args.tolerance}')
@@ -1 +1 @@
-from .inference import background_rejection
\ No newline at end of file
+from .inference import background_rejection, InferenceSession
\ No newline at end of file
@@ -0,0 +1,59 @@
+import argparse
+import time
+import torch
+from .inference import InferenceSession
+
+
+def benchmark(ckpt_pth, devices=('cpu', 'cpu-torchscript', 'cpu-onnx'), precisions=('fp32',),
+              patch_size='(128, 128, 128)', batch_size=4, threads=0, batches=10, export_dir=None, **kwargs):
+    """Throughput of the DeepDefinite backends in patches/s, on random batches of patch_size.
+
+    Every (device, precision) pair is warmed up with one batch, which also exports the
+    network, then timed over batches batches. Pairs a backend does not support are skipped.
+
+    Returns:
+        {(device, precision): patches/s}
+
+    Example:
+        python -m deepdefinite.benchmark --ckpt_pth utils/deepdefinite_ckpt_resize_2.pth --precisions fp32 bf16 int8
+    """
+    results = {}
+    for device in devices:
+        for precision in precisions:
+            try:
+                session = InferenceSession(ckpt_pth, device=device, patch_size=patch_size, batch_size=batch_size,
+                                           precision=precision, threads=threads, export_dir=export_dir, **kwargs)
+            except ValueError as e:
+                print(f'{device:16s} {precision:5s} skipped: {e}')
+                continue
+            input = torch.randn((session.batch_size, session.in_channels) + tuple(session.patch_size))
+            with torch.inference_mode():
+                session.forward(input)
+                if session.device.type == 'cuda':
+                    torch.cuda.synchronize()
+                start = time.perf_counter()
+                for _ in range(batches):
+                    bg, neuron = session.forward(input)
+                neuron.cpu()
+                elapsed = time.perf_counter() - start
+            results[(device, precision)] = batches * session.batch_size / elapsed
+            print(f'{device:16s} {precision:5s} {results[(device, precision)]:8.2f} patches/s')
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the throughput of the DeepDefinite backends')
+    parser.add_argument('--ckpt_pth', type=str, default='utils/deepdefinite_ckpt_resize_2.pth', help='Path to the model checkpoint')
+    parser.add_argument('--devices', type=str, nargs='+', default=['cpu', 'cpu-torchscript', 'cpu-onnx'], help='Devices to compare')
+    parser.add_argument('--precisions', type=str, nargs='+', default=['fp32'], help='fp32, bf16 and/or int8')
+    parser.add_argument('--patch_size', type=str, default='(128, 128, 128)', help='Patch size')
+    parser.add_argument('--batch_size', type=int, default=4, help='Patches per batch')
+    parser.add_argument('--threads', type=int, default=0, help='Intra-op threads, 0 for the backend default')
+    parser.add_argument('--batches', type=int, default=10, help='Number of timed batches')
+    parser.add_argument('--gsize', type=int, default=6, help='Neuron radius')
+    parser.add_argument('--f_maps', type=int, default=32, help='Feature maps of the checkpoint')
+    parser.add_argument('--export_dir', type=str, default=None, help='Directory of the exported networks')
+    args = parser.parse_args()
+    benchmark(args.ckpt_pth, devices=args.devices, precisions=args.precisions, patch_size=args.patch_size,
+              batch_size=args.batch_size, threads=args.threads, batches=args.batches, export_dir=args.export_dir,
+              gsize=args.gsize, f_maps=args.f_maps)
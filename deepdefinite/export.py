@@ -0,0 +1,126 @@
+import os
+import inspect
+import logging
+import tempfile
+import contextlib
+import torch
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+
+@contextlib.contextmanager
+def atomic_path(path):
+    """Temporary path next to path, moved onto path once written, so that concurrent runs
+    sharing an export directory never load a partially written file."""
+    root, ext = os.path.splitext(path)
+    fd, tmp_path = tempfile.mkstemp(suffix=ext, prefix=os.path.basename(root) + '.', dir=os.path.dirname(path))
+    os.close(fd)
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+# export BG_Rejection for a fixed (B, C, T, H, W) input, traced under bf16 autocast if asked
+def export_torchscript(net, path, input_shape, bf16=False):
+    net = net.eval().cpu()
+    with torch.inference_mode(False), torch.no_grad(), \
+            torch.autocast(device_type='cpu', dtype=torch.bfloat16, enabled=bf16):
+        traced = torch.jit.trace(net, torch.zeros(input_shape), check_trace=False)
+    traced = torch.jit.freeze(traced)
+    with atomic_path(path) as tmp_path:
+        traced.save(tmp_path)
+    logging.info(f'BG_Rejection exported to {path} for input {tuple(input_shape)}')
+    return path
+
+
+def export_onnx(net, path, input_shape, opset_version=17):
+    net = net.eval().cpu()
+    kwargs = {}
+    # torch >= 2.5 exports through dynamo by default, the TorchScript exporter handles this model as it is
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        kwargs['dynamo'] = False
+    with torch.inference_mode(False), torch.no_grad(), atomic_path(path) as tmp_path:
+        torch.onnx.export(net, (torch.zeros(input_shape),), tmp_path, input_names=['input'],
+                          output_names=['bg', 'neuron'], opset_version=opset_version, **kwargs)
+    logging.info(f'BG_Rejection exported to {path} for input {tuple(input_shape)}')
+    return path
+
+
+# dynamic int8 quantization of the convolution weights, activations are quantized on the fly
+def quantize_int8(path, quantized_path):
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    with atomic_path(quantized_path) as tmp_path:
+        quantize_dynamic(path, tmp_path, weight_type=QuantType.QInt8)
+    logging.info(f'{path} quantized to int8 in {quantized_path}')
+    return quantized_path
+
+
+def cpu_threads(threads=0):
+    """Number of threads for the CPU backends, threads if > 0 else the cores this process may use."""
+    if threads > 0:
+        return threads
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def exported_path(ckpt_pth, export_dir, input_shape, network, precision, ext):
+    """Path of the export of ckpt_pth for input_shape, e.g. ckpt_g6_f32_c1x1_4x1x128x128x128_fp32.onnx.
+
+    network tags the parameters the checkpoint was built with (gsize, f_maps, channels), so
+    that sessions of one checkpoint with different parameters never share an export.
+    """
+    export_dir = export_dir if export_dir is not None else os.path.join(tempfile.gettempdir(), 'deepdefinite')
+    os.makedirs(export_dir, exist_ok=True)
+    name = os.path.splitext(os.path.basename(ckpt_pth))[0]
+    return os.path.join(export_dir, f"{name}_{network}_{'x'.join(str(s) for s in input_shape)}_{precision}{ext}")
+
+
+def is_stale(path, ckpt_pth):
+    return not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(ckpt_pth)
+
+
+class TorchScriptRunner:
+    """Frozen TorchScript module of BG_Rejection on CPU, for one input shape.
+
+    Args:
+        path: path of the .pt file written by export_torchscript
+        threads: intra-op threads, 0 to keep the torch default
+    """
+
+    def __init__(self, path, threads=0):
+        if threads > 0:
+            torch.set_num_threads(threads)
+        self.module = torch.jit.load(path, map_location='cpu')
+
+    def __call__(self, input):
+        return self.module(input)
+
+
+class OnnxRunner:
+    """ONNX Runtime session of BG_Rejection on CPU, for one input shape.
+
+    Args:
+        path: path of the .onnx file written by export_onnx (or quantize_int8)
+        threads: intra-op threads, 0 for all the cores this process may use
+    """
+
+    def __init__(self, path, threads=0):
+        if onnxruntime is None:
+            raise ImportError('the cpu-onnx backend needs onnxruntime')
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = cpu_threads(threads)
+        options.inter_op_num_threads = 1
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+
+    def __call__(self, input):
+        bg, neuron = self.session.run(None, {'input': input.numpy()})
+        return torch.from_numpy(bg), torch.from_numpy(neuron)
@@ -1,136 +1,360 @@
 import os
+import math
 import time
-import datetime
+import logging
+from concurrent.futures import ThreadPoolExecutor
 import tifffile
 import numpy as np
 import torch
-from .utils import crop_patches, concat_patches, save_video
+from .utils import patch_regions, save_video, open_video_writer
+from . import export
 from .model import BG_Rejection
+from pipeline import timing
 
 from tqdm import tqdm
 
-def background_rejection(
-                         video,
-                         gsize = 6, # neuron radius
-                         ckpt_pth = '',
-                         patch_size ='(128, 128, 128)', # background rejection patch size
-                         stride_size = '(96, 96, 96)', # background rejection stride size
-                         batch_size = 4,
-                         device = 'cuda', # utilize GPU or CPU
-                         gpu_ids ='0', # GPU ids
-                         output_dir = '',
-                         in_channels = 1,
-                         out_channels = 1,
-                         f_maps = 32):
-    
-    # restrict the devices
-    os.environ["CUDA_VISIBLE_DEVICES"] = gpu_ids
-    device = torch.device(device)
-
-    # mkdir
-    os.makedirs(os.path.join(output_dir, 'bg'), exist_ok=True)
-    os.makedirs(os.path.join(output_dir, 'rmbg'), exist_ok=True)
-        
-
-    # load model and pretrained weights
-    net = BG_Rejection(in_channels=in_channels, out_channels=out_channels, f_maps=f_maps,
-                       gsize=gsize, infer=True)
-    if torch.cuda.device_count() > 1:
-        net = torch.nn.DataParallel(net)
-    net.to(device)
-    
-    # checkpoint = torch.load(ckpt_pth, map_location='cpu')
-    # net.load_state_dict(checkpoint['net'])
-
-    # checkpoint = torch.load(ckpt_pth, map_location='cpu',)
-    # new_state_dict = {}
-    # for k, v in checkpoint['net'].items():
-    #     new_key = "module." + k
-    #     new_state_dict[new_key] = v
-    # net.load_state_dict(new_state_dict)
-    checkpoint = torch.load(ckpt_pth, map_location='cpu')
-
-    try:
-        # Attempt to load the checkpoint directly
-        net.load_state_dict(checkpoint['net'])
-    except:
-        # If there's a KeyError, adjust the keys by adding "module." prefix
-        new_state_dict = {}
-        for k, v in checkpoint['net'].items():
-            new_key = "module." + k
-            new_state_dict[new_key] = v
-        net.load_state_dict(new_state_dict)
-
-    # patching
-    patch_size = eval(patch_size)
-    stride_size = eval(stride_size)
-    overlap_size = (patch_size[0] - stride_size[0],
-                    patch_size[1] - stride_size[1],
-                    patch_size[2] - stride_size[2])
-
-
-    # load data
-    # image_list_path = glob.glob(os.path.join(dataset_dir, '*.tif*'))
-    
-    # # TODO pay attention to the sort
-    
-    # # load the image to the RAM, T x H x W format
-    # image_list = [tifffile.imread(image).astype(np.float32) for image in image_list_path]
-    video = np.stack(video, axis=0) # not normalized to 0-1
-    frameN = video.shape[0]
-    
-    with torch.no_grad():
+
+class InferenceSession:
+    """DeepDefinite network loaded once for a run, applied to every chunk of the video.
+
+    Builds BG_Rejection, reads the checkpoint, places the network on its device(s) and
+    switches it to eval mode once, so process() only does the inference of a chunk.
+
+    Args:
+        ckpt_pth: path of the checkpoint, with or without the 'module.' prefix of DataParallel
+        gsize: neuron radius
+        device: 'cuda', 'cpu', or 'cpu-torchscript' / 'cpu-onnx' to run on CPU a TorchScript /
+            ONNX Runtime export of the network for the fixed patch shape, exported to
+            export_dir the first time a shape is met
+        gpu_ids: GPU ids, set to CUDA_VISIBLE_DEVICES before CUDA is initialized
+        patch_size, stride_size: background rejection patch and stride, '(T, H, W)' strings
+        batch_size: number of patches per forward pass, 0 for the largest batch fitting in
+            the free GPU memory
+        in_channels, out_channels, f_maps: network parameters of the checkpoint
+        compile: optimize the network with torch.compile (torch >= 2), the first chunk pays
+            for the compilation. Eager backends only
+        precision: 'fp32', 'bf16' (autocast, torch backends) or 'int8' (dynamic quantization
+            of the weights, cpu-onnx only)
+        threads: intra-op threads on CPU, 0 for the default of the backend
+        export_dir: directory of the exported networks, defaults to deepdefinite/ in the
+            temporary directory of the system
+
+    Example:
+        session = InferenceSession(ckpt_pth, gsize=6, device='cuda', gpu_ids='0')
+        for i, (start, stop, frames) in enumerate(preprocess_store.chunks(2000)):
+            session.process(frames, output_dir=os.path.join(rmbg_out, f'chunk_{i}'), store=rmbg_store, store_offset=start)
+    """
+
+    # devices running an exported network on CPU
+    backends = {'cpu-torchscript': 'torchscript', 'cpu-onnx': 'onnx'}
+
+    def __init__(self, ckpt_pth, gsize=6, device='cuda', gpu_ids='0', patch_size='(128, 128, 128)',
+                 stride_size='(96, 96, 96)', batch_size=4, in_channels=1, out_channels=1, f_maps=32, compile=False,
+                 precision='fp32', threads=0, export_dir=None):
+        start = time.perf_counter()
+        timing.begin('load_model')
+        # restrict the devices, only effective before the first CUDA call
+        os.environ["CUDA_VISIBLE_DEVICES"] = gpu_ids
+        self.backend = self.backends.get(device, 'eager')
+        self.device = torch.device('cpu' if self.backend != 'eager' else device)
+        if precision not in ('fp32', 'bf16', 'int8'):
+            raise ValueError(f'Unknown precision {precision}, use fp32, bf16 or int8')
+        if precision == 'int8' and self.backend != 'onnx':
+            raise ValueError('int8 inference needs the cpu-onnx device')
+        if precision == 'bf16' and self.backend == 'onnx':
+            raise ValueError('bf16 inference needs the cpu, cuda or cpu-torchscript device')
+        self.precision = precision
+        self.threads = threads
+        self.ckpt_pth = ckpt_pth
+        self.export_dir = export_dir
+        self.network = f'g{gsize}_f{f_maps}_c{in_channels}x{out_channels}'
+        self._runners = {}
+        if self.device.type == 'cpu' and self.backend != 'onnx' and threads > 0:
+            torch.set_num_threads(threads)
+        self.in_channels = in_channels
+        self.patch_size = eval(patch_size)
+        self.stride_size = eval(stride_size)
+        self.overlap_size = tuple(p - s for p, s in zip(self.patch_size, self.stride_size))
+
+        net = BG_Rejection(in_channels=in_channels, out_channels=out_channels, f_maps=f_maps,
+                           gsize=gsize, infer=True)
+        checkpoint = torch.load(ckpt_pth, map_location='cpu')
+        # checkpoints saved from DataParallel prefix the keys with 'module.'
+        state_dict = {k[len('module.'):] if k.startswith('module.') else k: v for k, v in checkpoint['net'].items()}
+        net.load_state_dict(state_dict)
         net.eval()
+        if self.device.type == 'cuda' and torch.cuda.device_count() > 1:
+            net = torch.nn.DataParallel(net)
+        net.to(self.device)
+        self.net = net
+        self.batch_size = batch_size if batch_size > 0 else self.auto_batch_size()
+        self._buffers = {}
+        if compile and self.backend == 'eager':
+            if hasattr(torch, 'compile'):
+                net = torch.compile(net)
+            else:
+                logging.warning('torch.compile needs torch >= 2, the network is not compiled')
+            self.net = net
+        timing.end('load_model')
+        logging.info(f'DeepDefinite loaded on {device} ({self.precision}) in {time.perf_counter() - start:.1f} s, '
+                     f'batches of {self.batch_size} patches')
 
-        start_time = time.time()
-        origin_shape = video.shape
+    def forward(self, input):
+        """(bg, neuron) outputs of the network for a (B, C, T, H, W) float32 batch."""
+        if self.backend == 'eager':
+            with torch.autocast(device_type=self.device.type, dtype=torch.bfloat16, enabled=self.precision == 'bf16'):
+                return self.net(input.to(self.device, non_blocking=True))
+        # the exports have a fixed batch size, the last batch of a chunk is padded
+        batch_num = input.shape[0]
+        if batch_num < self.batch_size:
+            input = torch.cat([input, input.new_zeros((self.batch_size - batch_num,) + tuple(input.shape[1:]))])
+        runner = self._runners.get(tuple(input.shape))
+        if runner is None:
+            runner = self._runners[tuple(input.shape)] = self._export(tuple(input.shape))
+        bg, neuron = runner(input)
+        return bg[:batch_num], neuron[:batch_num]
 
-        # preprocessing
-        video_mean = np.mean(video, axis=0, keepdims=True)
-        video = video - video_mean
-        
-        # patch chopping
-        video_patches, patch_num = crop_patches(video, patch_size, stride_size)
-        iter_num = len(video_patches) // batch_size if len(video_patches) % batch_size == 0 else len(
-            video_patches) // batch_size + 1
+    def _export(self, input_shape):
+        """Runner of the export for input_shape, exporting the network if needed."""
+        with timing.stage('export'):
+            if self.backend == 'torchscript':
+                path = export.exported_path(self.ckpt_pth, self.export_dir, input_shape, self.network,
+                                            self.precision, '.pt')
+                if export.is_stale(path, self.ckpt_pth):
+                    export.export_torchscript(self.net, path, input_shape, bf16=self.precision == 'bf16')
+                return export.TorchScriptRunner(path, self.threads)
+            path = export.exported_path(self.ckpt_pth, self.export_dir, input_shape, self.network, 'fp32', '.onnx')
+            if export.is_stale(path, self.ckpt_pth):
+                export.export_onnx(self.net, path, input_shape)
+            if self.precision == 'int8':
+                quantized_path = export.exported_path(self.ckpt_pth, self.export_dir, input_shape, self.network,
+                                                      'int8', '.onnx')
+                if export.is_stale(quantized_path, path):
+                    export.quantize_int8(path, quantized_path)
+                path = quantized_path
+            return export.OnnxRunner(path, self.threads)
 
-        bg_patches = []
-        neuron_patches = []
-        for j in range(iter_num):
-            input = torch.as_tensor(video_patches[j * batch_size:(j + 1) * batch_size],
-                                    dtype=torch.float32, device=device).unsqueeze(1)
-            out_bg, out_neuron = net(input)
+    def auto_batch_size(self, memory_fraction=0.8, max_batch_size=64):
+        """Largest batch whose inference fits in memory_fraction of the free GPU memory,
+        from the peak memory of a one patch forward pass. 4 on CPU."""
+        if self.device.type != 'cuda':
+            return 4
+        torch.cuda.empty_cache()
+        free, _ = torch.cuda.mem_get_info(self.device)
+        torch.cuda.reset_peak_memory_stats(self.device)
+        allocated = torch.cuda.memory_allocated(self.device)
+        with torch.inference_mode():
+            self.forward(torch.zeros((1, self.in_channels) + tuple(self.patch_size), device=self.device))
+        per_patch = torch.cuda.max_memory_allocated(self.device) - allocated
+        torch.cuda.empty_cache()
+        # DataParallel splits a batch over the GPUs
+        gpu_num = torch.cuda.device_count() if isinstance(self.net, torch.nn.DataParallel) else 1
+        return int(np.clip(memory_fraction * free // max(per_patch, 1), 1, max_batch_size // gpu_num)) * gpu_num
 
-            out_bg = out_bg.squeeze(1)
-            out_neuron = out_neuron.squeeze(1)
+    def process(self, video, output_dir='', store=None, store_offset=0):
+        """Background rejection of one chunk of frames.
 
-            bg_patches.append(out_bg.detach().cpu().numpy().astype(np.float16))
-            neuron_patches.append(out_neuron.detach().cpu().numpy().astype(np.float16))
+        Args:
+            video: (T, H, W) frames, not normalized to 0-1
+            output_dir: directory of bg/bg.avi and rmbg.avi (and of the rmbg tifs without store)
+            store: optional VideoStore receiving the rmbg frames instead of tifs
+            store_offset: index of the first frame of this chunk in the store
 
-            left_time = datetime.timedelta(seconds=int((time.time() - start_time) / (iter_num + j + 1) * ((iter_num - j - 1))))
-            print('[Inference Video] [Pacthes: %d/%d] [ETA: %s]' % (j + 1, iter_num, str(left_time)))
+        Returns:
+            (out_bg, out_neuron), (T, H, W) background and neuron videos
+        """
+        os.makedirs(os.path.join(output_dir, 'bg'), exist_ok=True)
+        if store is None:
+            os.makedirs(os.path.join(output_dir, 'rmbg'), exist_ok=True)
 
-        # do the stitching
-        bg_patches = np.concatenate(bg_patches, axis=0)
-        neuron_patches = np.concatenate(neuron_patches, axis=0)
+        video = np.stack(video, axis=0) # not normalized to 0-1
+        frameN = video.shape[0]
+
+        # preprocessing
+        timing.begin('crop_patches')
+        video_mean = np.mean(video, axis=0, keepdims=True)
+        video = video - video_mean
+        timing.end('crop_patches')
+        out_bg, out_neuron = self._infer(video, frames=frameN)
 
-        out_bg = concat_patches(bg_patches, origin_shape, patch_num, patch_size, stride_size, overlap_size)
-        out_neuron = concat_patches(neuron_patches, origin_shape, patch_num, patch_size, stride_size,
-                                            overlap_size)
         # save file
+        timing.begin('stitch')
         out_bg = (out_bg + video_mean).clip(0, 255)
         out_neuron = out_neuron.clip(0, 255)
-        
-        
+        timing.end('stitch')
+
         # save video trunks
-        for i in tqdm(range(frameN)):
-            # note the clip is necessary, as the output may have negative values
-            # tifffile.imwrite(os.path.join(output_dir, 'bg', 'frame_'+str(i)+'.tif'), out_bg[i].clip(0, 255).astype(np.uint8))
-            tifffile.imwrite(os.path.join(output_dir, 'rmbg', 'frame_'+str(i)+'.tif'), out_neuron[i].clip(0, 255).astype(np.uint8))
- 
+        timing.begin('write')
+        if store is not None:
+            store.write(store_offset, out_neuron.clip(0, 255).astype(np.uint8))
+        else:
+            for i in tqdm(range(frameN)):
+                # note the clip is necessary, as the output may have negative values
+                # tifffile.imwrite(os.path.join(output_dir, 'bg', 'frame_'+str(i)+'.tif'), out_bg[i].clip(0, 255).astype(np.uint8))
+                tifffile.imwrite(os.path.join(output_dir, 'rmbg', 'frame_'+str(i)+'.tif'), out_neuron[i].clip(0, 255).astype(np.uint8))
+
         save_video(out_bg, 30, os.path.join(output_dir, 'bg', 'bg.avi'))
         save_video(out_neuron,  30, os.path.join(output_dir, 'rmbg.avi'))
-        
+        timing.end('write')
+
         return out_bg, out_neuron
 
+    def process_stream(self, chunks, frame_num, store, output_dir=None, mean=None):
+        """Background rejection of a whole session, streamed through overlapping temporal windows.
+
+        The patch_size[0] frames windows slide by stride_size[0] over the session, exactly as
+        crop_patches / concat_patches would cut the whole video, so there is no seam between
+        chunks. Only the frames of the current window and of the last chunk read are held.
+        The mean subtracted from a window is the running mean of all the frames read so far,
+        or the given session mean.
+
+        Args:
+            chunks: iterable of (start, stop, frames) blocks of consecutive frames, e.g.
+                VideoStore.chunks(session.stride_size[0])
+            frame_num: number of frames of the session
+            store: VideoStore receiving the rmbg frames
+            output_dir: optional directory of bg/bg.avi and rmbg.avi
+            mean: optional (H, W) mean of the session, instead of the running mean
+
+        Returns:
+            number of frames processed
 
+        Example:
+            session.process_stream(preprocess_store.chunks(session.stride_size[0]), len(preprocess_store), rmbg_store)
+        """
+        window, stride, overlap = min(self.patch_size[0], frame_num), self.stride_size[0], self.overlap_size[0]
+        window_num = math.ceil((frame_num - window) / stride) + 1
+        chunks = iter(chunks)
+        buffer, buffer_start = None, 0
+        frame_sum, frame_count = None, 0
+        writers = None
+        if output_dir is not None:
+            os.makedirs(os.path.join(output_dir, 'bg'), exist_ok=True)
+            writers = [open_video_writer(os.path.join(output_dir, 'bg', 'bg.avi'), 30, store.shape[1:]),
+                       open_video_writer(os.path.join(output_dir, 'rmbg.avi'), 30, store.shape[1:])]
+
+        for i in tqdm(range(window_num)):
+            # same windows as crop_patches, the last one ends with the session
+            window_start = i * stride if i < window_num - 1 else frame_num - window
+            while buffer_start + (0 if buffer is None else len(buffer)) < window_start + window:
+                with timing.stage('load'):
+                    start, stop, frames = next(chunks)
+                    frames = np.asarray(frames, dtype=np.float32)
+                buffer = frames if buffer is None else np.concatenate([buffer, frames])
+                frame_sum = frames.sum(0, dtype=np.float64) if frame_sum is None else frame_sum + frames.sum(0, dtype=np.float64)
+                frame_count += len(frames)
+
+            # frames of this window kept by concat_patches
+            t_start = 0 if i == 0 else i * stride + overlap // 2
+            t_end = (i + 1) * stride + overlap // 2 if i < window_num - 1 else frame_num
+
+            timing.begin('crop_patches')
+            video_mean = (frame_sum / frame_count if mean is None else mean).astype(np.float32)
+            video = buffer[window_start - buffer_start:window_start - buffer_start + window] - video_mean
+            timing.end('crop_patches')
+            out_bg, out_neuron = self._infer(video, frames=t_end - t_start, verbose=False)
+
+            timing.begin('stitch')
+            out_bg = (out_bg[t_start - window_start:t_end - window_start] + video_mean).clip(0, 255)
+            out_neuron = out_neuron[t_start - window_start:t_end - window_start].clip(0, 255)
+            timing.end('stitch')
+
+            timing.begin('write')
+            store.write(t_start, out_neuron.astype(np.uint8))
+            if writers is not None:
+                for writer, frames in zip(writers, (out_bg, out_neuron)):
+                    for frame in frames.astype(np.uint8):
+                        writer.write(frame)
+            timing.end('write')
+
+            if i < window_num - 1:
+                next_start = (i + 1) * stride if i < window_num - 2 else frame_num - window
+                buffer = buffer[next_start - buffer_start:]
+                buffer_start = next_start
+
+        if writers is not None:
+            for writer in writers:
+                writer.release()
+        return frame_num
+
+    def _input_buffers(self, batch_size, patch_shape):
+        """Two reused (batch_size, C) + patch_shape float32 batches, pinned for the copy to the GPU."""
+        key = (batch_size, patch_shape)
+        if key not in self._buffers:
+            pin_memory = self.device.type == 'cuda' and torch.cuda.is_available()
+            self._buffers = {key: [torch.empty((batch_size, self.in_channels) + patch_shape, dtype=torch.float32,
+                                               pin_memory=pin_memory) for _ in range(2)]}
+        return self._buffers[key]
+
+    def _infer(self, video, frames=None, verbose=True):
+        """(bg, neuron) of a mean subtracted (T, H, W) video, cut in patches and stitched back.
+
+        A worker thread gathers the next batch of patches into the other input buffer while
+        the network runs on the current one, and the outputs are written straight to their
+        place in the stitched videos.
+        """
+        origin_shape = video.shape
+
+        # patch chopping
+        timing.begin('crop_patches')
+        regions = patch_regions(origin_shape, self.patch_size, self.stride_size)
+        patch_shape = tuple(s.stop - s.start for s in regions[0][0])
+        batch_size = min(self.batch_size, len(regions))
+        iter_num = math.ceil(len(regions) / batch_size)
+        buffers = self._input_buffers(batch_size, patch_shape)
+        out_bg = np.zeros(origin_shape, dtype=np.float16)
+        out_neuron = np.zeros(origin_shape, dtype=np.float16)
+        timing.end('crop_patches')
+
+        def gather(j):
+            batch = buffers[j % 2]
+            patches = batch.numpy()
+            batch_regions = regions[j * batch_size:(j + 1) * batch_size]
+            for k, (crop, _, _) in enumerate(batch_regions):
+                patches[k, 0] = video[crop]
+            return batch[:len(batch_regions)]
+
+        timing.begin('inference')
+        with ThreadPoolExecutor(max_workers=1) as pool, torch.inference_mode():
+            next_batch = pool.submit(gather, 0)
+            for j in tqdm(range(iter_num), desc='[Inference Video]', disable=not verbose):
+                input = next_batch.result()
+                # the buffer of batch j is refilled for batch j + 2, once its outputs are back
+                if j + 1 < iter_num:
+                    next_batch = pool.submit(gather, j + 1)
+                bg_patches, neuron_patches = self.forward(input)
+
+                bg_patches = bg_patches.squeeze(1).to(torch.float16).cpu().numpy()
+                neuron_patches = neuron_patches.squeeze(1).to(torch.float16).cpu().numpy()
+
+                # do the stitching
+                for k, (_, keep, stitch) in enumerate(regions[j * batch_size:(j + 1) * batch_size]):
+                    out_bg[stitch] = bg_patches[k][keep]
+                    out_neuron[stitch] = neuron_patches[k][keep]
+
+        timing.count(frames=frames if frames is not None else origin_shape[0])
+        timing.end('inference')
+        return out_bg, out_neuron
+
+
+def background_rejection(
+                         video,
+                         gsize = 6, # neuron radius
+                         ckpt_pth = '',
+                         patch_size ='(128, 128, 128)', # background rejection patch size
+                         stride_size = '(96, 96, 96)', # background rejection stride size
+                         batch_size = 4,
+                         device = 'cuda', # utilize GPU or CPU
+                         gpu_ids ='0', # GPU ids
+                         output_dir = '',
+                         in_channels = 1,
+                         out_channels = 1,
+                         f_maps = 32,
+                         store = None, # optional VideoStore receiving the rmbg frames instead of tifs
+                         store_offset = 0): # index of the first frame of this chunk in the store
+    """Background rejection of one video, loading the network for this call only.
+    Use an InferenceSession to process several chunks with the same network."""
+    session = InferenceSession(ckpt_pth, gsize=gsize, device=device, gpu_ids=gpu_ids, patch_size=patch_size,
+                               stride_size=stride_size, batch_size=batch_size, in_channels=in_channels,
+                               out_channels=out_channels, f_maps=f_maps)
+    return session.process(video, output_dir=output_dir, store=store, store_offset=store_offset)
@@ -4,6 +4,20 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 
+def ring_filter(x, weight):
+    """
+    F.conv2d(x, weight) of (N, 1, H + k - 1, W + k - 1) padded frames with a symmetric
+    (1, 1, k, k) kernel, computed through the FFT: the ring kernel is mostly zeros and
+    its dense convolution costs k^2 multiply-adds per pixel.
+    """
+    Hp, Wp = x.shape[-2:]
+    k = weight.shape[-1] - 1
+    # the kernel is symmetric, so its convolution is the correlation of conv2d, and the
+    # valid part of the circular convolution does not wrap around
+    out = torch.fft.irfft2(torch.fft.rfft2(x) * torch.fft.rfft2(weight, s=(Hp, Wp)), s=(Hp, Wp))
+    return out[..., k:, k:]
+
+
 class BG_Rejection(nn.Module):
     """
     Background Rejection Model.
@@ -32,7 +46,9 @@ class BG_Rejection(nn.Module):
 
         R = R / R.sum()  # normalization
 
-        self.ring_weight = torch.as_tensor(R, dtype=torch.float32).unsqueeze(0).unsqueeze(0)
+        # moved with the module, not in the checkpoints
+        self.register_buffer('ring_weight', torch.as_tensor(R, dtype=torch.float32).unsqueeze(0).unsqueeze(0),
+                             persistent=False)
 
         # ------------------neuron branch--------------------
         self.first_conv = nn.Conv3d(in_channels, f_maps, kernel_size=3, stride=1, padding=1)
@@ -72,7 +88,10 @@ class BG_Rejection(nn.Module):
         # background branch
         bg = x.permute(0, 2, 1, 3, 4).flatten(0, 1)  # (B*T, 1, H, W)
         bg = F.pad(bg, (self.padding_size, self.padding_size, self.padding_size, self.padding_size), mode='reflect')
-        bg = F.conv2d(bg, self.ring_weight.to(bg.device)) # convolve with the ring
+        if torch.onnx.is_in_onnx_export():
+            bg = F.conv2d(bg, self.ring_weight) # the ONNX exporter has no FFT
+        else:
+            bg = ring_filter(bg, self.ring_weight) # convolve with the ring
         bg = bg.reshape(B, T, -1, H, W).permute(0, 2, 1, 3, 4)  # (B, 1, T, H, W)
 
         if self.infer:
@@ -5,13 +5,19 @@ from torch.nn import init
 import cv2
 
 
-# save mc_video to avi format
-def save_video(video, fr, outpath, quality=97):
+# grayscale MJPG writer of (H, W) frames, for videos written frame by frame
+def open_video_writer(outpath, fr, shape, quality=97):
     fourcc = cv2.VideoWriter_fourcc(*'MJPG')
-    out = cv2.VideoWriter(outpath, fourcc, fr, (video[0].shape[1], video[0].shape[0]), isColor=False)
+    out = cv2.VideoWriter(outpath, fourcc, fr, (shape[1], shape[0]), isColor=False)
 
     # Set the quality (1-100, higher means better quality)
     out.set(cv2.VIDEOWRITER_PROP_QUALITY, quality)
+    return out
+
+
+# save mc_video to avi format
+def save_video(video, fr, outpath, quality=97):
+    out = open_video_writer(outpath, fr, video[0].shape[:2], quality)
 
     for frame in video:
         # Ensure each frame is grayscale and uint8 
@@ -51,6 +57,35 @@ def crop_patches(img, patch_size, stride_size):
                                w_start:w_start + patch_size[2]])
     return patches, patch_num
 
+# where every patch of crop_patches comes from and goes to, for patches stitched as they come
+def patch_regions(origin_shape, patch_size, stride_size):
+    """(crop, keep, stitch) slices of every patch, in the order of crop_patches: the part of
+    the video a patch is cut from, and the part of the patch concat_patches keeps with the
+    part of the output it is written to."""
+    overlap_size = [p - s for p, s in zip(patch_size, stride_size)]
+    assert overlap_size[0] % 2 == 0 and overlap_size[1] % 2 == 0 and overlap_size[2] % 2 == 0
+    patch_size = list(patch_size)
+    if origin_shape[0] < patch_size[0]:
+        patch_size[0] = origin_shape[0]
+    axes = []
+    for length, p, s, o in zip(origin_shape, patch_size, stride_size, overlap_size):
+        n = math.ceil((length - p) / s) + 1
+        regions = []
+        for i in range(n):
+            start = i * s if i < n - 1 else length - p
+            out_start = 0 if i == 0 else i * s + o // 2
+            out_end = (i + 1) * s + o // 2 if i < n - 1 else length
+            if i == 0:
+                keep = slice(0, p if n == 1 else p - o // 2)
+            elif i == n - 1:
+                keep = slice(p - (out_end - out_start), p)
+            else:
+                keep = slice(o // 2, p - o // 2)
+            regions.append((slice(start, start + p), keep, slice(out_start, out_end)))
+        axes.append(regions)
+    return [tuple(zip(t, h, w)) for t in axes[0] for h in axes[1] for w in axes[2]]
+
+
 # from patches to videos
 def concat_patches(patches, origin_shape, patch_num, patch_size, stride_size, overlap_size):
     assert overlap_size[0] % 2 == 0 and overlap_size[1] % 2 == 0 and overlap_size[2] % 2 == 0
@@ -0,0 +1,5 @@
+from .buffer import VideoBuffer
+from .ingest import FrameIngest, JpegFrames
+from .shifts import ShiftStore, ShiftedVideo
+from .store import VideoStore
+from .timing import StageProfiler
@@ -0,0 +1,82 @@
+import os
+import logging
+
+import numpy as np
+
+
+class VideoBuffer:
+    """Memory-mapped (T, H, W) working buffer for one stage of the pipeline.
+
+    The file is preallocated once from the frame count and filled in place, so a
+    stage never holds more than the chunk it is working on in RAM and the OS pages
+    frames in and out as needed. Indexing returns views of the memmap, which lets
+    downstream stages read time ranges and spatial windows without copying.
+
+    Args:
+        path: path of the raw memmap file
+        shape: (T, H, W) of the video
+        dtype: data type of the frames
+        mode: np.memmap mode, 'w+' creates (and overwrites) the file, 'r+'/'r' reopen it
+
+    Example:
+        video = VideoBuffer(os.path.join(tmp_dir, 'video.dat'), (T, H, W), np.uint8)
+        video[0:1000] = frames
+        patch = video[:, 0:500, 0:500]  # no copy
+        video.delete()
+    """
+
+    def __init__(self, path, shape, dtype, mode='w+'):
+        if mode == 'w+':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.array = np.memmap(path, dtype=dtype, mode=mode, shape=tuple(shape))
+
+    @property
+    def shape(self):
+        return self.array.shape
+
+    @property
+    def dtype(self):
+        return self.array.dtype
+
+    @property
+    def nbytes(self):
+        return self.array.nbytes
+
+    def __len__(self):
+        return self.array.shape[0]
+
+    def __getitem__(self, item):
+        return self.array[item]
+
+    def __setitem__(self, item, value):
+        self.array[item] = value
+
+    def __iter__(self):
+        return iter(self.array)
+
+    def __array__(self, dtype=None, copy=None):
+        return self.array if dtype is None else self.array.astype(dtype)
+
+    def chunks(self, chunk_size):
+        """Iterates over (start, stop, view) blocks of at most chunk_size frames."""
+        for start in range(0, len(self), chunk_size):
+            stop = min(start + chunk_size, len(self))
+            yield start, stop, self.array[start:stop]
+
+    def flush(self):
+        self.array.flush()
+
+    def delete(self):
+        """Drops the mapping and removes the file.
+
+        On Linux the disk space is released once the last view is gone; on Windows the
+        file is left in place if a view still maps it.
+        """
+        self.array = None
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        except PermissionError:
+            logging.warning(f'{self.path} is still mapped and was not removed')
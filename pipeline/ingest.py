@@ -0,0 +1,181 @@
+import os
+import time
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from . import timing
+from .buffer import VideoBuffer
+
+
+class FrameIngest:
+    """Streaming reader for the frame_{i}.jpg files of one session.
+
+    JPEGs are decoded straight to grayscale on a bounded thread pool (OpenCV releases
+    the GIL while decoding) into a preallocated (T, H, W) uint8 array or memmap.
+    Iterating over the object yields fixed-size chunks as soon as they are decoded,
+    while up to `prefetch` further chunks are already being read in the background.
+
+    Args:
+        data_path: directory holding frame_0.jpg ... frame_{T-1}.jpg
+        frame_num: number of frames T to read
+        chunk_size: number of frames per yielded chunk
+        n_threads: number of decoding threads
+        prefetch: number of chunks decoded ahead of the consumer
+        out: optional preallocated (T, H, W) uint8 array or VideoBuffer. If a str is
+            given, a VideoBuffer is created at that path.
+        file_pattern: file name template of a frame
+
+    Example:
+        ingest = FrameIngest(data_path, frame_num, chunk_size=1000)
+        for start, stop, chunk in ingest:
+            ...  # chunk is a view of ingest.video[start:stop]
+    """
+
+    def __init__(self, data_path, frame_num, chunk_size=1000, n_threads=8, prefetch=2,
+                 out=None, file_pattern='frame_{}.jpg'):
+        self.data_path = data_path
+        self.frame_num = frame_num
+        self.chunk_size = chunk_size
+        self.n_threads = max(1, n_threads)
+        self.prefetch = max(0, prefetch)
+        self.file_pattern = file_pattern
+        self.fps = None
+        self.max_fps = None
+        self._busy = 0.
+        self._lock = threading.Lock()
+        self._file_sizes = np.zeros(frame_num, dtype=np.int64)
+
+        # the first frame gives the frame size, it is not decoded again when iterating
+        t0 = time.perf_counter()
+        first = self._imread(0)
+        self._first_busy = time.perf_counter() - t0
+        shape = (frame_num,) + first.shape
+        if out is None:
+            out = np.empty(shape, dtype=np.uint8)
+        elif isinstance(out, str):
+            out = VideoBuffer(out, shape, np.uint8)
+        if out.shape != shape or out.dtype != np.uint8:
+            raise ValueError(f'Output array must be uint8 with shape {shape}, got {out.dtype} {out.shape}')
+        self.video = out
+        self.video[0] = first
+
+    def frame_path(self, i):
+        return os.path.join(self.data_path, self.file_pattern.format(i))
+
+    def _imread(self, i):
+        path = self.frame_path(i)
+        try:
+            buf = np.fromfile(path, dtype=np.uint8)
+        except OSError:
+            raise IOError(f'Failed to read {path}')
+        img = cv2.imdecode(buf, cv2.IMREAD_GRAYSCALE)
+        if img is None:
+            raise IOError(f'Failed to decode {path}')
+        self._file_sizes[i] = buf.size
+        return img
+
+    def _decode(self, i):
+        t0 = time.perf_counter()
+        img = self._imread(i)
+        if img.shape != self.video.shape[1:]:
+            raise ValueError(f'{self.frame_path(i)} has shape {img.shape}, expected {self.video.shape[1:]}')
+        self.video[i] = img
+        with self._lock:
+            self._busy += time.perf_counter() - t0
+
+    def __len__(self):
+        return -(-self.frame_num // self.chunk_size)
+
+    def __iter__(self):
+        """Yields (start, stop, chunk) with chunk a view of self.video[start:stop]."""
+        starts = iter(range(0, self.frame_num, self.chunk_size))
+        pending = deque()
+        pool = ThreadPoolExecutor(max_workers=self.n_threads)
+
+        def submit():
+            start = next(starts, None)
+            if start is not None:
+                stop = min(start + self.chunk_size, self.frame_num)
+                pending.append((start, stop, [pool.submit(self._decode, i) for i in range(max(start, 1), stop)]))
+
+        t0 = time.perf_counter()
+        t_wait = 0.
+        self._busy = self._first_busy
+        try:
+            for _ in range(self.prefetch + 1):
+                submit()
+            while pending:
+                start, stop, futures = pending.popleft()
+                t1 = time.perf_counter()
+                for future in futures:
+                    future.result()
+                t_wait += time.perf_counter() - t1
+                timing.count(frames=stop - start, bytes_read=self._file_sizes[start:stop].sum())
+                submit()
+                yield start, stop, self.video[start:stop]
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+        # measured throughput, and the one of the decoders if all the threads were busy all the time
+        elapsed = time.perf_counter() - t0
+        self.fps = self.frame_num / max(elapsed, 1e-9)
+        self.max_fps = self.frame_num * self.n_threads / max(self._busy, 1e-9)
+        logging.info(f'Read {self.frame_num} frames in {elapsed:.1f} s ({self.fps:.1f} frames/s), '
+                     f'at most {self.max_fps:.1f} frames/s with {self.n_threads} busy decoding threads, '
+                     f'consumer waited {t_wait:.1f} s for frames')
+
+    def read_all(self):
+        """Decodes the whole session and returns the (T, H, W) array."""
+        for _ in self:
+            pass
+        return self.video
+
+
+class JpegFrames:
+    """Read-only (T, H, W) uint8 view of the frame_{i}.jpg files, decoded when indexed.
+
+    Nothing is kept in memory, so a stage that only needs some frames of a finished
+    session (e.g. ShiftedVideo.from_session) reads them straight from the acquisition.
+
+    Args:
+        data_path: directory holding frame_0.jpg ... frame_{T-1}.jpg
+        frame_num: number of frames T
+        file_pattern: file name template of a frame
+
+    Example:
+        frames = JpegFrames(data_path, frame_num)
+        chunk = frames[1000:1100]
+    """
+
+    def __init__(self, data_path, frame_num, file_pattern='frame_{}.jpg'):
+        self.data_path = data_path
+        self.file_pattern = file_pattern
+        self.shape = (frame_num,) + self._imread(0).shape
+        self.dtype = np.dtype(np.uint8)
+
+    def _imread(self, i):
+        path = os.path.join(self.data_path, self.file_pattern.format(i))
+        img = cv2.imdecode(np.fromfile(path, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+        if img is None:
+            raise IOError(f'Failed to decode {path}')
+        return img
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, item):
+        if isinstance(item, tuple):
+            return self[item[0]][(slice(None),) * np.ndim(np.arange(len(self))[item[0]]) + item[1:]]
+        idx = np.arange(len(self))[item]
+        if np.ndim(idx) == 0:
+            return self._imread(int(idx))
+        frames = np.empty((len(idx),) + self.shape[1:], dtype=np.uint8)
+        for k, i in enumerate(idx):
+            frames[k] = self._imread(i)
+        timing.count(bytes_read=frames.nbytes)
+        return frames
@@ -0,0 +1,276 @@
+import collections
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from caiman.motion_correction import (RegistrationPlan, apply_shift_iteration, apply_shifts_batch, bin_median,
+                                      high_pass_filter_space, register_frames, tile_and_correct)
+from preprocessing.pick_broken_frame import detect_broken_frames
+
+from . import timing
+from .store import VideoStore
+
+
+class OnlineMotionCorrection:
+    """Motion correction of a session while it is being acquired.
+
+    Watches data_path for frame_0.jpg, frame_1.jpg, ... and corrects every frame as soon
+    as it is written, so motion correction is done when the acquisition ends. A frame is
+    taken once the next one exists or its file has not changed for settle_time seconds.
+
+    The first init_frames frames give the template (median of the frames rigidly aligned
+    to their median). It is then refreshed every template_update frames with the median of
+    the means of the last template_blocks blocks of corrected frames, as the running
+    template of caiman's motion_correct_online. Frames are registered pw-rigid with
+    tile_and_correct, like normcorre_function, with a RegistrationPlan rebuilt whenever the
+    template changes, and the shifts of a batch are applied at once by apply_shifts_batch.
+
+    Bad frames are replaced by the previous good frame (the next one at the start of the
+    session). Corrected frames are appended to the VideoStore at store_path and, if
+    buffer_path is given, to a raw float32 file that can be opened as a VideoBuffer.
+
+    Args:
+        data_path: acquisition directory
+        store_path: path of the .h5 VideoStore of the corrected frames
+        max_shifts, strides, overlaps, max_deviation_rigid, gSig_filt, border_nan:
+            motion correction parameters, as for MotionCorrect
+        buffer_path: optional raw float32 (T, H, W) file of the corrected frames
+        frame_num: number of frames of the session if known, otherwise the acquisition
+            is over once no frame arrived for idle_timeout seconds
+        init_frames: number of frames of the first template
+        template_update: number of frames between two updates of the template
+        template_blocks: number of blocks of frames whose means give the template
+        batch_size: maximum number of frames corrected at once
+        n_threads: number of threads correcting the frames of a batch
+        detect_bad_frames: replace the broken frames (detect_broken_frames)
+        poll_interval: seconds between two looks at the directory when no frame is ready
+        settle_time: seconds without change after which the last file is complete
+        idle_timeout: seconds without a new frame after which the acquisition is over
+        file_pattern: file name template of a frame
+
+    Example:
+        online_mc = OnlineMotionCorrection(data_path, os.path.join(mc_out, 'mc.h5'), max_shifts,
+                                           strides, overlaps, max_deviation_rigid,
+                                           buffer_path=os.path.join(tmp_out, 'mc.dat'))
+        frame_num = online_mc.run()
+        video = VideoBuffer(os.path.join(tmp_out, 'mc.dat'), (frame_num,) + online_mc.dims, np.float32, mode='r+')
+    """
+
+    def __init__(self, data_path, store_path, max_shifts, strides, overlaps, max_deviation_rigid,
+                 gSig_filt=(6, 6), border_nan='copy', buffer_path=None, frame_num=None, init_frames=200,
+                 template_update=200, template_blocks=10, batch_size=32, n_threads=8, detect_bad_frames=True,
+                 poll_interval=0.2, settle_time=1.0, idle_timeout=60., file_pattern='frame_{}.jpg'):
+        self.data_path = data_path
+        self.store_path = store_path
+        self.buffer_path = buffer_path
+        self.max_shifts = tuple(max_shifts)
+        self.strides = tuple(strides)
+        self.overlaps = tuple(overlaps)
+        self.max_deviation_rigid = max_deviation_rigid
+        self.gSig_filt = gSig_filt
+        self.border_nan = border_nan
+        self.frame_num = frame_num
+        self.init_frames = init_frames
+        self.template_update = template_update
+        self.batch_size = batch_size
+        self.n_threads = max(1, n_threads)
+        self.detect_bad_frames = detect_bad_frames
+        self.poll_interval = poll_interval
+        self.settle_time = settle_time
+        self.idle_timeout = idle_timeout
+        self.file_pattern = file_pattern
+
+        self.dims = None
+        self.template = None
+        self.plan = None
+        self.add_to_movie = 0.
+        self.shifts_rig = []
+        self.bad_frames = []
+        self._blocks = collections.deque(maxlen=template_blocks)
+        self._block_sum = None
+        self._block_count = 0
+        self._last_good = None
+        self._pending = []  # frames not corrected yet, before the first template
+        self._store = None
+        self._buffer = None
+
+    def frame_path(self, i):
+        return os.path.join(self.data_path, self.file_pattern.format(i))
+
+    def _ready(self, i):
+        """Whether frame i is completely written."""
+        path = self.frame_path(i)
+        if not os.path.exists(path):
+            return False
+        if os.path.exists(self.frame_path(i + 1)):
+            return True
+        return time.time() - os.path.getmtime(path) > self.settle_time
+
+    def _imread(self, i):
+        path = self.frame_path(i)
+        img = cv2.imdecode(np.fromfile(path, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+        if img is None:
+            raise IOError(f'Failed to decode {path}')
+        return img
+
+    def run(self):
+        """Corrects the frames until the acquisition is over. Returns the number of frames."""
+        next_frame = 0
+        last_arrival = time.time()
+        t0 = time.perf_counter()
+        self._store = None
+        with ThreadPoolExecutor(max_workers=self.n_threads) as pool:
+            while self.frame_num is None or next_frame < self.frame_num:
+                ready = []
+                while len(ready) < self.batch_size and (self.frame_num is None or next_frame + len(ready) < self.frame_num) \
+                        and self._ready(next_frame + len(ready)):
+                    ready.append(next_frame + len(ready))
+                if not ready:
+                    if time.time() - last_arrival > self.idle_timeout:
+                        logging.info(f'No new frame for {self.idle_timeout} s, acquisition over')
+                        break
+                    time.sleep(self.poll_interval)
+                    continue
+                last_arrival = time.time()
+                with timing.stage('read'):
+                    frames = list(pool.map(self._imread, ready))
+                    timing.count(frames=len(frames))
+                self._add(np.stack(frames), pool)
+                next_frame += len(ready)
+            # a session shorter than init_frames
+            if self._pending:
+                self._initialize()
+                self._correct(np.stack(self._pending), pool)
+                self._pending = []
+        self.close()
+        logging.info(f'Online motion correction of {next_frame} frames in {time.perf_counter() - t0:.1f} s, '
+                     f'{len(self.bad_frames)} bad frames replaced')
+        return next_frame
+
+    def _add(self, frames, pool):
+        if self.dims is None:
+            self.dims = frames.shape[1:]
+        if self.detect_bad_frames:
+            with timing.stage('bad_frames'):
+                flags = detect_broken_frames(frames)
+            start = len(self.shifts_rig) + len(self._pending)
+            for k in np.flatnonzero(flags):
+                self.bad_frames.append(start + k)
+                logging.info(f'Broken frame detected at frame_{start + k}.jpg')
+            good = np.flatnonzero(~flags)
+            for k in range(len(frames)):
+                if flags[k]:
+                    # previous good frame, the next one if there is none yet
+                    previous = good[good < k]
+                    if len(previous):
+                        frames[k] = frames[previous[-1]]
+                    elif self._last_good is not None:
+                        frames[k] = self._last_good
+                    elif len(good):
+                        frames[k] = frames[good[0]]
+            if len(good):
+                self._last_good = frames[good[-1]].copy()
+        if self.template is None:
+            self._pending += list(frames)
+            if len(self._pending) >= self.init_frames:
+                self._initialize()
+                frames = np.stack(self._pending)
+                self._pending = []
+            else:
+                return
+        self._correct(frames, pool)
+
+    def _initialize(self):
+        """First template, from the frames received so far."""
+        with timing.stage('template'):
+            init = np.stack(self._pending).astype(np.float32)
+            if self.gSig_filt is not None:
+                self.add_to_movie = -np.min([high_pass_filter_space(img, self.gSig_filt) for img in init])
+            else:
+                self.add_to_movie = -init.min()
+            template = bin_median(init)
+            if self.gSig_filt is not None:
+                template = high_pass_filter_space(template, self.gSig_filt)
+            shifts = register_frames(init, template, self.max_shifts, add_to_movie=self.add_to_movie,
+                                     gSig_filt=self.gSig_filt)
+            aligned = np.stack([apply_shift_iteration(img, shift, border_nan=self.border_nan)
+                                for img, shift in zip(init, shifts)])
+            self._set_template(bin_median(aligned))
+
+    def _set_template(self, template):
+        if self.gSig_filt is not None:
+            template = high_pass_filter_space(template, self.gSig_filt)
+        self.template = template
+        self.plan = RegistrationPlan(template, strides=self.strides, overlaps=self.overlaps,
+                                     add_to_movie=np.float32(self.add_to_movie))
+
+    def _correct(self, frames, pool):
+        with timing.stage('correct'):
+            imgs = np.asarray(frames, dtype=np.float32)
+            rigid_shts = register_frames(imgs, self.template, self.max_shifts, add_to_movie=self.add_to_movie,
+                                         gSig_filt=self.gSig_filt, plan=self.plan)
+            template, plan = self.template, self.plan
+
+            def estimate(k):
+                _, shifts, _, _, rigid_shift = tile_and_correct(
+                    imgs[k], template, self.strides, self.overlaps, self.max_shifts,
+                    add_to_movie=self.add_to_movie, upsample_factor_fft=10, show_movie=False,
+                    max_deviation_rigid=self.max_deviation_rigid, shifts_opencv=True, gSig_filt=self.gSig_filt,
+                    border_nan=self.border_nan, return_rigid_shift=True, rigid_shts=rigid_shts[k], plan=plan,
+                    apply_shifts=False)
+                return shifts, rigid_shift
+
+            results = list(pool.map(estimate, range(len(imgs))))
+            self.shifts_rig += [rigid_shift for _, rigid_shift in results]
+            # the filtered frames are registered, the raw ones corrected, as in tile_and_correct_wrapper
+            offset = 0 if self.gSig_filt is not None else self.add_to_movie
+            if self.max_deviation_rigid == 0:
+                corrected = apply_shifts_batch(imgs, shifts_rig=[shifts for shifts, _ in results],
+                                               border_nan=self.border_nan, add_to_movie=offset,
+                                               out_offset=self.add_to_movie)
+            else:
+                corrected = apply_shifts_batch(imgs, x_shifts_els=[[sh[0] for sh in shifts] for shifts, _ in results],
+                                               y_shifts_els=[[sh[1] for sh in shifts] for shifts, _ in results],
+                                               dims_grid=tuple(np.add(plan.xy_grid[-1], 1)), add_to_movie=offset,
+                                               out_offset=self.add_to_movie)
+            # nonneg_movie of MotionCorrect
+            corrected += np.float32(self.add_to_movie)
+
+        with timing.stage('write'):
+            if self._store is None:
+                self._store = VideoStore.create(self.store_path, (0,) + tuple(self.dims), np.uint8, resizable=True)
+                if self.buffer_path is not None:
+                    os.makedirs(os.path.dirname(os.path.abspath(self.buffer_path)), exist_ok=True)
+                    self._buffer = open(self.buffer_path, 'wb')
+            self._store.append(corrected)
+            if self._buffer is not None:
+                # a raw memmap is the frames one after the other, appending keeps it valid
+                self._buffer.write(corrected.tobytes())
+
+        self._update_template(corrected)
+
+    def _update_template(self, corrected):
+        """Running template, updated every template_update frames."""
+        for start in range(0, len(corrected), self.template_update):
+            block = corrected[start:start + self.template_update - self._block_count]
+            block_sum = block.sum(0, dtype=np.float64)
+            self._block_sum = block_sum if self._block_sum is None else self._block_sum + block_sum
+            self._block_count += len(block)
+            if self._block_count >= self.template_update:
+                self._blocks.append(self._block_sum / self._block_count)
+                self._block_sum, self._block_count = None, 0
+                with timing.stage('template'):
+                    self._set_template(np.median(np.stack(self._blocks), 0).astype(np.float32) - np.float32(self.add_to_movie))
+            if start + len(block) >= len(corrected):
+                break
+
+    def close(self):
+        if self._store is not None:
+            self._store.close()
+        if self._buffer is not None:
+            self._buffer.close()
+            self._buffer = None
@@ -0,0 +1,191 @@
+import os
+
+import h5py
+import numpy as np
+
+from . import timing
+from .ingest import JpegFrames
+
+
+class ShiftStore:
+    """Motion correction shifts of a session, stored instead of the corrected frames.
+
+    Per frame, the rigid shift ('shifts_rig', (T, 2)) and the shift of every pw-rigid
+    patch ('x_shifts_els', 'y_shifts_els', (T, num_patches)) as found by MotionCorrect,
+    and the raw frame it is read from ('frame_index', a bad frame points to the good
+    frame that replaced it). With the raw frames this is all ShiftedVideo needs to
+    recompute the motion corrected video, for a few MB instead of a float32 copy of the
+    session.
+
+    Args:
+        path: path of the .h5 file
+        mode: h5py file mode, 'r' to read, 'r+' to keep writing
+
+    Example:
+        shifts = ShiftStore.create(os.path.join(mc_out, 'shifts.h5'), frame_num, (H, W))
+        normcorre_function(chunk, ..., persist='shifts', shift_store=shifts, shift_offset=start)
+        video = ShiftedVideo(raw_video, shifts)
+    """
+
+    def __init__(self, path, mode='r'):
+        self.path = path
+        self.file = h5py.File(path, mode)
+
+    @classmethod
+    def create(cls, path, frame_num, dims):
+        """Creates an empty store for frame_num frames of size dims, overwriting any existing file."""
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with h5py.File(path, 'w') as f:
+            f.create_dataset('shifts_rig', shape=(frame_num, 2), dtype=np.float32)
+            f.create_dataset('frame_index', data=np.arange(frame_num, dtype=np.int64))
+            f.attrs['dims'] = tuple(dims)
+            f.attrs['completed_frames'] = 0
+        return cls(path, mode='r+')
+
+    def __len__(self):
+        return self.file['shifts_rig'].shape[0]
+
+    @property
+    def completed(self):
+        return int(self.file.attrs['completed_frames'])
+
+    @property
+    def frame_index(self):
+        return self.file['frame_index'][:]
+
+    def write(self, start, mc):
+        """Writes the shifts of a MotionCorrect object whose movie starts at frame `start`."""
+        shifts_rig = np.asarray(mc.shifts_rig, dtype=np.float32)
+        stop = start + len(shifts_rig)
+        self.file['shifts_rig'][start:stop] = shifts_rig
+        nbytes = shifts_rig.nbytes
+        if getattr(mc, 'x_shifts_els', None):
+            for name in ('x_shifts_els', 'y_shifts_els'):
+                shifts = np.asarray(getattr(mc, name), dtype=np.float32)
+                if name not in self.file:
+                    self.file.create_dataset(name, shape=(len(self), shifts.shape[1]), dtype=np.float32)
+                self.file[name][start:stop] = shifts
+                nbytes += shifts.nbytes
+        # what apply_shifts_movie needs to lay out the patches and the borders
+        self.file.attrs.update(strides=tuple(mc.strides), overlaps=tuple(mc.overlaps),
+                               border_nan=mc.border_nan, shifts_opencv=mc.shifts_opencv,
+                               downsample_factor=mc.downsample_factor)
+        if start <= self.completed:
+            self.file.attrs['completed_frames'] = max(self.completed, stop)
+        timing.count(bytes_written=nbytes)
+
+    def write_frame_index(self, frame_index):
+        """Raw frame read for every frame, e.g. after bad frames were replaced by good ones."""
+        self.file['frame_index'][:] = frame_index
+
+    def motion_correct(self):
+        """MotionCorrect object holding the shifts, to apply them with apply_shifts_movie."""
+        from caiman.motion_correction import MotionCorrect  # caiman imports this package
+        attrs = self.file.attrs
+        border_nan = attrs['border_nan']
+        mc = MotionCorrect([], strides=tuple(attrs['strides']), overlaps=tuple(attrs['overlaps']),
+                           shifts_opencv=bool(attrs['shifts_opencv']),
+                           border_nan=bool(border_nan) if isinstance(border_nan, np.bool_) else border_nan,
+                           downsample_factor=int(attrs['downsample_factor']))
+        mc.shifts_rig = self.file['shifts_rig'][:]
+        mc.pw_rigid = 'x_shifts_els' in self.file
+        if mc.pw_rigid:
+            mc.x_shifts_els = self.file['x_shifts_els'][:]
+            mc.y_shifts_els = self.file['y_shifts_els'][:]
+        return mc
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        if self.file.id.valid:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ShiftedVideo:
+    """Motion corrected (T, H, W) video computed when it is read, from the raw frames and their shifts.
+
+    Indexing reads the raw frames, applies their shifts with MotionCorrect.apply_shifts_movie
+    and returns float32 frames, the same as the pw-rigid movie of normcorre_function, so the
+    next stage streams the corrected frames without them ever being written.
+
+    Args:
+        source: (T, H, W) raw frames, e.g. VideoBuffer, VideoStore or JpegFrames
+        shifts: ShiftStore, or path of one
+        chunk_size: number of frames corrected at once when iterating
+
+    Example:
+        video = ShiftedVideo(raw_video, shifts)
+        for start, stop, frames in video.chunks(1000):
+            ...
+        # or from the files of a finished session, e.g. to inspect its motion correction
+        video = ShiftedVideo.from_session(os.path.join(out_path, 'mc'), data_path)
+    """
+
+    def __init__(self, source, shifts, chunk_size=100):
+        if isinstance(shifts, str):
+            shifts = ShiftStore(shifts)
+        if shifts.completed < len(shifts):
+            raise ValueError(f'{shifts.path} only has the shifts of {shifts.completed} of {len(shifts)} frames')
+        self.source = source
+        self.shifts = shifts
+        self.chunk_size = chunk_size
+        self.frame_index = shifts.frame_index
+        self.mc = shifts.motion_correct()
+
+    @classmethod
+    def from_session(cls, mc_out, data_path, **kwargs):
+        """Corrected video of a session from its mc/shifts.h5 and its frame_{i}.jpg files."""
+        shifts = ShiftStore(os.path.join(mc_out, 'shifts.h5'))
+        return cls(JpegFrames(data_path, len(shifts)), shifts, **kwargs)
+
+    @property
+    def shape(self):
+        return (len(self.frame_index),) + tuple(self.source.shape[1:])
+
+    @property
+    def dtype(self):
+        return np.dtype(np.float32)
+
+    def __len__(self):
+        return len(self.frame_index)
+
+    def correct(self, idx):
+        """(n, H, W) corrected frames idx."""
+        idx = np.asarray(idx, dtype=np.int64)
+        if len(idx) == 0:
+            return np.zeros((0,) + self.shape[1:], dtype=np.float32)
+        raw_idx = self.frame_index[idx]
+        if np.all(np.diff(raw_idx) == 1):
+            raw = np.asarray(self.source[raw_idx[0]:raw_idx[-1] + 1])
+        else:
+            raw = np.stack([np.asarray(self.source[i]) for i in raw_idx])
+        return np.asarray(self.mc.apply_shifts_movie(raw, remove_min=False, frame_idx=idx), dtype=np.float32)
+
+    def __getitem__(self, item):
+        if not isinstance(item, tuple):
+            item = (item,)
+        idx = np.arange(len(self))[item[0]]
+        if np.ndim(idx) == 0:
+            return self.correct([idx])[0][item[1:]]
+        return self.correct(idx)[(slice(None),) + item[1:]]
+
+    def chunks(self, chunk_size=None):
+        """Iterates over (start, stop, frames) blocks of at most chunk_size frames."""
+        chunk_size = chunk_size or self.chunk_size
+        for start in range(0, len(self), chunk_size):
+            stop = min(start + chunk_size, len(self))
+            yield start, stop, self.correct(np.arange(start, stop))
+
+    def __iter__(self):
+        for _, _, frames in self.chunks():
+            yield from frames
+
+    def close(self):
+        self.shifts.close()
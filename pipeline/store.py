@@ -0,0 +1,139 @@
+import os
+
+import h5py
+import numpy as np
+
+from . import timing
+
+
+class VideoStore:
+    """Chunked, compressed (T, H, W) video container, one HDF5 file per stage.
+
+    The dataset is chunked along time and tiled in space, so a time range of full
+    frames and a spatial window over the whole session can both be read with a single
+    call without touching the rest of the file. The number of frames written so far is
+    kept in the file metadata, which lets a later run check how far a stage got without
+    reading any frame.
+
+    Args:
+        path: path of the .h5 file
+        mode: h5py file mode, 'r' to read, 'r+' to keep writing
+
+    Example:
+        with VideoStore.create(path, (T, H, W), np.uint8) as store:
+            store.write(0, frames)
+        frames = VideoStore(path)[100:200, 0:500, 0:500]
+    """
+    dataset_name = 'video'
+
+    def __init__(self, path, mode='r'):
+        self.path = path
+        self.file = h5py.File(path, mode)
+        self.dataset = self.file[self.dataset_name]
+
+    @classmethod
+    def create(cls, path, shape, dtype=np.uint8, chunks=(16, 256, 256), compression='lzf', resizable=False, **attrs):
+        """Creates an empty store, overwriting any existing file.
+
+        Args:
+            path: path of the .h5 file
+            shape: (T, H, W) of the video
+            dtype: data type of the frames
+            chunks: chunk shape (time, height, width), clipped to the video shape
+            compression: h5py compression filter, 'lzf' is fast enough to not slow down writing
+            resizable: let append() grow the video past T frames, e.g. T = 0 while the
+                session is still being acquired
+            attrs: extra metadata saved with the video
+
+        Returns:
+            VideoStore opened in 'r+' mode.
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        maxshape = (None,) + tuple(shape[1:]) if resizable else None
+        # the final length of a resizable video is not known, only the frame size clips its chunks
+        chunks = tuple(int(max(1, min(c, s) if s is not None else c))
+                       for c, s in zip(chunks, maxshape or shape))
+        with h5py.File(path, 'w') as f:
+            dataset = f.create_dataset(cls.dataset_name, shape=tuple(shape), dtype=dtype,
+                                       chunks=chunks, compression=compression, maxshape=maxshape)
+            dataset.attrs['completed_frames'] = 0
+            for key, value in attrs.items():
+                dataset.attrs[key] = value
+        return cls(path, mode='r+')
+
+    @staticmethod
+    def completed_frames(path):
+        """Number of frames written to the store at path, 0 if it does not exist."""
+        if not os.path.exists(path):
+            return 0
+        try:
+            with h5py.File(path, 'r') as f:
+                return int(f[VideoStore.dataset_name].attrs['completed_frames'])
+        except (OSError, KeyError):
+            # unfinished or foreign file
+            return 0
+
+    @property
+    def shape(self):
+        return self.dataset.shape
+
+    @property
+    def dtype(self):
+        return self.dataset.dtype
+
+    @property
+    def attrs(self):
+        return self.dataset.attrs
+
+    @property
+    def completed(self):
+        return int(self.dataset.attrs['completed_frames'])
+
+    def __len__(self):
+        return self.dataset.shape[0]
+
+    def write(self, start, frames):
+        """Writes a (n, H, W) block of frames starting at frame `start`."""
+        frames = np.asarray(frames)
+        stop = start + frames.shape[0]
+        self.dataset[start:stop] = frames.astype(self.dataset.dtype, copy=False)
+        timing.count(bytes_written=frames.shape[0] * np.prod(self.shape[1:]) * self.dtype.itemsize)
+        # only count frames written contiguously from the beginning
+        if start <= self.completed:
+            self.dataset.attrs['completed_frames'] = max(self.completed, stop)
+
+    def append(self, frames):
+        """Writes a (n, H, W) block after the completed frames, growing a resizable store if needed."""
+        start = self.completed
+        stop = start + len(frames)
+        if stop > self.shape[0]:
+            self.dataset.resize(stop, axis=0)
+        self.write(start, frames)
+
+    def read(self, t=slice(None), y=slice(None), x=slice(None)):
+        """Reads a time range and spatial window, e.g. read(slice(0, 100), slice(0, 500))."""
+        return self.__getitem__((t, y, x))
+
+    def __getitem__(self, item):
+        frames = self.dataset[item]
+        timing.count(bytes_read=np.asarray(frames).nbytes)
+        return frames
+
+    def chunks(self, chunk_size):
+        """Iterates over (start, stop, frames) blocks of at most chunk_size frames."""
+        for start in range(0, self.shape[0], chunk_size):
+            stop = min(start + chunk_size, self.shape[0])
+            yield start, stop, self[start:stop]
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        if self.file.id.valid:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,217 @@
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+def max_rss_mb(children=False):
+    """High-water mark of resident memory so far, in MB, or None if it cannot be measured.
+
+    Of this process, or with children=True of its largest child process that has exited
+    (getrusage RUSAGE_CHILDREN). The mark never goes down.
+    """
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+    if psutil is not None and not children:
+        info = psutil.Process().memory_info()
+        return getattr(info, 'peak_wset', info.rss) / 1024 ** 2
+    return None
+
+
+def tree_rss_mb():
+    """Current resident memory of this process and all its child processes (MC cluster,
+    segmentation pools...), in MB, or None without psutil. Pages shared between the
+    processes (shared memory, memmaps) are counted once per process."""
+    if psutil is None:
+        return None
+    try:
+        process = psutil.Process()
+        rss = process.memory_info().rss
+        children = process.children(recursive=True)
+    except psutil.Error:
+        return None
+    for child in children:
+        try:
+            rss += child.memory_info().rss
+        except psutil.Error:  # exited meanwhile
+            pass
+    return rss / 1024 ** 2
+
+
+class StageProfiler:
+    """Wall time, counters and memory of the stages of one pipeline run.
+
+    Stages nest: a stage opened inside another is recorded as 'outer/inner'. A stage
+    entered several times (e.g. once per chunk) is accumulated under the same name,
+    with the number of calls. Counters (frames, bytes read and written) go to the
+    innermost open stage and can be added from worker threads.
+
+    Memory, per stage and over all its calls:
+        stage_peak_rss_mb: highest resident memory of this process and its children
+            sampled while the stage was open (every sample_interval s, psutil only)
+        maxrss_growth_mb: how much the stage raised the high-water marks of this process
+            and of its exited children, 0 if an earlier stage had already used more
+
+    Args:
+        sample_interval: seconds between two memory samples
+
+    Library code does not hold a profiler: it calls the module level stage(), begin(),
+    end() and count(), which record into the active profiler and do nothing otherwise.
+
+    Example:
+        profiler = StageProfiler()
+        activate(profiler)
+        with stage('mc'):
+            ...
+            count(frames=len(chunk), bytes_written=chunk.nbytes)
+        profiler.dump(os.path.join(out_path, 'timings.json'))
+    """
+
+    counters = ('frames', 'bytes_read', 'bytes_written')
+
+    def __init__(self, sample_interval=0.2):
+        self.stages = {}
+        self.start_time = time.time()
+        self.sample_interval = sample_interval
+        self._stack = []
+        self._lock = threading.Lock()
+        self._sampler = None
+        self._stop_sampling = threading.Event()
+
+    @staticmethod
+    def _maxrss():
+        marks = [max_rss_mb(), max_rss_mb(children=True)]
+        return None if None in marks else sum(marks)
+
+    def _sample(self):
+        rss = tree_rss_mb()
+        if rss is None:
+            return
+        with self._lock:
+            for _, path, _, _ in self._stack:
+                record = self.stages[path]
+                record['stage_peak_rss_mb'] = max(record['stage_peak_rss_mb'] or 0, rss)
+
+    def _sample_loop(self):
+        while not self._stop_sampling.wait(self.sample_interval):
+            self._sample()
+
+    def begin(self, name):
+        with self._lock:
+            path = '/'.join([entry[0] for entry in self._stack] + [name])
+            self._stack.append((name, path, time.perf_counter(), self._maxrss()))
+            if path not in self.stages:
+                self.stages[path] = dict(calls=0, seconds=0.0, stage_peak_rss_mb=None, maxrss_growth_mb=None,
+                                         **{key: 0 for key in self.counters})
+        self._sample()
+        # one sampling thread while any stage is open
+        if psutil is not None and self._sampler is None:
+            self._stop_sampling.clear()
+            self._sampler = threading.Thread(target=self._sample_loop, name='StageProfiler', daemon=True)
+            self._sampler.start()
+
+    def end(self, name=None):
+        self._sample()
+        with self._lock:
+            stage_name, path, start, maxrss = self._stack.pop()
+            if name is not None and name != stage_name:
+                self._stack.append((stage_name, path, start, maxrss))
+                raise RuntimeError(f'stage {name} ended while {stage_name} is open')
+            record = self.stages[path]
+            record['calls'] += 1
+            record['seconds'] += time.perf_counter() - start
+            if maxrss is not None:
+                record['maxrss_growth_mb'] = (record['maxrss_growth_mb'] or 0) + self._maxrss() - maxrss
+            stack_empty = not self._stack
+        if stack_empty and self._sampler is not None:
+            self._stop_sampling.set()
+            self._sampler.join()
+            self._sampler = None
+
+    @contextmanager
+    def stage(self, name):
+        self.begin(name)
+        try:
+            yield self
+        finally:
+            self.end(name)
+
+    def count(self, **counts):
+        """Adds to the counters of the innermost open stage, e.g. count(frames=100)."""
+        if not self._stack:
+            return
+        with self._lock:
+            record = self.stages[self._stack[-1][1]]
+            for key, value in counts.items():
+                record[key] += int(value)
+
+    def report(self):
+        """Machine readable summary, with throughput for the stages that counted frames."""
+        stages = {}
+        for path, record in self.stages.items():
+            record = dict(record)
+            if record['frames'] and record['seconds'] > 0:
+                record['fps'] = record['frames'] / record['seconds']
+            stages[path] = record
+        return dict(start_time=time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.start_time)),
+                    total_seconds=time.time() - self.start_time,
+                    max_rss_mb=max_rss_mb(),
+                    children_max_rss_mb=max_rss_mb(children=True),
+                    stages=stages)
+
+    def dump(self, path):
+        """Writes the report as json, e.g. to out_path/timings.json."""
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+    def log(self, logger):
+        for path, record in self.report()['stages'].items():
+            fps = f", {record['fps']:.1f} frames/s" if 'fps' in record else ''
+            logger.info(f"{path}: {record['seconds']:.1f} s in {record['calls']} calls{fps}")
+
+
+_active = None
+
+
+def activate(profiler):
+    """Makes profiler record the stages of the pipeline, None switches recording off."""
+    global _active
+    _active = profiler
+
+
+def active():
+    return _active
+
+
+def stage(name):
+    """Context manager timing a stage of the active profiler, no-op without one."""
+    return _active.stage(name) if _active is not None else nullcontext()
+
+
+def begin(name):
+    if _active is not None:
+        _active.begin(name)
+
+
+def end(name=None):
+    if _active is not None:
+        _active.end(name)
+
+
+def count(**counts):
+    if _active is not None:
+        _active.count(**counts)
@@ -1,5 +1,6 @@
 from .adjust_intensity import adjust_intensity_image
 from .correction_chessboard import correct_image
-from .pick_broken_frame import detect_broken_frame, replace_array
+from .fused_preprocess import build_preprocess_maps, preprocess_video
+from .pick_broken_frame import detect_broken_frame, detect_broken_frames, replace_array
 from .vessel_rejection import get_vessel_mask, visualize_img_and_mask
 from .detect_area import detect_calcium_center
\ No newline at end of file
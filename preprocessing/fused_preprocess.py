@@ -0,0 +1,89 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+from tqdm import tqdm
+
+
+def build_preprocess_maps(frame_shape, error_XX_new, error_YY_new, crop_parameter):
+    """
+    Precompute a single remap that does the distortion correction of the cropped part of a frame.
+
+    Same coordinates as correct_image followed by the crop, but only the pixels of the
+    crop are computed.
+
+    Parameters:
+    - frame_shape: (H, W) of the motion corrected frames.
+    - error_XX_new: numpy array, the error matrix to adjust the X coordinates.
+    - error_YY_new: numpy array, the error matrix to adjust the Y coordinates.
+    - crop_parameter: [y0, x0, h, w] of the crop, clipped to the frame like array slicing.
+
+    Returns:
+    - maps: (map1, map2) in cv2.convertMaps CV_16SC2 fixed-point form, for cv2.remap.
+    """
+    H, W = frame_shape
+    crop = (slice(crop_parameter[0], crop_parameter[0] + crop_parameter[2]),
+            slice(crop_parameter[1], crop_parameter[1] + crop_parameter[3]))
+    XX, YY = np.meshgrid(np.arange(W), np.arange(H))
+    XX_new = (XX + error_XX_new)[crop].astype(np.float32)
+    YY_new = (YY + error_YY_new)[crop].astype(np.float32)
+
+    return cv2.convertMaps(XX_new, YY_new, cv2.CV_16SC2)
+
+
+def preprocess_video(video, maps, out, weight_map=None, up_sample=1, store=None, n_threads=8, chunk_size=64,
+                     writer=None):
+    """
+    Apply intensity weighting, distortion correction, crop and upsampling to every frame, in one pass.
+
+    The input is read once, chunk_size frames at a time, so a video computed when it is read
+    (e.g. ShiftedVideo) is motion corrected once per chunk. Frames are processed by a thread
+    pool (cv2.remap and cv2.resize release the GIL) and written in place to `out`. The maximum
+    value of the corrected frames before upsampling is tracked on the fly, so the caller can
+    normalize with 255 / max_v later instead of running a second pass. The frames are the
+    ones of correct_image, crop and cv2.resize.
+
+    Parameters:
+    - video: (T, H, W) motion corrected frames, array-like.
+    - maps: output of build_preprocess_maps.
+    - out: preallocated (T, h, w) array-like receiving the float16 frames.
+    - weight_map: optional (H, W) intensity weight map, skipped if None.
+    - up_sample: int, upsampling factor applied after cropping.
+    - store: optional VideoStore receiving the frames in blocks of chunk_size.
+    - n_threads: int, number of worker threads.
+    - chunk_size: int, number of frames per batch.
+    - writer: optional cv2.VideoWriter receiving the input frames as uint8, e.g. to save the
+      motion corrected video in the same pass.
+
+    Returns:
+    - max_v: float, maximum value of the preprocessed video.
+    """
+    map1, map2 = maps
+    if weight_map is not None:
+        weight_map = weight_map.astype(np.float32)
+
+    def process(i, frame):
+        if weight_map is not None:
+            frame = frame * weight_map
+        img = cv2.remap(frame, map1, map2, cv2.INTER_CUBIC)
+        if up_sample > 1:
+            # the crop border is replicated by resize, as when the crop was upsampled on its own
+            out[i] = cv2.resize(img, (img.shape[1] * up_sample, img.shape[0] * up_sample),
+                                interpolation=cv2.INTER_CUBIC)
+        else:
+            out[i] = img
+        return img.max()
+
+    max_v = 0
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        for start in tqdm(range(0, len(video), chunk_size)):
+            stop = min(start + chunk_size, len(video))
+            frames = np.asarray(video[start:stop], dtype=np.float32)
+            max_v = max(max_v, max(pool.map(process, range(start, stop), frames)))
+            if writer is not None:
+                for frame in frames:
+                    writer.write(frame.astype(np.uint8))
+            if store is not None:
+                store.write(start, out[start:stop])
+
+    return float(max_v)
@@ -1,31 +1,92 @@
 import os
 import cv2
 import numpy as np
+import math
 import matplotlib.pyplot as plt
-from skimage import filters
+from numba import jit, prange
 
 # Define the function to detect broken frames
 # @Mingrui Wang, 06132024
-def detect_broken_frame(img, threshold_scale=0.06, column_ratio=0.4): # This is too slow for per-frerame processing.
-    # Perform edge detection using Prewitt filter
-    edgeI_tmp = filters.prewitt(img)
-
-    # Convert the edge detection result to binary (logical 0 and 1 values)
-    threshold = np.max(np.array(edgeI_tmp)) * threshold_scale  # You can adjust this threshold as needed 0.05-0.08
-    edgeI = np.array(edgeI_tmp) > threshold
+def detect_broken_frame(img, threshold_scale=0.06, column_ratio=0.4):
+    """Single frame version of detect_broken_frames."""
+    return bool(detect_broken_frames(img[np.newaxis], threshold_scale, column_ratio)[0])
+
+
+@jit(["void(u1[:,:,:],i8,f8,b1[:])", "void(f4[:,:,:],i8,f8,b1[:])"],
+     nopython=True, parallel=True, cache=True, fastmath=True)
+def fast_broken_frame(video, cols, threshold_scale, flags):
+    '''Flag frames whose Prewitt edge map has a row that is mostly edges.
+
+    Inputs:
+        video(numpy.ndarray of uint8 or float32, shape = (T,Lx,Ly)): the input video
+        cols(int): number of leading columns that are inspected
+        threshold_scale(float): edge threshold relative to the maximum edge magnitude
+
+    Outputs:
+        flags(numpy.ndarray of bool, shape = (T,)): True for broken frames
+    '''
+    Lx = video.shape[1]
+    Ly = video.shape[2]
+    for t in prange(video.shape[0]):
+        # Prewitt magnitude sqrt((gx**2 + gy**2) / 2) with the 1/3 smoothing folded in,
+        # borders are mirrored as in skimage.filters.prewitt. The threshold needs the
+        # maximum over the whole frame, but only the first cols columns are kept.
+        edge = np.empty((Lx, cols), dtype=np.float32)
+        vmax = 0.
+        for i in range(Lx):
+            i0 = max(i - 1, 0)
+            i1 = min(i + 1, Lx - 1)
+            for j in range(Ly):
+                j0 = max(j - 1, 0)
+                j1 = min(j + 1, Ly - 1)
+                gx = (np.float32(video[t, i0, j0]) + np.float32(video[t, i0, j]) + np.float32(video[t, i0, j1])
+                      - np.float32(video[t, i1, j0]) - np.float32(video[t, i1, j]) - np.float32(video[t, i1, j1]))
+                gy = (np.float32(video[t, i0, j0]) + np.float32(video[t, i, j0]) + np.float32(video[t, i1, j0])
+                      - np.float32(video[t, i0, j1]) - np.float32(video[t, i, j1]) - np.float32(video[t, i1, j1]))
+                v = math.sqrt((gx * gx + gy * gy) / 18.)
+                if j < cols:
+                    edge[i, j] = v
+                if v > vmax:
+                    vmax = v
+
+        # a frame is broken if any row has more than half of its columns above threshold
+        threshold = vmax * threshold_scale
+        broken = False
+        for i in range(Lx):
+            count = 0
+            for j in range(cols):
+                if edge[i, j] > threshold:
+                    count += 1
+            if count > 0.5 * cols:
+                broken = True
+                break
+        flags[t] = broken
 
-    # Resize edgeI to keep only the first 40% columns
-    cols = int(edgeI.shape[1] * column_ratio)
-    edgeI = edgeI[:, :cols]
 
-    # Compute the mean of edge detection result along columns
-    I_mean = np.mean(edgeI, axis=1)
+def detect_broken_frames(video, threshold_scale=0.06, column_ratio=0.4):
+    """Detects broken frames in a stack of frames.
 
-    # Check the condition
-    flag = np.sum(I_mean > 0.5) > 0
+    Same criterion as the original per-frame detector: the Prewitt edge map is
+    thresholded at threshold_scale times its maximum, and a frame is broken if any row
+    of the first `column_ratio` columns is mostly edges. The edge map is computed in a
+    single pass without temporaries, and frames are processed in parallel.
 
+    Args:
+        video: (T, H, W) stack of frames, uint8 or float
+        threshold_scale: edge threshold relative to the maximum edge magnitude, 0.05-0.08
+        column_ratio: ratio of leading columns that are inspected
 
-    return flag
+    Returns:
+        (T,) boolean array, True for broken frames.
+    """
+    video = np.asarray(video)
+    if video.dtype != np.uint8:
+        video = video.astype(np.float32)
+    cols = int(video.shape[2] * column_ratio)
+    flags = np.zeros(video.shape[0], dtype=bool)
+    if cols > 0 and video.shape[0] > 0:
+        fast_broken_frame(video, cols, float(threshold_scale), flags)
+    return flags
 
 
 # replace bad frames with closest good frames
@@ -33,43 +94,33 @@ def detect_broken_frame(img, threshold_scale=0.06, column_ratio=0.4): # This is
 def replace_array(flag_array):
     """Replaces bad frames with the nearest good frames.
     
+    Ties are resolved towards the earlier good frame.
+
     Args:
-        file_list_array: List of file paths for each frame.
-        flag_array: List of boolean values indicating if a frame is good (True) or bad (False).
+        flag_array: List of boolean values indicating if a frame is bad (True) or good (False).
 
     Returns:
         List of pared (frame id needs to be replace, replaced frame id).
     """
-    replace_frame_array = []
-    bad_frame_indices = [i for i, flag in enumerate(flag_array) if flag] # note how to deal with flag
-    good_frame_indices = [i for i, flag in enumerate(flag_array) if not flag]
-
-    for bad_idx in bad_frame_indices:
-        closest_good_idx = None
-        min_distance = float("inf")
-
-        # Search backward for nearest good frame
-        for i in range(bad_idx - 1, -1, -1):
-            if i in good_frame_indices: # good frame
-                distance = bad_idx - i
-                if distance < min_distance:
-                    closest_good_idx = i
-                    min_distance = distance
-                break  # Stop once the first good frame is found
-
-        # Search forward for nearest good frame (if closer than the backward one)
-        for i in range(bad_idx + 1, len(flag_array)):
-            if i in good_frame_indices:
-                distance = i - bad_idx
-                if distance < min_distance:
-                    closest_good_idx = i
-                break
-
-        # Replace bad frame with nearest good frame (if found)
-        if closest_good_idx is not None:
-            replace_frame_array.append([bad_idx, closest_good_idx])
-
-    return replace_frame_array
+    flags = np.asarray(flag_array, dtype=bool)
+    n = len(flags)
+    idx = np.arange(n)
+
+    # nearest good frame at or before / at or after every index
+    prev_good = np.maximum.accumulate(np.where(flags, -1, idx))
+    next_good = np.minimum.accumulate(np.where(flags, n, idx)[::-1])[::-1]
+
+    bad_idx = np.flatnonzero(flags)
+    prev_idx = prev_good[bad_idx]
+    next_idx = next_good[bad_idx]
+    has_prev = prev_idx >= 0
+    has_next = next_idx < n
+    # the forward frame only wins if it is strictly closer
+    use_next = has_next & (~has_prev | (next_idx - bad_idx < bad_idx - prev_idx))
+    good_idx = np.where(use_next, next_idx, prev_idx)
+    valid = has_prev | has_next
+
+    return [[int(b), int(g)] for b, g in zip(bad_idx[valid], good_idx[valid])]
 
 
 def main():
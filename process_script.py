@@ -39,10 +39,13 @@ from scipy import sparse
 
 # %%
 import caiman
-from caiman import normcorre_function
-from preprocessing import adjust_intensity_image, correct_image, detect_broken_frame, replace_array, get_vessel_mask, visualize_img_and_mask, detect_calcium_center
-from deepdefinite import background_rejection
-from segmentation import neuron_segmentation, convert_to_sparse, load_sparse_frames_from_mat, save_sparse_frames_to_mat
+from caiman import normcorre_function, normcorre_session, MCDiagnostics
+from preprocessing import adjust_intensity_image, correct_image, detect_broken_frame, detect_broken_frames, replace_array, build_preprocess_maps, preprocess_video, get_vessel_mask, visualize_img_and_mask, detect_calcium_center
+from deepdefinite import InferenceSession
+from deepdefinite.utils import open_video_writer
+from pipeline import FrameIngest, VideoBuffer, VideoStore, ShiftStore, ShiftedVideo, StageProfiler, timing
+from pipeline.online_mc import OnlineMotionCorrection
+from segmentation import neuron_segmentation, segment_patches, SegmentationPool, SparseMasks, extract_traces, save_mask_sum
 from Visualization import com, plot_cm, view_patches, nb_view_patches, save_video, filter_masks_by_roundness, plot_trace
 import argparse
 import math
@@ -78,6 +81,7 @@ def arg_parse():
     parser.add_argument('--set_frame_num', type=int, default=0, help='Define the frame number. If 0, the program will automatically detect the frame number')
     parser.add_argument('--data_path', type=str, default="/mnt/nas01/wy/line/BS/189/22-14-39-494/frames", help='Path to the data directory')
     parser.add_argument('--out_path', type=str, default="/mnt/nas01/wy/line/BS/189/22-14-39-494/Analysis", help='Path to the output directory')
+    parser.add_argument('--read_threads', type=int, default=8, help='Number of threads decoding the jpg frames')
 
     # motion registration
     parser.add_argument('--fr', type=int, default=10, help='Frame rate')
@@ -92,6 +96,15 @@ def arg_parse():
     parser.add_argument('--shifts_opencv', type=str2bool, default=True, help='Flag for correcting motion using bicubic interpolation')
     parser.add_argument('--border_nan', type=str, default='copy', help='Replicate values along the boundary')
     parser.add_argument('--downsample_ratio', type=float, default=0.1, help='Downsample ratio for displaying purpose')
+    parser.add_argument('--mc_schedule', type=str, default='chunked', choices=['chunked', 'session'], help='chunked: MC of each mc_chunk_size chunk in turn, the template passed from chunk to chunk; session: one template from a subsample of the whole session, then all the frames corrected at once in num_frames_split splits')
+    parser.add_argument('--mc_mode', type=str, default='two_pass', choices=['two_pass', 'single_pass'], help='two_pass: full rigid pass then full pw-rigid pass, single_pass: one pw-rigid pass seeded by the rigid shift of each frame (no rigid.tif)')
+    parser.add_argument('--mc_downsample', type=int, default=1, choices=[1, 2, 4], help='Estimate the MC shifts on frames downsampled by this factor (refined at full resolution), the shifts are applied to the full resolution frames. Needs shifts_opencv')
+    parser.add_argument('--mc_persist', type=str, default='frames', choices=['frames', 'shifts'], help='frames: write the motion corrected frames (mc/mc.h5 and the tif files of every chunk); shifts: only save the shifts to mc/shifts.h5, the corrected frames are recomputed from the raw frames when the next stage reads them (ShiftedVideo)')
+    parser.add_argument('--mc_diagnostics', type=str, default='full', choices=['full', 'summary', 'off'], help='MC quality control figures. full: template, shifts, local correlations and concat_movie.tif for every chunk; summary: figures rendered once for the session in mc/, correlation images of one frame out of --mc_diagnostics_stride; off: none')
+    parser.add_argument('--mc_diagnostics_stride', type=int, default=10, help='One frame out of this number is used for the correlation images of the summary diagnostics')
+    parser.add_argument('--online_mc', type=str2bool, default=False, help='Motion correct the frames while they are being acquired: data_path is watched for new frame_N.jpg files, each one is registered against a running template and appended to mc/mc.h5. Only mc.h5 is written (no shifts.h5, chunk figures or badframe_replaced.avi)')
+    parser.add_argument('--online_idle_timeout', type=float, default=60, help='With --online_mc and no --set_frame_num, the acquisition is over once no new frame arrived for this many seconds')
+    parser.add_argument('--mc_shared_backend', type=str, default='memmap', choices=['memmap', 'shm'], help='How the MC workers read the input frames: memmap reads them straight from the session memmap, shm copies every chunk (chunked schedule) or the template subsample (session schedule) to shared memory (needs /dev/shm larger than a chunk)')
 
     # preprocessing
     parser.add_argument('--crop_parameter', type=int, nargs='+', default=[153, 303, 1000, 1000], help='Crop parameters')
@@ -103,8 +116,13 @@ def arg_parse():
     parser.add_argument('--rmbg_chunk_size', type=int, default=2000, help='Chunk size for RMBG model')
     parser.add_argument('--rmbg_gsize', type=int, default=6, help='Neuron radius for background rejection')
     parser.add_argument('--ckpt_pth', type=str, default='utils/deepdefinite_ckpt_resize_2.pth', help='Path to the model checkpoint')
-    parser.add_argument('--device', type=str, default='cuda', help='Device to use (cuda or cpu)')
+    parser.add_argument('--device', type=str, default='cuda', help='Device to use (cuda, cpu, or cpu-onnx / cpu-torchscript for an exported RMBG model on CPU)')
     parser.add_argument('--gpu_ids', type=str, default='2', help='GPU ids')
+    parser.add_argument('--rmbg_batch_size', type=int, default=4, help='RMBG patches per batch, 0 to fit the free GPU memory')
+    parser.add_argument('--rmbg_precision', type=str, default='fp32', help='RMBG precision: fp32, bf16 or int8 (cpu-onnx only)')
+    parser.add_argument('--rmbg_threads', type=int, default=0, help='RMBG intra-op threads on CPU, 0 for the default')
+    parser.add_argument('--rmbg_compile', type=str2bool, default=False, help='optimize the RMBG model with torch.compile')
+    parser.add_argument('--rmbg_stream', type=str2bool, default=False, help='stream the whole session through overlapping RMBG windows instead of independent chunks')
 
     # segmentation. Note these parameters are for upsample 2 times
     parser.add_argument('--patch_size', type=int, default=500, help='Chopped patch size')
@@ -116,6 +134,8 @@ def arg_parse():
     parser.add_argument('--thresh_COM0', type=int, default=6, help='Initial merge threshold')
     parser.add_argument('--thresh_COM', type=int, default=9, help='Merge threshold')
     parser.add_argument('--cons', type=int, default=5, help='Minimum consecutive number of frames of active neurons')
+    parser.add_argument('--seg_patch_workers', type=int, default=1, help='Number of patches segmented in parallel, 1 segments the patches one by one with the frames in parallel. Each worker holds a copy of its patch in RAM')
+    parser.add_argument('--seg_frame_workers', type=int, default=0, help='Number of processes separating the frames of a patch when --seg_patch_workers is 1, 0 uses all CPUs')
 
     # save video
     parser.add_argument('--avi_quality', type=int, default=100, help='Quality of the saved AVI file')
@@ -189,6 +209,7 @@ def PICO_processing(args):
     set_frame_num = args.set_frame_num
     out_path = args.out_path
     data_path = args.data_path
+    read_threads = args.read_threads
     
     # motion correction
     fr = args.fr
@@ -203,6 +224,15 @@ def PICO_processing(args):
     shifts_opencv = args.shifts_opencv
     border_nan = args.border_nan
     downsample_ratio = args.downsample_ratio
+    mc_shared_backend = args.mc_shared_backend
+    mc_mode = args.mc_mode
+    mc_schedule = args.mc_schedule
+    mc_downsample = args.mc_downsample
+    mc_persist = args.mc_persist
+    mc_diagnostics = args.mc_diagnostics
+    mc_diagnostics_stride = args.mc_diagnostics_stride
+    online_mc = args.online_mc
+    online_idle_timeout = args.online_idle_timeout
 
     # preprocessing
     crop_parameter = args.crop_parameter
@@ -219,6 +249,11 @@ def PICO_processing(args):
     ckpt_pth = args.ckpt_pth
     device = args.device
     gpu_ids = args.gpu_ids
+    rmbg_batch_size = args.rmbg_batch_size
+    rmbg_compile = args.rmbg_compile
+    rmbg_precision = args.rmbg_precision
+    rmbg_threads = args.rmbg_threads
+    rmbg_stream = args.rmbg_stream
 
     # segmentation
     patch_size = args.patch_size
@@ -230,6 +265,8 @@ def PICO_processing(args):
     thresh_COM0 = args.thresh_COM0
     thresh_COM = args.thresh_COM
     cons = args.cons
+    seg_patch_workers = args.seg_patch_workers
+    seg_frame_workers = args.seg_frame_workers
 
     # save
     avi_quality = args.avi_quality
@@ -239,6 +276,7 @@ def PICO_processing(args):
     preprocess_out = os.path.join(out_path, 'preprocess')
     rmbg_out = os.path.join(out_path, 'rmbg')
     seg_out = os.path.join(out_path, f'seg_results_thresh_pmap_{thresh_pmap}')
+    tmp_out = os.path.join(out_path, 'tmp') # memmap buffers of the working videos
 
     os.makedirs(mc_out, exist_ok=True)
     os.makedirs(rmbg_out, exist_ok=True)
@@ -253,154 +291,202 @@ def PICO_processing(args):
 
     start_time = datetime.now()
     logger.info(f'start time: {start_time}')
+    # stage timings, counters and memory of this run, saved to timings.json
+    profiler = StageProfiler()
+    timing.activate(profiler)
 
     for arg in vars(args):
         logger.info(f'{arg}: {getattr(args, arg)}')
 
-    if set_frame_num == 0: # we don't know the frame number
+    if online_mc and not jump_to_rmbg:
+        frame_num = set_frame_num or None # known once the acquisition is over
+    elif set_frame_num == 0: # we don't know the frame number
         frame_num = len(glob.glob(data_path + '/*.jpg'))
         print(frame_num)
     else:
         frame_num = set_frame_num
 
     if not jump_to_rmbg:
-        # determine good frames and read
-        flag_array = []
-        video = []
-        logger.info('=======>bad frame detection<=======\n')
-        # read and preprocess. This will take a while
-        for i in tqdm(range(0, frame_num)):
-            path = os.path.join(data_path, 'frame_'+str(i)+'.jpg')
-            img = cv2.imread(path)
-            img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-            video.append(img)
-            if bad_frame_detect_flag:
-                flag = detect_broken_frame(img)
+        if online_mc:
+            # the frames are corrected as the acquisition writes them, MC is done when it ends
+            logger.info('=======>online motion correction<=======\n')
+            mc_persist = 'frames'
+            timing.begin('ingest_mc')
+            online = OnlineMotionCorrection(data_path, os.path.join(mc_out, 'mc.h5'), max_shifts, strides, overlaps,
+                                            max_deviation_rigid, border_nan=border_nan,
+                                            buffer_path=os.path.join(tmp_out, 'mc.dat'), frame_num=frame_num,
+                                            n_threads=read_threads, detect_bad_frames=bad_frame_detect_flag,
+                                            idle_timeout=online_idle_timeout)
+            frame_num = online.run()
+            timing.end('ingest_mc')
+            video = VideoBuffer(os.path.join(tmp_out, 'mc.dat'), (frame_num,) + tuple(online.dims), np.float32, mode='r+')
+        else:
+            # read with a threaded decoder, detect bad frames chunk by chunk and run MC on each
+            # chunk as soon as its bad frames can be replaced (i.e. the next good frame is read).
+            # With the session schedule MC starts once all the frames are read
+            logger.info('=======>bad frame detection and motion correction<=======\n')
+            timing.begin('ingest_mc')
+            ingest = FrameIngest(data_path, frame_num, chunk_size=mc_chunk_size, n_threads=read_threads,
+                                 out=os.path.join(tmp_out, 'video.dat'))
+            video = ingest.video
+            flag_array = np.zeros(frame_num, dtype=bool)
+
+            N_chunk = len(ingest)
+            template = None
+            c, dview, n_processes = caiman.cluster.setup_cluster(
+                backend='local', n_processes=24, single_thread=False)
+
+            # the shifts are always saved, the corrected frames only with mc_persist == 'frames'
+            shift_store = ShiftStore.create(os.path.join(mc_out, 'shifts.h5'), frame_num, video.shape[1:])
+            mc_summary = MCDiagnostics(mc_out, stride=mc_diagnostics_stride) if mc_diagnostics == 'summary' else None
+            if mc_persist == 'frames':
+                mc_video = VideoBuffer(os.path.join(tmp_out, 'mc.dat'), video.shape, np.float32)
+                mc_store = VideoStore.create(os.path.join(mc_out, 'mc.h5'), video.shape, np.uint8)
+            mc_idx = 0 # next chunk to be motion corrected
+            for start, stop, chunk in tqdm(ingest, total=N_chunk):
+                if bad_frame_detect_flag:
+                    with timing.stage('bad_frames'):
+                        flag_array[start:stop] = detect_broken_frames(chunk)
+                    for k in np.flatnonzero(flag_array[start:stop]):
+                        print(f'Broken frame detected at frame_{str(start + k)}.jpg')
+
+                while mc_schedule == 'chunked' and mc_idx < N_chunk:
+                    mc_start = mc_idx * mc_chunk_size
+                    mc_stop = min(mc_start + mc_chunk_size, frame_num)
+                    # the trailing bad frames need a later good frame, unless this is the end
+                    if stop < frame_num and flag_array[mc_stop:stop].all():
+                        break
+
+                    replace_item = [item for item in replace_array(flag_array[:stop]) if mc_start <= item[0] < mc_stop]
+                    if replace_item:
+                        print(replace_item)
+                    for item in replace_item:
+                        bad_idx, good_idx = item[0], item[1]
+                        video[bad_idx] = video[good_idx]
+
+                    image_stack = video[mc_start:mc_stop]
+                    # Print the shape of the resulting stack
+                    print(image_stack.shape)
+
+                    tmp_outpath = f'{mc_out}/chunk_{mc_idx}'
+                    os.makedirs(tmp_outpath, exist_ok = True)
+
+                    # call function
+                    timing.begin('normcorre')
+                    m_nonrig, bord_px_rig, bord_px_els, template = normcorre_function(video=image_stack, # a numpy array of the video
+                                        fr=fr,
+                                        max_shifts=max_shifts, 
+                                        strides=strides, 
+                                        overlaps=overlaps, 
+                                        max_deviation_rigid= max_deviation_rigid, 
+                                        shifts_opencv=shifts_opencv, 
+                                        border_nan=border_nan, 
+                                        downsample_ratio=downsample_ratio,
+                                        outpath=tmp_outpath,
+                                        template=template,
+                                        save_movie=save_movie,
+                                        dview=dview,
+                                        shared_backend=mc_shared_backend,
+                                        source=video if mc_shared_backend == 'memmap' else None,
+                                        source_offset=mc_start,
+                                        mc_mode=mc_mode,
+                                        downsample_factor=mc_downsample,
+                                        persist=mc_persist,
+                                        shift_store=shift_store,
+                                        shift_offset=mc_start,
+                                        diagnostics=mc_diagnostics,
+                                        summary=mc_summary)
+                    timing.end('normcorre')
+                
+                    if mc_persist == 'frames':
+                        with timing.stage('mc_write'):
+                            mc_store.write(mc_start, m_nonrig)
+                            mc_video[mc_start:mc_stop] = m_nonrig
+                    mc_idx += 1
+
+            if mc_schedule == 'session':
+                for bad_idx, good_idx in replace_array(flag_array):
+                    video[bad_idx] = video[good_idx]
+                video.flush()
+
+                timing.begin('normcorre')
+                fname_els, bord_px_rig, bord_px_els, template = normcorre_session(video=video,
+                                        fr=fr,
+                                        max_shifts=max_shifts,
+                                        strides=strides,
+                                        overlaps=overlaps,
+                                        max_deviation_rigid=max_deviation_rigid,
+                                        shifts_opencv=shifts_opencv,
+                                        border_nan=border_nan,
+                                        outpath=mc_out,
+                                        dview=dview,
+                                        n_workers=n_processes,
+                                        num_frames_split=num_frames_split,
+                                        shared_backend=mc_shared_backend,
+                                        downsample_factor=mc_downsample,
+                                        persist=mc_persist,
+                                        shift_store=shift_store,
+                                        diagnostics=mc_diagnostics,
+                                        summary=mc_summary)
+                timing.end('normcorre')
+
+            if mc_schedule == 'session' and mc_persist == 'frames':
+                with timing.stage('mc_write'):
+                    Yr, dims, T = caiman.load_memmap(fname_els)
+                    for mc_idx, mc_start in enumerate(range(0, frame_num, mc_chunk_size)):
+                        mc_stop = min(mc_start + mc_chunk_size, frame_num)
+                        m_nonrig = np.reshape(Yr[:, mc_start:mc_stop].T, [mc_stop - mc_start] + list(dims), order='F')
+                        mc_store.write(mc_start, m_nonrig)
+                        mc_video[mc_start:mc_stop] = m_nonrig
+                        if save_movie:
+                            tmp_outpath = f'{mc_out}/chunk_{mc_idx}'
+                            os.makedirs(tmp_outpath, exist_ok = True)
+                            tifffile.imwrite(tmp_outpath + '/non_rigid.tif', m_nonrig.astype(np.uint8))
+                    del Yr
+                    os.remove(fname_els)
+
+            # bad frames are read from the good frames that replaced them
+            frame_index = np.arange(frame_num)
+            for bad_idx, good_idx in replace_array(flag_array):
+                frame_index[bad_idx] = good_idx
+            shift_store.write_frame_index(frame_index)
+            shift_store.flush()
+            if mc_summary is not None:
+                with timing.stage('mc_summary'):
+                    mc_summary.render()
+            if mc_persist == 'frames':
+                mc_store.close()
+                shift_store.close()
+            timing.end('ingest_mc')
+
+            logger.info(f'frame decoding: {ingest.fps:.1f} frames/s, at most {ingest.max_fps:.1f} frames/s with all decoding threads busy')
+
+            # save the corrected video
+            with timing.stage('save_avi'):
+                save_video(video, fr, out_path + '/badframe_replaced.avi', quality=avi_quality)
+
+            caiman.stop_server(dview=dview)
+            if mc_persist == 'frames':
+                # replace the original video with the motion corrected video
+                video.delete()
+                video = mc_video
+                # clear the memory
+                del mc_video
             else:
-                flag = False
-            
-            flag_array.append(flag)
-            if flag:
-                print(f'Broken frame detected at frame_{str(i)}.jpg')
-
-    # if not jump_to_rmbg:
-    #     # determine good frames and read
-    #     flag_array = []
-    #     video = []
-    #     logger.info('=======>bad frame detection<=======\n')
-    #     # read and preprocess. This will take a while
-    #     previous_frame = None  # Variable to store the previous frame
-    #     for i in tqdm(range(0, frame_num)):
-    #         path = os.path.join(data_path, 'frame_' + str(i) + '.jpg')
-            
-    #         try:
-    #             img = cv2.imread(path)
-    #             if img is None:
-    #                 raise ValueError("Failed to load image.")  # Handling for invalid image
-            
-    #             img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-            
-    #             # Check if the frame is all black (i.e., all pixel values are 0)
-    #             if np.mean(img)<8:
-    #                 if previous_frame is not None:
-    #                     print(f"All-black frame detected at frame_{str(i)}. Replacing with the previous frame.")
-    #                     img = previous_frame  # Replace the current frame with the previous one
-    #                 else:
-    #                     print(f"All-black frame detected at frame_{str(i)}. No previous frame available.")
-            
-    #         except cv2.error as e:
-    #             # Handle corrupt JPEG data error
-    #             print(f"Corrupt JPEG data at frame_{str(i)}. Replacing with the previous frame.")
-    #             if previous_frame is not None:
-    #                 img = previous_frame  # Replace with previous frame if corrupt
-    #             else:
-    #                 img = np.zeros_like(img)  # Handle case if no previous frame available (you could use a blank frame)
-            
-    #         video.append(img)
-            
-    #         if bad_frame_detect_flag:
-    #             flag = detect_broken_frame(img)
-    #         else:
-    #             flag = False
-            
-    #         flag_array.append(flag)
-    #         if flag:
-    #             print(f'Broken frame detected at frame_{str(i)}.jpg')
-            
-    #         # Store the current frame as the previous one for the next iteration
-    #         previous_frame = img
-
-        # now print correct reading list
-        replace_item = replace_array(flag_array)
-        print(replace_item)
-
-        for item in replace_item:
-            bad_idx, good_idx = item[0], item[1]
-            video[bad_idx] = video[good_idx].copy()
-
-
-        # save the corrected video
-        save_video(video, fr, out_path + '/badframe_replaced.avi', quality=avi_quality)
-
-        #  MC
-        logger.info('=======>motion correction<=======\n')
-        
-        N_chunk = math.ceil(len(video) / mc_chunk_size)
-        template = None
-        mc_video = []
-        c, dview, n_processes = caiman.cluster.setup_cluster(
-            backend='local', n_processes=24, single_thread=False)
-
-        for i in tqdm(range(N_chunk)):
-            image_stack = np.stack(video[i*mc_chunk_size:(i+1)*mc_chunk_size], axis=0)
-            # Print the shape of the resulting stack
-            print(image_stack.shape)
-
-            tmp_outpath = f'{mc_out}/chunk_{i}'
-            os.makedirs(tmp_outpath, exist_ok = True)
-
-            # call function
-            m_nonrig, bord_px_rig, bord_px_els, template = normcorre_function(video=image_stack, # a numpy array of the video
-                                fr=fr,
-                                max_shifts=max_shifts, 
-                                strides=strides, 
-                                overlaps=overlaps, 
-                                max_deviation_rigid= max_deviation_rigid, 
-                                shifts_opencv=shifts_opencv, 
-                                border_nan=border_nan, 
-                                downsample_ratio=downsample_ratio,
-                                outpath=tmp_outpath,
-                                template=template,
-                                save_movie=save_movie,
-                                dview=dview)
-            
-            frames_list = [m_nonrig[i] for i in range(m_nonrig.shape[0])]
-            mc_video.extend(frames_list)
-
-        caiman.stop_server(dview=dview)
-        # replace the original video with the motion corrected video
-        video = mc_video
-        # clear the memory
-        del mc_video
-
-        # save video
-        save_video(video, fr, out_path + '/mc.avi', quality=avi_quality)
-
-        # save all mc video
-        tmp_outpath = f'{mc_out}/all'
-        os.makedirs(tmp_outpath, exist_ok = True)
-        for i, frame in tqdm(enumerate(video)): # save back to a list
-            # save
-            tifffile.imwrite(os.path.join(tmp_outpath, 'frame_'+str(i)+'.tif'),  frame.astype(np.uint8))  # Save as TIFF file
+                # the motion corrected frames are computed from the raw ones as they are read
+                raw_video = video
+                video = ShiftedVideo(raw_video, shift_store)
 
 
         logger.info('=======>do upsampling<=======\n')
+        timing.begin('preprocess')
+        # a ShiftedVideo recomputes the frames it is asked for, read frame no.1 once
+        frame_0 = np.asarray(video[0], dtype=np.float32)
         # intensity correction from good frame no.1
         if intensity_corr_flag:
-            tmp_img = video[0]
-            weight_map, I_change = adjust_intensity_image(tmp_img)
+            weight_map, I_change = adjust_intensity_image(frame_0)
         else:
-            weight_map = np.ones_like(video[0], dtype=np.float64)
+            weight_map = np.ones_like(frame_0, dtype=np.float64)
             I_change = 1
 
         # load precalibrated distortion correction map
@@ -416,8 +502,6 @@ def PICO_processing(args):
 
         # intensity uniformity
         logger.info('=======>field distortion correction and intensity uniformity<=======\n')
-        video_preprocessed = []  # stored in a list
-        max_v = 0
 
         logger.info(f"Former crop_parameter is {args.crop_parameter}" )
 
@@ -425,61 +509,59 @@ def PICO_processing(args):
         model = YOLO("/data/home/angran/BBNC/code/PICO_ca_processing/utils/yolo_v8s.pt")
         crop_parameter_init = crop_parameter.copy()
 
-        img_change_frame = video[0].astype(np.float64) * weight_map
+        img_change_frame = frame_0.astype(np.float64) * weight_map
         img_change_frame = correct_image(img_change_frame, error_XX_new, error_YY_new)
         img_change_frame = cv2.normalize(img_change_frame, None, 0, 255, cv2.NORM_MINMAX)
         img_change_frame = img_change_frame.astype(np.uint8)
 
         # frame_0 = cv2.imread(os.path.join(data_path, "frame_0.jpg"), cv2.IMREAD_GRAYSCALE)
 
-        crop_parameter = YOLO_center_detect(model, img_change_frame, crop_parameter_init, output_dir=out_path)
+        with timing.stage('crop_detection'):
+            crop_parameter = YOLO_center_detect(model, img_change_frame, crop_parameter_init, output_dir=out_path)
 
         logger.info(f"Corrected crop_parameter is as follows: {crop_parameter}")
 
         del model
 
-        for frame in tqdm(video):
-            # print(f'Processing frame {i}')
-            # adjust illumination
-            img_change_frame = frame.astype(np.float64) * weight_map
-            
-            # distortion correction, no upsampling here
-            img_change_frame = correct_image(img_change_frame, error_XX_new, error_YY_new)
-
-            # crop image
-            img_change_frame = img_change_frame[crop_parameter[0]:crop_parameter[0]+crop_parameter[2], 
-                                                crop_parameter[1]:crop_parameter[1]+crop_parameter[3]]
-            
-            if up_sample_flag: # TODO
-                # do upsampling, 2 times larger
-                tmp_img = img_change_frame.astype(np.float32)
-                tmp_img = cv2.resize(tmp_img, (tmp_img.shape[1]*up_sample, tmp_img.shape[0]*up_sample), 
-                                        interpolation=cv2.INTER_CUBIC)
-                tmp_img = tmp_img.astype(np.float16)
-            else:
-                tmp_img = img_change_frame.astype(np.float16)
-            video_preprocessed.append(tmp_img) # do not using float32 to save memory
-            
-            # update max value
-            max_v = max(max_v, np.max(img_change_frame))
-            
-        # release the ram
+        # distortion correction and crop in one precomputed remap, upsampled in the same pass
+        preprocess_maps = build_preprocess_maps(video.shape[1:], error_XX_new, error_YY_new, crop_parameter)
+        preprocess_up = up_sample if up_sample_flag else 1
+        video_preprocessed = VideoBuffer(os.path.join(tmp_out, 'preprocessed.dat'),
+                                         (len(video),) + tuple(s * preprocess_up for s in preprocess_maps[0].shape[:2]),
+                                         np.float16) # do not using float32 to save memory
+        preprocess_store = VideoStore.create(os.path.join(preprocess_out, 'preprocess.h5'),
+                                             video_preprocessed.shape, np.float16)
+        # the motion corrected video is saved in the same pass, so it is read (or warped) only once
+        mc_writer = open_video_writer(out_path + '/mc.avi', fr, video.shape[1:], quality=avi_quality)
+        with timing.stage('remap'):
+            max_v = preprocess_video(video, preprocess_maps, video_preprocessed,
+                                     weight_map=weight_map if intensity_corr_flag else None,
+                                     up_sample=preprocess_up, store=preprocess_store, n_threads=read_threads,
+                                     writer=mc_writer)
+            timing.count(frames=len(video))
+        mc_writer.release()
+
+        # frames are kept unnormalized, readers scale them to uint8 with 255 / max_v
+        preprocess_scale = 255 / max_v
+        preprocess_store.attrs['scale'] = preprocess_scale
+        preprocess_store.close()
+
+        # release the disk space
+        if mc_persist == 'frames':
+            video.delete()
+        else:
+            video.close()
+            raw_video.delete()
+            del raw_video
         del video
-        # save preprocessed video
 
-        logger.info('=======>save preprocessed video<=======\n')
-        for i, frame in tqdm(enumerate(video_preprocessed)): # save back to a list
-            # save
-            norm_frame = (frame / max_v) * 255 # keep it in uint8
-            tifffile.imwrite(os.path.join(preprocess_out, 'frame_'+str(i)+'.tif'),  norm_frame.astype(np.uint8))  # Save as TIFF file
-            video_preprocessed[i] = norm_frame
-
-    
         # save video
-        save_video(video_preprocessed, fr, out_path + '/preprocessed.avi', quality=avi_quality)
+        with timing.stage('save_avi'):
+            save_video(video_preprocessed, fr, out_path + '/preprocessed.avi', quality=avi_quality, scale=preprocess_scale)
 
         # %% get vessel mask
         logger.info('=======>get vessel mask<=======\n')
+        timing.begin('vessel_mask')
         norm_img = np.array(video_preprocessed[0]).astype(np.float32)
         norm_img = norm_img / norm_img.max()
         # vessel_img, vessel_mask = get_vessel_mask(norm_img , 'utils/vessel_model.pt')
@@ -491,9 +573,11 @@ def PICO_processing(args):
 
         tifffile.imwrite(os.path.join(out_path, 'vessel_mask.tif'), ((vessel_mask > 0) * 255).astype(np.uint8))
         tifffile.imwrite(os.path.join(out_path, 'vessel_image.tif'), (vessel_img*255).astype(np.uint8))
+        timing.end('vessel_mask')
+        timing.end('preprocess')
   
         # %%
-        logger.info(f'video_preprocessed: list, {video_preprocessed[0].dtype}')
+        logger.info(f'video_preprocessed: {video_preprocessed.shape}, {video_preprocessed.dtype}')
         logger.info(f'vessel_mask: dtype {vessel_mask.dtype}, min {vessel_mask.min()}, max {vessel_mask.max()}')
 
         # %% [markdown]
@@ -502,6 +586,7 @@ def PICO_processing(args):
         # %%
         # do the background subtraction
         
+        video_preprocessed.delete()
         del video_preprocessed
     else:
 
@@ -513,35 +598,46 @@ def PICO_processing(args):
     
     logger.info('=======>background subtraction<=======\n')
     
-    tmp_outpath = f'{preprocess_out}'
-    tif_files = glob.glob(os.path.join(tmp_outpath, '*.tif'))    
-    rmbg_chunk_num = math.ceil(len(tif_files) / rmbg_chunk_size)  
+    rmbg_store_path = os.path.join(rmbg_out, 'rmbg.h5')
     if not jump_to_seg:
-        # still, we chop it to chunks
-        for i in tqdm(range(rmbg_chunk_num)):
-            tmp_output_dir = os.path.join(rmbg_out, f'chunk_{i}')
-            os.makedirs(tmp_output_dir, exist_ok=True)
+        timing.begin('rmbg')
+        preprocess_store = VideoStore(os.path.join(preprocess_out, 'preprocess.h5'))
+        rmbg_chunk_num = math.ceil(len(preprocess_store) / rmbg_chunk_size)
+        rmbg_store = VideoStore.create(rmbg_store_path, preprocess_store.shape, np.uint8)
+        # the model is loaded once and applied to every chunk
+        rmbg_session = InferenceSession(ckpt_pth, gsize=rmbg_gsize, device=device, gpu_ids=gpu_ids,
+                                        batch_size=rmbg_batch_size, compile=rmbg_compile, precision=rmbg_precision,
+                                        threads=rmbg_threads, export_dir=os.path.join(tmp_out, 'export'))
+        if rmbg_stream:
+            # one pass over the session, a temporal window at a time
+            logger.info('=======>background subtraction: streaming<=======\n')
+            preprocess_scale = preprocess_store.attrs['scale']
+            preprocess_chunks = ((start, stop, (frames.astype(np.float32) * preprocess_scale).astype(np.uint8))
+                                 for start, stop, frames in preprocess_store.chunks(rmbg_session.stride_size[0]))
+            rmbg_session.process_stream(preprocess_chunks, len(preprocess_store), rmbg_store, output_dir=rmbg_out)
+        else:
+            # still, we chop it to chunks
+            for i in tqdm(range(rmbg_chunk_num)):
+                tmp_output_dir = os.path.join(rmbg_out, f'chunk_{i}')
+                os.makedirs(tmp_output_dir, exist_ok=True)
             
-            # load preprocessed video
-            tmp_video = []
-            logger.info(f'=======>background subtraction: chunk {i} loading<=======\n')
-            for j in range(i * rmbg_chunk_size, (i + 1) * rmbg_chunk_size):
-                if j >= len(tif_files): # safeguard
-                    break
-                path = os.path.join(tmp_outpath, 'frame_'+str(j)+'.tif')
-                img = cv2.imread(path, cv2.IMREAD_GRAYSCALE).astype(np.float16)
-                tmp_video.append(img)
+                # load preprocessed video
+                logger.info(f'=======>background subtraction: chunk {i} loading<=======\n')
+                with timing.stage('load'):
+                    tmp_video = preprocess_store[i * rmbg_chunk_size:(i + 1) * rmbg_chunk_size].astype(np.float32) * preprocess_store.attrs['scale']
+                    tmp_video = tmp_video.astype(np.uint8).astype(np.float16)
                 
-            # do the model
-            logger.info(f'=======>background subtraction: chunk {i} processing<=======\n')
-            _, _ = background_rejection(
-                                    video = tmp_video, # where the cleared data stored
-                                    gsize = rmbg_gsize, # neuron radius
-                                    device = device, # utilize GPU or CPU
-                                    gpu_ids =gpu_ids, # GPU ids
-                                    ckpt_pth = ckpt_pth, # model path
-                                    output_dir = tmp_output_dir # output directory
-                                    )
+                # do the model
+                logger.info(f'=======>background subtraction: chunk {i} processing<=======\n')
+                _, _ = rmbg_session.process(
+                                        video = tmp_video, # where the cleared data stored
+                                        output_dir = tmp_output_dir, # output directory
+                                        store = rmbg_store, # rmbg frames are written here
+                                        store_offset = i * rmbg_chunk_size
+                                        )
+        preprocess_store.close()
+        rmbg_store.close()
+        timing.end('rmbg')
         # if i == 0:
         #     neuron_video = tmp_neuron_video
         # else:
@@ -550,46 +646,26 @@ def PICO_processing(args):
     #
     # read all
     if not jump_to_vis:
-        for i in tqdm(range(rmbg_chunk_num)):
-            tmp_output_dir = os.path.join(rmbg_out, f'chunk_{i}/rmbg')
-            tmp_tif_files = glob.glob(os.path.join(tmp_output_dir, '*.tif'))
-
-            # load preprocessed video
-            tmp_video = []
-            logger.info(f'=======>reload background subtraction: chunk {i} loading<=======\n')
-            for j in range(len(tmp_tif_files)):
-                path = os.path.join(tmp_output_dir, 'frame_'+str(j)+'.tif')
-                img = cv2.imread(path, cv2.IMREAD_GRAYSCALE).astype(np.float16)
-                tmp_video.append(img)
-                
-            # list to array
-            tmp_neuron_video = np.array(tmp_video)
-            if i == 0:
-                neuron_video = tmp_neuron_video
-            else:
-                neuron_video = np.concatenate((neuron_video, tmp_neuron_video), axis=0)
-                
-        del tmp_video
-        del tmp_neuron_video
+        logger.info(f'=======>reload background subtraction<=======\n')
+        neuron_vmin = 255
+        with timing.stage('reload_rmbg'), VideoStore(rmbg_store_path) as rmbg_store:
+            neuron_video = VideoBuffer(os.path.join(tmp_out, 'neuron.dat'), rmbg_store.shape, np.float16)
+            for start, stop, frames in tqdm(rmbg_store.chunks(rmbg_chunk_size)):
+                neuron_video[start:stop] = frames
+                neuron_vmin = min(neuron_vmin, int(frames.min()))
     
     # %% save rmbg video
     if not jump_to_seg:
         # save video
         if not jump_to_seg:
-            save_video(neuron_video, fr, out_path + '/rmbg.avi', quality=avi_quality)
-
-        logger.info('=======>save RMBG video<=======\n')
-        tmp_outpath = f'{rmbg_out}/all'
-        os.makedirs(tmp_outpath, exist_ok = True)
-        for i, frame in tqdm(enumerate(neuron_video)): # save back to a list
-            tifffile.imwrite(os.path.join(tmp_outpath, 'frame_'+str(i)+'.tif'),  frame.astype(np.uint8))  # Save as TIFF file
-        
+            with timing.stage('save_avi'):
+                save_video(neuron_video, fr, out_path + '/rmbg.avi', quality=avi_quality)
 
     # %% [markdown]
     # # Segmentation
     # %%
     # do the segmentation. We have to do patch based segmentation
-    # A is a N x H x W array, where N is the number of neurons, H and W are the height and width of the frames.
+    # A is a SparseMasks of N masks over the H x W frames, where N is the number of neurons, H and W are the height and width of the frames.
     # C is a N x T array, where N is the number of neurons, T is the frame number.
     logger.info('=======>segmentation<=======\n')
     
@@ -597,42 +673,47 @@ def PICO_processing(args):
     # Iterate over patches
     if not jump_to_vis: # flow control
         _, d1, d2, = neuron_video.shape
-        begin_to_concat = False
-
-        for i in range(0, d1, patch_size):
-            for j in range(0, d2, patch_size):
-                logger.info(f'=======>segment patch {i},{j}<=======\n')
-                # Extract patch
-                patch = neuron_video[:, i:i+patch_size, j:j+patch_size]
-                tmp_seg_out = os.path.join(seg_out, f'patch_{i}_{j}')
-                os.makedirs(tmp_seg_out, exist_ok=True)
-                A_tmp, C_tmp = neuron_segmentation(patch,
-                                    tmp_seg_out,
-                                    pixel_size = pixel_size,
-                                    minArea = minArea,
-                                    avgArea = avgArea,
-                                    thresh_pmap = thresh_pmap,
-                                    thresh_mask = thresh_mask,
-                                    thresh_COM0 = thresh_COM0,
-                                    thresh_COM = thresh_COM,
-                                    cons = cons)
-
-                if isinstance(A_tmp, np.ndarray):
-                    # enhance A_tmp to a global size
-                    A_tmp2 = np.zeros([A_tmp.shape[0], d1, d2], dtype=bool)
-                    A_tmp2[:, i:i+patch_size, j:j+patch_size] = A_tmp
-
-                    if not begin_to_concat:
-                        A = A_tmp2
-                        C = C_tmp
-                        begin_to_concat = True
-
-                    else:
-                        A = np.concatenate((A, A_tmp2), axis=0)
-                        C = np.concatenate((C, C_tmp), axis=0)
+        timing.begin('segmentation')
+        timing.begin('patches')
+        # patches run serially (default): parallelize over the frames of each patch instead,
+        # with one pool shared by all the patches
+        seg_pool = SegmentationPool(seg_frame_workers or None) if seg_patch_workers <= 1 else None
+        n_patches = math.ceil(d1 / patch_size) * math.ceil(d2 / patch_size)
+        if seg_pool is not None:
+            logger.info(f'=======>segment {n_patches} patches with {seg_pool.n_workers} frame workers<=======\n')
+        else:
+            logger.info(f'=======>segment {n_patches} patches with {seg_patch_workers} patch workers<=======\n')
+        try:
+            A, C = segment_patches(neuron_video,
+                                   seg_out,
+                                   patch_size = patch_size,
+                                   n_workers = seg_patch_workers,
+                                   pool = seg_pool,
+                                   return_traces = False,
+                                   pixel_size = pixel_size,
+                                   minArea = minArea,
+                                   avgArea = avgArea,
+                                   thresh_pmap = thresh_pmap,
+                                   thresh_mask = thresh_mask,
+                                   thresh_COM0 = thresh_COM0,
+                                   thresh_COM = thresh_COM,
+                                   cons = cons)
+        finally:
+            if seg_pool is not None:
+                seg_pool.close()
+        timing.end('patches')
+        if len(A) == 0:
+            logger.warning('no neuron found, the segmentation results are empty')
+        neuron_video.delete()
+        del neuron_video
+
+        # traces on the stitched masks, so neurons on patch borders are complete
+        logger.info('=======>extract traces<=======\n')
+        with timing.stage('traces'), VideoStore(rmbg_store_path) as rmbg_store:
+            C = extract_traces(A, rmbg_store, chunk_size=64, n_threads=read_threads, vmin=neuron_vmin, scale=1 / 255.0)
         # %%
         logger.info(f"A.shape: {A.shape}")
-        logger.info(f"A.dtype: {A.dtype}")
+        logger.info(f"A pixels: {A.csr.nnz}")
         logger.info(f"C.shape: {C.shape}")
         logger.info(f"C.dtype: {C.dtype}")
 
@@ -642,42 +723,28 @@ def PICO_processing(args):
         logger.info('=======>calculate center of these neuorns<=======\n')
         d1 = A.shape[2] # x, width
         d2 = A.shape[1] # y, height
-        A_2d = A.reshape(A.shape[0], -1).T
-        cm_chunk = 1000
-        cm_chunk_num = math.ceil(A_2d.shape[1] / cm_chunk)
-        for i in tqdm(range(cm_chunk_num)):
-            cm_tmp = com(A=A_2d[:, i*cm_chunk:(i+1)*cm_chunk].astype(np.float32), d1 = d1, d2 = d2) # A no longer be a boolen array
-            if i == 0:
-                cm = cm_tmp
-            else:
-                cm = np.concatenate((cm, cm_tmp), axis=0)
+        cm = A.com()
 
         # important: cm is (x, y) but not (h, w). TODO check!
         # save A and C and cm
-        del A_2d
-        sparse_frames = convert_to_sparse(A)
         assert A.shape[0] == C.shape[0]
-        save_sparse_frames_to_mat(sparse_frames, seg_out + '/seg_results.mat')
+        A.save_mat(seg_out + '/seg_results.mat')
         savemat(seg_out + '/infer_results.mat', {'C': C})
         savemat(seg_out + '/cm.mat', {'cm': cm})
         
-        result_name = seg_out + '/SEG_SUM.png'
-        mask_sum = np.sum(A, axis=0).astype('uint8')
-        mask_sum = mask_sum * int(255/np.max(mask_sum))
-        io.imsave(result_name, mask_sum)
+        save_mask_sum(A, seg_out + '/SEG_SUM.png')
+        timing.end('segmentation')
     
     else:
         logger.info('=======>loading segmentation results<=======\n')
         # load A
-        A = load_sparse_frames_from_mat(filename=seg_out + '/seg_results.mat')
-        A = np.array(A)
+        A = SparseMasks.load_mat(seg_out + '/seg_results.mat')
         d1 = A.shape[2] # x, width
         d2 = A.shape[1] # y, height
         # load C
         C = loadmat(seg_out + '/infer_results.mat')['C']
         # load cm
         cm = loadmat(seg_out + '/cm.mat')['cm']
-        cm_chunk = 1000
     # %%
     # visualize cm
     # Plotting
@@ -688,6 +755,7 @@ def PICO_processing(args):
     plt.close()
     # %%
     # revise the segments without the vessel contamination
+    timing.begin('filtering')
     invalid_idx = []
     vessel_mask_resize = cv2.resize(vessel_mask, (d1, d2), interpolation=cv2.INTER_NEAREST) # so the size does not matter
     # do not using interpolation=cv2.INTER_CUBIC, since we are dealing with binary mask
@@ -715,38 +783,27 @@ def PICO_processing(args):
     del cm
     
     # %%
-    A_filtered = np.delete(A, invalid_idx, axis=0)
+    A_filtered = A.delete(invalid_idx)
     C_filtered = np.delete(C, invalid_idx, axis=0)
     
     # %% additional shape filtering
     invalid_idx2 = filter_masks_by_roundness(A_filtered, max_axis_ratio=3, min_occupancy=0.5) # TODO test
     
-    A_filtered = np.delete(A_filtered, invalid_idx2, axis=0)
+    A_filtered = A_filtered.delete(invalid_idx2)
     C_filtered = np.delete(C_filtered, invalid_idx2, axis=0)
     
     # save filtered segments
-    result_name = seg_out + '/SEG_SUM_filtered.png'
-    mask_sum = np.sum(A_filtered, axis=0).astype('uint8')
-    mask_sum = mask_sum * int(255/np.max(mask_sum))
-    io.imsave(result_name, mask_sum)
+    save_mask_sum(A_filtered, seg_out + '/SEG_SUM_filtered.png')
     # %%
-    A_2d_filtered = A_filtered.reshape(A_filtered.shape[0], -1).T
-    
-    cm_chunk_num = math.ceil(A_2d_filtered.shape[1] / cm_chunk)
-    for i in tqdm(range(cm_chunk_num)):
-        cm_tmp = com(A=A_2d_filtered[:, i*cm_chunk:(i+1)*cm_chunk].astype(np.float32), d1 = d1, d2 = d2) # A no longer be a boolen array
-        if i == 0:
-            cm_filtered = cm_tmp
-        else:
-            cm_filtered = np.concatenate((cm_filtered, cm_tmp), axis=0)
+    cm_filtered = A_filtered.com()
             
     plot_cm(cm_filtered, d1, d2, save_path=os.path.join(seg_out, 'cm_wo_vessel.png'), save_svg_path=os.path.join(seg_out, 'cm_wo_vessel.svg'))
     plt.pause(5)
     plt.close()
     # %%
     # comparison
-    visualize_img_and_mask(vessel_img.astype(np.float32), np.sum(A, axis=0).astype(np.float32), 
-                           np.sum(A_filtered, axis=0).astype(np.float32),
+    visualize_img_and_mask(vessel_img.astype(np.float32), A.sum_image().astype(np.float32), 
+                           A_filtered.sum_image().astype(np.float32),
                            save_path=os.path.join(seg_out, 'neuron_mask.png'),
                            save_svg_path=os.path.join(seg_out, 'neuron_mask.svg')
                            )
@@ -754,8 +811,8 @@ def PICO_processing(args):
     plt.close()
     # %%
     # save A and C and cm
-    sparse_frames = convert_to_sparse(A_filtered)
-    save_sparse_frames_to_mat(sparse_frames, seg_out + '/seg_results_filtered.mat')
+    A_filtered.save_mat(seg_out + '/seg_results_filtered.mat')
+    timing.end('filtering')
     savemat(seg_out + '/infer_results_filtered.mat', {'C': C_filtered})
     savemat(seg_out + '/cm_filtered.mat', {'cm': cm_filtered})
     # %% [markdown]
@@ -771,16 +828,21 @@ def PICO_processing(args):
     # b = np.zeros((d1 * d2, 1), dtype = 'float32')
     # f = np.zeros((1, len(neuron_video)), dtype = 'float32')
     logger.info('Plotting Traces.....................\n')
-    plot_trace(seg_out + '/seg_results_filtered.mat', 
+    timing.begin('plot_trace')
+    plot_trace(A_filtered, 
                seg_out + '/infer_results_filtered.mat', 
                seg_out + '/Neuron_trace/', 
                frame_len = 1000, 
                neuron_step = 100)
+    timing.end('plot_trace')
 
     end_time = datetime.now()
 
     logger.info(f'end time: {end_time}')
     logger.info(f'{end_time-start_time} spent for {frame_num} calcium processing.')
+    profiler.log(logger)
+    profiler.dump(os.path.join(out_path, 'timings.json'))
+    timing.activate(None)
     
  
 if __name__ == '__main__':
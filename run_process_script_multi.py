@@ -1,6 +1,8 @@
 import os
 import json
 
+from pipeline import VideoStore
+
 # Define the paths
 # data_paths = ["/mnt/nas/lk/pico/Experiments/maze/20240930maze/8#/calcium01/frames",
 #               "/mnt/nas/lk/pico/Experiments/maze/20240930maze/8#/calcium02/frames",
@@ -158,19 +160,20 @@ def check_analysis_status(out_path, data_path):
     frames_count = count_files_in_directory(data_path)
     jump_to_rmbg, jump_to_seg, jump_to_vis = False, False, False
 
-    analysis_dir = os.path.join(out_path, "preprocess")
-    rmbg_dir = os.path.join(out_path, "rmbg", "all")
+    # the stage containers keep the number of frames written in their metadata
+    preprocess_store = os.path.join(out_path, "preprocess", "preprocess.h5")
+    rmbg_store = os.path.join(out_path, "rmbg", "rmbg.h5")
     seg_results_dir = os.path.join(out_path, "seg_results_thresh_pmap_1")
 
     # Check if the preprocessing images are available
-    if count_files_in_directory(analysis_dir) == frames_count and \
+    if VideoStore.completed_frames(preprocess_store) == frames_count and \
             os.path.exists(os.path.join(out_path, "vessel_image.tif")) and \
             os.path.exists(os.path.join(out_path, "vessel_mask.tif")):
         print(f"Preprocessing completed, setting jump_to_rmbg=True")
         jump_to_rmbg = True
 
     # Check if the rmbg step is completed
-    if count_files_in_directory(rmbg_dir) == frames_count:
+    if VideoStore.completed_frames(rmbg_store) == frames_count:
         print(f"RMBG completed, setting jump_to_seg=True")
         jump_to_seg = True
 
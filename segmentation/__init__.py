@@ -1 +1,5 @@
-from .segment import *
\ No newline at end of file
+from .segment import *
+from .masks import SparseMasks
+from .traces import extract_traces
+from .patches import segment_patches
+from .pool import SegmentationPool
\ No newline at end of file
@@ -9,6 +9,8 @@ import multiprocessing as mp
 from .seperate_neurons import watershed_neurons, separate_neuron
 from .combine import segs_results, unique_neurons2_simp, group_neurons, piece_neurons_IOU, piece_neurons_consume
 from .refine_cons import refine_seperate, refine_seperate_output, refine_seperate_multi
+from .pool import SegmentationPool
+from pipeline import timing
 
 
 # %%
@@ -40,7 +42,8 @@ def complete_segment(pmaps: np.ndarray, Params: dict, useMP=True, useWT=False, d
         useMP (bool, defaut to True): indicator of whether multiprocessing is used to speed up. 
         useWT (bool, default to False): Indicator of whether watershed is used. 
         display (bool, default to False): Indicator of whether to show intermediate information
-        p (multiprocessing.Pool, default to None): 
+        p (SegmentationPool or multiprocessing.Pool, default to None): the worker pool used if useMP. 
+            A SegmentationPool shares the frames with the workers instead of pickling them.
 
     Outputs:
         Masks_2 (sparse.csr_matrix of bool): the final segmented binary neuron masks after consecutive refinement. 
@@ -60,10 +63,16 @@ def complete_segment(pmaps: np.ndarray, Params: dict, useMP=True, useWT=False, d
 
     # Segment neuron masks from each frame of probability map 
     start = time.time()
-    if useMP:
-        segs = p.starmap(separate_neuron, [(frame, thresh_pmap, minArea, avgArea, useWT) for frame in pmaps], chunksize=1)
+    timing.begin('separate_neurons')
+    if useMP and isinstance(p, SegmentationPool):
+        segs = p.separate_neurons(pmaps, thresh_pmap, minArea, avgArea, useWT)
+    elif useMP:
+        segs = p.starmap(separate_neuron, [(frame, thresh_pmap, minArea, avgArea, useWT) for frame in pmaps], \
+            chunksize=max(1, nframes // (4 * mp.cpu_count())))
     else:
         segs =[separate_neuron(frame, thresh_pmap, minArea, avgArea, useWT) for frame in pmaps]
+    timing.count(frames=nframes)
+    timing.end('separate_neurons')
     end = time.time()
     num_neurons = sum([x[1].size for x in segs])
     if display:
@@ -76,6 +85,7 @@ def complete_segment(pmaps: np.ndarray, Params: dict, useMP=True, useWT=False, d
         Masks_2 = sparse.csc_matrix((0,Lx*Ly), dtype='bool')
     else: # find active neurons
         start = time.time()
+        timing.begin('merge_neurons')
         # Initally merge neurons with close COM.
         totalmasks, neuronstate, COMs, areas, probmapID = segs_results(segs)
         uniques, times_uniques = unique_neurons2_simp(totalmasks, neuronstate, COMs, \
@@ -115,10 +125,12 @@ def complete_segment(pmaps: np.ndarray, Params: dict, useMP=True, useWT=False, d
 
         masks_final_2 = piecedneurons
         times_final = [np.unique(x) for x in times_piecedneurons]
+        timing.end('merge_neurons')
             
         # Refine neurons using consecutive occurence requirement
         start = time.time()
-        Masks_2 = refine_seperate(masks_final_2, times_final, cons, thresh_mask)
+        with timing.stage('refine_neurons'):
+            Masks_2 = refine_seperate(masks_final_2, times_final, cons, thresh_mask)
         end_all = time.time()
         if display:
             print('{:25s}: Used {:9.6f} s, {:9.6f} ms/frame, '\
@@ -160,7 +172,8 @@ def complete_segment_output(pmaps: np.ndarray, Params: dict, useMP=True, useWT=F
         useMP (bool, defaut to True): indicator of whether multiprocessing is used to speed up. 
         useWT (bool, default to False): Indicator of whether watershed is used. 
         display (bool, default to False): Indicator of whether to show intermediate information
-        p (multiprocessing.Pool, default to None): 
+        p (SegmentationPool or multiprocessing.Pool, default to None): the worker pool used if useMP. 
+            A SegmentationPool shares the frames with the workers instead of pickling them.
 
     Outputs:
         Masks_2 (sparse.csr_matrix of bool): the final segmented binary neuron masks after consecutive refinement. 
@@ -180,8 +193,11 @@ def complete_segment_output(pmaps: np.ndarray, Params: dict, useMP=True, useWT=F
 
     # Segment neuron masks from each frame of probability map 
     start = time.time()
-    if useMP:
-        segs = p.starmap(separate_neuron, [(frame, thresh_pmap, minArea, avgArea, useWT) for frame in pmaps], chunksize=1)
+    if useMP and isinstance(p, SegmentationPool):
+        segs = p.separate_neurons(pmaps, thresh_pmap, minArea, avgArea, useWT)
+    elif useMP:
+        segs = p.starmap(separate_neuron, [(frame, thresh_pmap, minArea, avgArea, useWT) for frame in pmaps], \
+            chunksize=max(1, nframes // (4 * mp.cpu_count())))
     else:
         segs =[separate_neuron(frame, thresh_pmap, minArea, avgArea, useWT) for frame in pmaps]
     end = time.time()
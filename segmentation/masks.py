@@ -0,0 +1,175 @@
+import numpy as np
+from scipy import sparse
+from scipy.io import savemat, loadmat
+
+
+class SparseMasks:
+    """
+    Binary neuron masks stored as one sparse row per neuron.
+
+    The masks are a (N, d1 * d2) bool CSR matrix over the pixels flattened in C order,
+    so memory scales with the total number of mask pixels instead of N * d1 * d2.
+    The bounding box of every mask is kept alongside, which lets per-neuron operations
+    (traces, shape filtering, drawing) work on small dense crops.
+
+    Parameters:
+    - csr : sparse matrix
+        (N, d1 * d2) masks, converted to bool CSR.
+    - dims : tuple
+        (d1, d2) = (height, width) of the field of view.
+
+    Example:
+        masks = SparseMasks.from_dense(Masks)  # (N, d1, d2) bool
+        crop, roi = masks.crop(0)  # same as convert_mask(Masks[0])
+        masks = masks.delete(invalid_idx)
+        masks.save_mat(output_folder + '/seg_results.mat')
+    """
+
+    def __init__(self, csr, dims):
+        self.csr = sparse.csr_matrix(csr, dtype=bool)
+        self.csr.eliminate_zeros()
+        self.csr.sort_indices()
+        self.dims = (int(dims[0]), int(dims[1]))
+        assert self.csr.shape[1] == self.dims[0] * self.dims[1], 'masks do not match dims'
+        self._bboxes = None
+
+    @classmethod
+    def from_dense(cls, masks):
+        """Builds the masks from a (N, d1, d2) array."""
+        masks = np.asarray(masks)
+        return cls(sparse.csr_matrix(masks.reshape(masks.shape[0], -1), dtype=bool), masks.shape[1:])
+
+    @classmethod
+    def empty(cls, dims):
+        return cls(sparse.csr_matrix((0, dims[0] * dims[1]), dtype=bool), dims)
+
+    @classmethod
+    def vstack(cls, masks_list, dims):
+        """Concatenates masks of the same field of view, in order."""
+        masks_list = [masks.csr for masks in masks_list]
+        if len(masks_list) == 0:
+            return cls.empty(dims)
+        return cls(sparse.vstack(masks_list, format='csr'), dims)
+
+    @property
+    def shape(self):
+        return (self.csr.shape[0],) + self.dims
+
+    def __len__(self):
+        return self.csr.shape[0]
+
+    @property
+    def areas(self):
+        """Number of pixels of every mask."""
+        return np.diff(self.csr.indptr)
+
+    @property
+    def bboxes(self):
+        """(N, 4) int array of [y0, y1, x0, x1] per mask, end exclusive as in convert_mask."""
+        if self._bboxes is None:
+            bboxes = np.zeros((len(self), 4), dtype=np.int64)
+            areas = self.areas
+            valid = areas > 0
+            if valid.any():
+                rows, cols = np.divmod(self.csr.indices, self.dims[1])
+                starts = self.csr.indptr[:-1][valid]
+                bboxes[valid, 0] = np.minimum.reduceat(rows, starts)
+                bboxes[valid, 1] = np.maximum.reduceat(rows, starts) + 1
+                bboxes[valid, 2] = np.minimum.reduceat(cols, starts)
+                bboxes[valid, 3] = np.maximum.reduceat(cols, starts) + 1
+            self._bboxes = bboxes
+        return self._bboxes
+
+    def pixels(self, i):
+        """(rows, cols) of the pixels of mask i."""
+        return np.divmod(self.csr.indices[self.csr.indptr[i]:self.csr.indptr[i + 1]], self.dims[1])
+
+    def window(self, i, y0, y1, x0, x1):
+        """
+        Dense bool crop of mask i over a window of the field of view.
+
+        The window is clipped to the field of view. Returns the crop and its (y0, x0).
+        """
+        y0, x0 = max(int(y0), 0), max(int(x0), 0)
+        y1, x1 = min(int(y1), self.dims[0]), min(int(x1), self.dims[1])
+        crop = np.zeros((max(y1 - y0, 0), max(x1 - x0, 0)), dtype=bool)
+        rows, cols = self.pixels(i)
+        inside = (rows >= y0) & (rows < y1) & (cols >= x0) & (cols < x1)
+        crop[rows[inside] - y0, cols[inside] - x0] = True
+        return crop, (y0, x0)
+
+    def crop(self, i, margin=0):
+        """
+        Dense bool crop of mask i over its bounding box, grown by margin pixels.
+
+        With margin=0 this matches convert_mask: returns (mask_valid, roi) with
+        roi = [y0, y1, x0, x1].
+        """
+        y0, y1, x0, x1 = self.bboxes[i]
+        crop, (y0, x0) = self.window(i, y0 - margin, y1 + margin, x0 - margin, x1 + margin)
+        return crop, [y0, y0 + crop.shape[0], x0, x0 + crop.shape[1]]
+
+    def shift(self, offset, dims):
+        """Places the masks at (y, x) = offset in a larger field of view of size dims."""
+        rows, cols = np.divmod(self.csr.indices, self.dims[1])
+        indices = (rows + offset[0]) * dims[1] + (cols + offset[1])
+        csr = sparse.csr_matrix((self.csr.data, indices, self.csr.indptr),
+                                shape=(len(self), dims[0] * dims[1]))
+        return SparseMasks(csr, dims)
+
+    def keep(self, idx):
+        """Masks at the given indices (or bool selector), in that order."""
+        return SparseMasks(self.csr[np.asarray(idx)], self.dims)
+
+    def delete(self, idx):
+        """Masks without the given indices, like np.delete(A, idx, axis=0)."""
+        keep = np.ones(len(self), dtype=bool)
+        keep[np.asarray(idx, dtype=np.int64)] = False
+        return self.keep(np.nonzero(keep)[0])
+
+    def toarray(self):
+        """Dense (N, d1, d2) bool array. Only for small fields of view."""
+        return self.csr.toarray().reshape(self.shape)
+
+    def sum_image(self):
+        """(d1, d2) number of masks covering every pixel, np.sum(A, axis=0) for the dense masks."""
+        return np.bincount(self.csr.indices, minlength=self.dims[0] * self.dims[1]).reshape(self.dims)
+
+    def com(self):
+        """
+        Center of mass of every mask, same as Visualization.com on the dense masks.
+
+        Returns:
+        - cm : ndarray of shape (N, 2), in (x, y) order.
+        """
+        rows, cols = np.divmod(self.csr.indices, self.dims[1])
+        areas = self.areas
+        starts = self.csr.indptr[:-1]
+        cm = np.full((len(self), 2), np.nan)
+        valid = areas > 0
+        if valid.any():
+            cm[valid, 0] = np.add.reduceat(cols.astype(np.float64), starts[valid]) / areas[valid]
+            cm[valid, 1] = np.add.reduceat(rows.astype(np.float64), starts[valid]) / areas[valid]
+        return cm
+
+    def save_mat(self, filename):
+        """
+        Saves the masks to a .mat file.
+
+        'A' is the (d1 * d2, N) sparse matrix of the masks, pixels flattened in C order,
+        and 'dims' is (d1, d2). In MATLAB: reshape(full(A(:, i)), dims(2), dims(1))'.
+        """
+        savemat(filename, {'A': self.csr.T.tocsc(), 'dims': np.array(self.dims)})
+
+    @classmethod
+    def load_mat(cls, filename):
+        """Loads masks saved by save_mat, or by save_sparse_frames_to_mat (one 'frame_i' per neuron)."""
+        data = loadmat(filename)
+        if 'A' in data:
+            return cls(sparse.csr_matrix(data['A'].T), tuple(np.ravel(data['dims'])))
+        names = sorted([key for key in data if key.startswith('frame_')], key=lambda key: int(key[6:]))
+        if len(names) == 0:
+            raise ValueError(f'no masks found in {filename}')
+        dims = data[names[0]].shape
+        rows = [sparse.csr_matrix(data[name]).reshape(1, -1) for name in names]
+        return cls(sparse.vstack(rows, format='csr'), dims)
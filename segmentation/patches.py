@@ -0,0 +1,75 @@
+import os
+import multiprocessing as mp
+
+import numpy as np
+
+from .masks import SparseMasks
+from .segment import neuron_segmentation
+
+
+def _segment_patch(video_path, shape, dtype, i, j, patch_size, output_folder, seg_params):
+    # every worker maps the same file, so the patch is read from the page cache
+    video = np.memmap(video_path, dtype=dtype, mode='r', shape=shape)
+    patch = video[:, i:i + patch_size, j:j + patch_size]
+    Masks, C = neuron_segmentation(patch, output_folder, return_sparse=True, **seg_params)
+    if len(Masks) == 0:
+        return None, None
+    return Masks.shift((i, j), shape[1:]), C
+
+
+def segment_patches(video, output_folder, patch_size=500, n_workers=1, pool=None, return_traces=True, **seg_params):
+    """
+    Run neuron_segmentation on square patches of the video in parallel.
+
+    Patches are independent, so they can be fanned out to a process pool. Workers map
+    the video file themselves instead of receiving a pickled copy. The results of each
+    patch are saved in output_folder/patch_i_j as before. By default the patches run
+    serially and the frames of each patch are separated in parallel by pool.
+
+    Parameters:
+    - video : VideoBuffer
+        (T, d1, d2) memmap backed probability map.
+    - output_folder : str
+        Segmentation output folder.
+    - patch_size : int
+        Side length of the patches.
+    - n_workers : int
+        Number of patch worker processes, 1 runs the patches serially in this process.
+        Each worker holds a float32 copy of its patch, plan the memory accordingly.
+    - pool : SegmentationPool, optional
+        Frame-level worker pool used when the patches run serially. Pool workers cannot
+        start pools of their own, so it is ignored when n_workers > 1.
+    - return_traces : bool
+        Extract the traces of each patch. Neurons cut by a patch border get partial traces,
+        set it to False and use extract_traces on the whole video instead.
+    - seg_params :
+        Keyword arguments passed on to neuron_segmentation.
+
+    Returns:
+    - A : SparseMasks of the (d1, d2) field of view, with N = 0 if no neuron was found.
+    - C : ndarray of shape (N, T), or None if return_traces is False.
+    """
+    video.flush()
+    _, d1, d2 = video.shape
+    seg_params = dict(seg_params, return_traces=return_traces)
+    tasks = [(video.path, video.shape, video.dtype, i, j, patch_size,
+              os.path.join(output_folder, f'patch_{i}_{j}'), seg_params)
+             for i in range(0, d1, patch_size) for j in range(0, d2, patch_size)]
+
+    if n_workers > 1:
+        # spawn: numba and torch thread pools of the parent are not fork safe
+        with mp.get_context('spawn').Pool(min(n_workers, len(tasks))) as patch_pool:
+            results = patch_pool.starmap(_segment_patch, tasks, chunksize=1)
+    else:
+        results = [_segment_patch(*task[:-1], dict(task[-1], p=pool)) for task in tasks]
+
+    # stitch once, in patch order
+    results = [result for result in results if result[0] is not None]
+    A = SparseMasks.vstack([result[0] for result in results], (d1, d2))
+    if not return_traces:
+        C = None
+    elif len(results) == 0:
+        C = np.zeros((0, video.shape[0]), dtype=np.float32)
+    else:
+        C = np.concatenate([result[1] for result in results], axis=0)
+    return A, C
@@ -0,0 +1,104 @@
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from .seperate_neurons import separate_neuron
+
+
+def _separate_block(shm_name, shape, dtype, start, stop, thresh_pmap, minArea, avgArea, useWT):
+    '''Worker side of SegmentationPool.separate_neurons.
+        Attaches the shared probability maps by name and segments frames start:stop.
+    '''
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        pmaps = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        segs = [separate_neuron(pmaps[t], thresh_pmap, minArea, avgArea, useWT) for t in range(start, stop)]
+        del pmaps
+    finally:
+        shm.close()
+    return segs
+
+
+def _separate_block_star(args):
+    return _separate_block(*args)
+
+
+class SegmentationPool:
+    '''Persistent worker pool for the frame-wise part of the post-processing.
+        The pool is created once per run and reused by every call of complete_segment,
+        so the worker start-up cost (spawn + imports) is paid only once.
+        The probability maps are copied once into shared memory, and the workers receive
+        only its name and a block of frame indices, instead of a pickled copy of every frame.
+
+    Inputs:
+        n_workers (int, default to None): number of worker processes. None uses all the CPUs.
+        blocks_per_worker (int, default to 4): number of frame blocks handed to each worker per call.
+            More blocks balance the load better, fewer blocks reduce the scheduling overhead.
+
+    Example:
+        with SegmentationPool() as p:
+            Masks_2 = complete_segment(pmaps, Params, useMP=True, p=p)
+    '''
+    def __init__(self, n_workers=None, blocks_per_worker=4):
+        self.n_workers = n_workers if n_workers else mp.cpu_count()
+        self.blocks_per_worker = blocks_per_worker
+        # spawn: numba and torch thread pools of the parent are not fork safe
+        self.pool = mp.get_context('spawn').Pool(self.n_workers)
+
+    def chunksize(self, nframes):
+        '''Number of frames per task for a video of nframes frames.'''
+        return max(1, nframes // (self.blocks_per_worker * self.n_workers))
+
+    def separate_neurons(self, pmaps, thresh_pmap=None, minArea=0, avgArea=0, useWT=False):
+        '''Run separate_neuron on every frame of "pmaps" in the workers.
+
+        Inputs:
+            pmaps (3D numpy.ndarray, shape = (nframes,Lx,Ly)): the probability maps or the binary activity.
+            thresh_pmap, minArea, avgArea, useWT: passed on to separate_neuron.
+
+        Outputs:
+            segs (list): the output of separate_neuron for every frame, in frame order.
+        '''
+        pmaps = np.ascontiguousarray(pmaps)
+        nframes = pmaps.shape[0]
+        if nframes == 0:
+            return []
+        shm = shared_memory.SharedMemory(create=True, size=max(1, pmaps.nbytes))
+        try:
+            shared = np.ndarray(pmaps.shape, dtype=pmaps.dtype, buffer=shm.buf)
+            shared[:] = pmaps
+            del shared
+            chunksize = self.chunksize(nframes)
+            tasks = [(shm.name, pmaps.shape, pmaps.dtype, start, min(start + chunksize, nframes),
+                      thresh_pmap, minArea, avgArea, useWT) for start in range(0, nframes, chunksize)]
+            segs = []
+            # imap keeps the block order, so the frame order of segs is unchanged
+            for block in self.pool.imap(_separate_block_star, tasks):
+                segs.extend(block)
+        finally:
+            shm.close()
+            shm.unlink()
+        return segs
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def terminate(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        # do not wait for running tasks if segmentation failed
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
@@ -19,6 +19,8 @@ from .combine import segs_results, unique_neurons2_simp, \
     group_neurons, piece_neurons_IOU, piece_neurons_consume
 from .complete_post import complete_segment
 from .par3 import fastthreshold
+from .masks import SparseMasks
+from .traces import extract_traces
 
 def convert_mask(mask):
     row_sum = np.sum(mask, axis = 0)
@@ -79,6 +81,22 @@ def save_sparse_frames_to_mat(sparse_frames, filename='sparse_data.mat'):
     data_dict = {f'frame_{i}': frame for i, frame in enumerate(sparse_frames)}
     savemat(filename, data_dict)
 
+def save_mask_sum(masks, filename):
+    """
+    Save the number of masks covering every pixel as a uint8 image, scaled to 0-255.
+
+    Parameters:
+    - masks : SparseMasks or ndarray
+        The masks, sparse or as a dense (N, H, W) array.
+    - filename : str
+        Path of the image.
+    """
+    mask_sum = masks.sum_image() if isinstance(masks, SparseMasks) else np.sum(masks, axis=0)
+    mask_sum = mask_sum.astype('uint8')
+    if np.max(mask_sum) > 0: # no mask gives a black image
+        mask_sum = mask_sum * int(255/np.max(mask_sum))
+    io.imsave(filename, mask_sum)
+
 def load_sparse_frames_from_mat(filename):
     """
     Loads Boolean frames from a MAT file and returns them as a list.
@@ -93,6 +111,10 @@ def load_sparse_frames_from_mat(filename):
     data = loadmat(filename)
     frames = []
 
+    # files written by SparseMasks.save_mat keep all the masks in 'A'
+    if 'A' in data:
+        return list(SparseMasks.load_mat(filename).toarray())
+
     # Iterate over the keys in the data dictionary
     for key in data:
         # Check if the key matches the expected pattern ('frame_...')
@@ -114,7 +136,10 @@ def neuron_segmentation(prob_map,
                         thresh_mask = 0.5,  # values higher than "thresh_mask" times the maximum value of the mask are set to one
                         thresh_COM0 = 4, # maximum COM distance of two masks to be considered the same neuron in the initial merging (unit: pixels)
                         thresh_COM = 8, # maximum COM distance of two masks to be considered the same neuron (unit: pixels)
-                        cons = 3):
+                        cons = 3,
+                        p = None, # SegmentationPool used to segment the frames in parallel, None runs serially
+                        return_sparse = False, # return the masks as SparseMasks instead of a dense (N, Lx, Ly) array
+                        return_traces = True): # extract the traces C, skip it if they are extracted later on the stitched video
 
     display = True
     start = time.time()
@@ -165,9 +190,8 @@ def neuron_segmentation(prob_map,
     # io.imsave(im_folder + '\\' + im_name + '_seg' + 'threshold.tiff', pmaps_b, check_contrast=False)
 
     # the rest of post-processing. The result is a 2D sparse matrix of the segmented neurons
-    p = None
     useWT = False
-    useMP = False
+    useMP = p is not None
     Masks_2 = complete_segment(pmaps_b, Params_post_copy, useMP=useMP, p=p, useWT=useWT, display=display)
     if display:
         finish = time.time()
@@ -175,17 +199,16 @@ def neuron_segmentation(prob_map,
         time_frame_post = time_post/nframes*1000
         print('Processing Done: {:6f} s, {:6f} ms/frame'.format(time_post, time_frame_post))
 
-    # convert to a 3D array of the segmented neurons
-    Masks = np.reshape(Masks_2.toarray(), (Masks_2.shape[0], Lx, Ly)).astype('bool')
+    # keep the segmented neurons sparse, rows are the masks flattened in C order
+    Masks = SparseMasks(Masks_2, (Lx, Ly))
 
     # save in smart way, utilizing sparse matrix
-    sparse_frames = convert_to_sparse(Masks)
-    save_sparse_frames_to_mat(sparse_frames, output_folder + '/seg_results.mat') # note can be empty
+    Masks.save_mat(output_folder + '/seg_results.mat') # note can be empty
 
 
     # save summary image
     result_name = output_folder + '/SEG_SUM.png'
-    if np.sum(Masks, axis = 0).max() == 0:
+    if len(Masks) == 0 or Masks.sum_image().max() == 0:
         mask_sum = np.zeros(prob_map.shape[1:], dtype='uint8')
         io.imsave(result_name, mask_sum)
         
@@ -193,9 +216,7 @@ def neuron_segmentation(prob_map,
         C = []
         return Masks, C
     else:
-        mask_sum = np.sum(Masks, axis = 0).astype('uint8')
-        mask_sum = mask_sum * int(255/np.max(mask_sum))
-        io.imsave(result_name, mask_sum)
+        save_mask_sum(Masks, result_name)
 
     if display:
         finish = time.time()
@@ -208,12 +229,13 @@ def neuron_segmentation(prob_map,
     N = Masks.shape[0] # component number
     print('Final Neuron number: ', N)
 
-    C = np.zeros((N, nframes), dtype = 'float32')
-    for i in range(N):
-        # read the target positions
-        mask_valid, roi = convert_mask(Masks[i])
-        curr_temporal_signal = np.squeeze(np.sum(prob_map[:,roi[0]:roi[1],roi[2]:roi[3]] * mask_valid.astype(np.float32), axis=(1, 2))) # broadcast here.
-        C[i] = curr_temporal_signal
+    if not return_traces:
+        if not return_sparse:
+            Masks = Masks.toarray()
+        return Masks, None
+
+    # prob_map is already normalized
+    C = extract_traces(Masks, prob_map, vmin=0, scale=1)
 
     if display:
         finish = time.time()
@@ -228,4 +250,6 @@ def neuron_segmentation(prob_map,
         time_post = finish-start
         print('Temporal signal saved: {:6f} s'.format(time_post))
     
+    if not return_sparse:
+        Masks = Masks.toarray()
     return Masks, C
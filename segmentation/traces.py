@@ -0,0 +1,53 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from tqdm import tqdm
+
+
+def extract_traces(masks, video, chunk_size=200, n_threads=1, vmin=0, scale=1 / 255.0):
+    """
+    Temporal traces of all the masks at once, C = scale * A @ (Y - vmin).
+
+    The video is read in blocks of chunk_size frames and only the pixels covered by
+    at least one mask are kept, so one sparse-dense product per block gives the traces
+    of every neuron. Works on the stitched full field of view, so neurons crossing
+    patch borders get their whole mask.
+
+    Parameters:
+    - masks : SparseMasks
+        (N, d1, d2) masks.
+    - video : array-like
+        (T, d1, d2) video, e.g. VideoStore, VideoBuffer or ndarray. Only time slices are read.
+    - chunk_size : int
+        Number of frames read at once.
+    - n_threads : int
+        Number of blocks processed in parallel, the sparse product releases the GIL.
+    - vmin : float
+        Value subtracted from the video, e.g. its minimum.
+    - scale : float
+        Scaling of the traces, 1 / 255 maps uint8 frames to 0-1 as in neuron_segmentation.
+
+    Returns:
+    - C : ndarray of shape (N, T), float32.
+    """
+    T = len(video)
+    assert tuple(video.shape[1:]) == masks.dims, 'masks and video do not have the same field of view'
+    # restrict the product to the pixels in use
+    pixels = np.unique(masks.csr.indices)
+    A = masks.csr[:, pixels].astype(np.float32)
+    offset = vmin * masks.areas.astype(np.float32)[:, None]
+    C = np.zeros((len(masks), T), dtype=np.float32)
+
+    def process(start):
+        stop = min(start + chunk_size, T)
+        Y = np.asarray(video[start:stop]).reshape(stop - start, -1)[:, pixels].astype(np.float32)
+        C[:, start:stop] = (A @ Y.T - offset) * scale
+
+    starts = range(0, T, chunk_size)
+    if n_threads > 1:
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            list(tqdm(pool.map(process, starts), total=len(starts)))
+    else:
+        for start in tqdm(starts):
+            process(start)
+    return C